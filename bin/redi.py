@@ -13,9 +13,18 @@ __email__ = "nrejack@ufl.edu"
 __status__ = "Development"
 
 import ast
+import bisect
+import contextlib
+import copy
 import errno
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing
 import pickle
+import Queue
+import threading
 import time
 from datetime import date, datetime, timedelta
 from collections import defaultdict
@@ -27,6 +36,8 @@ import sys
 import imp
 import argparse
 import os
+import tempfile
+import zlib
 
 from requests import RequestException
 from lxml import etree
@@ -35,6 +46,8 @@ from utils import redi_email
 from utils.redcapClient import redcapClient
 import utils.SimpleConfigParser as SimpleConfigParser
 import utils.GetEmrData as GetEmrData
+import utils.raw_data_columns as raw_data_columns
+from utils.raw_data_columns import RawDataColumns
 from utils.GetEmrData import EmrConnectionDetails
 
 
@@ -63,6 +76,10 @@ _person_form_events_service = None
 
 translational_table_tree = None
 
+# Bump this whenever the layout of ConfigLookups changes so that cached
+# lookups compiled by an older version are not reused
+CONFIG_LOOKUPS_VERSION = 1
+
 DEFAULT_DATA_DIRECTORY = os.getcwd()
 
 
@@ -131,6 +148,19 @@ def main():
 
     db_path = get_db_path(settings.batch_info_database, data_directory)
 
+    if args['invalidate_record'] or args['invalidate_form']:
+        if not os.path.exists(db_path):
+            # the database is created with its tables by the first run
+            logger.info('There is no payload ledger in %s yet' % db_path)
+            return
+        ledger = redi_lib.PayloadLedger(db_path)
+        forgotten = ledger.invalidate(args['invalidate_record'],
+                                      args['invalidate_form'])
+        ledger.close()
+        logger.info('Removed %s events from the payload ledger in %s' % (
+            forgotten, db_path))
+        return
+
     output_files = os.path.join(data_directory, "data")
     _makedirs(output_files)
 
@@ -145,10 +175,17 @@ def main():
 
     _person_form_events_service = PersonFormEventsRepository(\
         os.path.join(output_files, 'person_form_event_tree_with_data.xml'),\
-         logger)
+         logger, settings.status_journal)
+
+    profile_dir = None
+    if args['profile']:
+        profile_dir = os.path.join(
+            data_directory, 'log',
+            'profile_' + datetime.now().strftime('%Y_%m_%d-%H_%M_%S'))
 
     _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
-         get_emr_data, settings, output_files, db_path, args['resume'], args['skip_blanks'])
+         get_emr_data, settings, output_files, db_path, args['resume'],
+         args['skip_blanks'], args['workers'], profile_dir)
 
 
 def _makedirs(data_folder):
@@ -165,6 +202,7 @@ def _delete_last_runs_data(data_folder):
     _remove(os.path.join(data_folder, 'alert_summary.obj'))
     _remove(os.path.join(data_folder, 'rule_errors.obj'))
     _remove(os.path.join(data_folder, 'collection_date_summary_dict.obj'))
+    _remove(os.path.join(data_folder, 'subject_digests.obj'))
 
 
 def _remove(path):
@@ -205,7 +243,8 @@ def _save(obj, path):
 
 
 def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
-         get_emr_data, settings, data_folder, database_path, resume=False, skip_blanks=False):
+         get_emr_data, settings, data_folder, database_path, resume=False,
+         skip_blanks=False, workers=1, profile_dir=None):
     global translational_table_tree
 
     assert _person_form_events_service is not None
@@ -219,20 +258,29 @@ def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
             settings.emr_sftp_project_name,
             settings.emr_data_file)
         print props
-        GetEmrData.get_emr_data(configuration_directory, props)
+        # when the csv file is ingested directly raw.xml is only needed if
+        # the generated files are kept
+        GetEmrData.get_emr_data(configuration_directory, props,
+            settings.raw_data_format != 'csv' or do_keep_gen_files,
+            settings.raw_csv_file, settings.raw_xml_file)
 
     # load custom post-processing rules
     rules = load_rules(settings.rules, configuration_directory)
 
     # read in 3 main data files / translation tables
 
-    raw_xml_file = os.path.join(configuration_directory, settings.raw_xml_file)
+    if settings.raw_data_format == 'csv':
+        raw_data_file = os.path.join(configuration_directory,
+                                     settings.raw_csv_file)
+    else:
+        raw_data_file = os.path.join(configuration_directory,
+                                     settings.raw_xml_file)
     # we need the batch information to set the
     # status to `completed` an ste the `rbEndTime`
     email_settings = get_email_settings(settings)
     redcap_settings = get_redcap_settings(settings)
     db_path = database_path
-    batch = _check_input_file(db_path, email_settings, raw_xml_file, settings)
+    batch = _check_input_file(db_path, email_settings, raw_data_file, settings)
 
     form_events_file = os.path.join(configuration_directory,\
      settings.form_events_file)
@@ -251,14 +299,28 @@ def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
     report_xsl = proj_root + "bin/utils/report.xsl"
     send_email = settings.send_email
 
+    metrics = redi_lib.StageMetrics(profile_dir=profile_dir)
     if not resume:
         _delete_last_runs_data(data_folder)
 
+        subject_filter = None
+        if settings.incremental_subjects:
+            subject_filter = _select_changed_subjects(
+                config_file, configuration_directory, raw_data_file, settings,
+                data_folder, db_path)
+            if not subject_filter:
+                logger.info('None of the subjects changed since the last '
+                            'run. There is no data to send.')
+                _finish_run(batch, db_path, dry_run, data_folder,
+                            do_keep_gen_files)
+                return
+
         alert_summary, person_form_event_tree_with_data, rule_errors, \
         collection_date_summary_dict = _create_person_form_event_tree_with_data(
             config_file, configuration_directory, email_settings,\
-             form_events_file, raw_xml_file, redcap_settings, rules,\
-              settings, data_folder, translation_table_file, dry_run)
+             form_events_file, raw_data_file, redcap_settings, rules,\
+              settings, data_folder, translation_table_file, dry_run,
+               database_path, subject_filter, workers, metrics)
 
         _store_run_data(data_folder, alert_summary,
                         person_form_event_tree_with_data, rule_errors,
@@ -266,22 +328,51 @@ def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
 
     alert_summary, person_form_event_tree_with_data, rule_errors, collection_date_summary_dict = \
         _fetch_run_data(data_folder)
+    # the stages of a resumed run are added to the ones of the stopped run
+    metrics_file = os.path.join(data_folder, 'stage_metrics.json')
+    if resume and os.path.exists(metrics_file):
+        metrics = redi_lib.StageMetrics.read(metrics_file, profile_dir)
+    metrics.write(metrics_file)
+    if profile_dir is not None:
+        logger.info('The profiles of the stages are written to %s' %
+                    profile_dir)
 
     # Data will be sent to REDCap server and email will be sent only if
     # redi.py is not executing in dry run state.
     if not dry_run:
         unsent_events = person_form_event_tree_with_data.xpath("//event/status[.='unsent']")
+        if settings.payload_ledger:
+            ledger = redi_lib.PayloadLedger(db_path)
+        else:
+            ledger = None
         # Use the new method to communicate with RedCAP
         report_data = redi_lib.generate_output(
             person_form_event_tree_with_data, redcap_settings, email_settings,
-            _person_form_events_service, skip_blanks)
-        # write person_form_event_tree to file
-        write_element_tree_to_file(person_form_event_tree_with_data,\
-         os.path.join(data_folder, 'person_form_event_tree_with_data.xml'))
+            _person_form_events_service, skip_blanks, ledger, metrics)
+        if ledger is not None:
+            ledger.close()
+        metrics.write(metrics_file)
+        report_data['stages'] = metrics.stages
+        # write person_form_event_tree to file; this also compacts the
+        # status journal into the file
+        _person_form_events_service.store(person_form_event_tree_with_data)
         sent_events = person_form_event_tree_with_data.xpath("//event/status[.='sent']")
         if len(unsent_events) != len(sent_events):
             logger.warning('Some of the events are not sent to the redcap. Please check event statuses in '+data_folder+'person_form_event_tree_with_data.xml')
 
+        # remember the subjects of this run so the next incremental run only
+        # processes the ones which change; if an event was not sent all of
+        # them are processed again
+        subject_digests_file = os.path.join(data_folder, 'subject_digests.obj')
+        if os.path.exists(subject_digests_file):
+            if len(unsent_events) == len(sent_events):
+                redi_lib.store_subject_digests(
+                    db_path, _load(subject_digests_file),
+                    batch['rbID'] if batch else None)
+            else:
+                logger.warning('Subject digests are not stored because some '
+                               'events were not sent')
+
         # Add any errors from running the rules to the report
         map(logger.warning, rule_errors)
 
@@ -314,6 +405,10 @@ def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
                 raise
             report_file.write(html_str)
 
+    _finish_run(batch, db_path, dry_run, data_folder, do_keep_gen_files)
+
+
+def _finish_run(batch, db_path, dry_run, data_folder, do_keep_gen_files):
     if batch:
         # Update the batch row
         done_timestamp = redi_lib.get_db_friendly_date_time()
@@ -328,154 +423,507 @@ def _run(config_file, configuration_directory, do_keep_gen_files, dry_run,
         redi_lib.delete_temporary_folder(data_folder)
 
 
+def _select_changed_subjects(config_file, configuration_directory,
+                             raw_data_file, settings, data_folder, db_path):
+    """
+    Return the STUDY_IDs whose raw data digest differs from the one stored
+    by the last run, and save all digests of this run to the data folder
+
+    The configuration files are part of every digest, so all subjects are
+    processed again when one of them changes.
+    """
+    config_files = [config_file] + [
+        os.path.join(configuration_directory, file_name) for file_name in [
+            settings.form_events_file,
+            settings.translation_table_file,
+            settings.component_to_loinc_code_xml,
+            settings.research_id_to_redcap_id,
+            settings.replace_fields_in_raw_data_xml] if file_name]
+    digests = compute_subject_digests(
+        iter_raw_subjects(raw_data_file, settings.raw_data_format),
+        get_config_digest(config_files))
+    changed = changed_subjects(digests,
+                               redi_lib.get_subject_digests(db_path))
+    logger.info('%s of %s subjects are new or changed since the last run',
+                len(changed), len(digests))
+    _save(digests, os.path.join(data_folder, 'subject_digests.obj'))
+    return changed
+
+
 def _create_person_form_event_tree_with_data(config_file, \
-    configuration_directory, email_settings, form_events_file, raw_xml_file,\
+    configuration_directory, email_settings, form_events_file, raw_data_file,\
      redcap_settings, rules, settings, data_folder, translation_table_file,\
-      dry_run):
+      dry_run, database_path, subject_filter=None, workers=1, metrics=None):
     global translational_table_tree
-    # parse the raw.xml file and fill the etree rawElementTree
-    data = parse_raw_xml(raw_xml_file)
+    if metrics is None:
+        metrics = redi_lib.StageMetrics()
+    snapshots = SnapshotWriter(data_folder, settings.snapshot_policy,
+                               settings.snapshot_background)
+    try:
+        # Compile the lookups of the configuration files or reuse the ones
+        # compiled by an earlier run if none of the files changed
+        component_to_loinc_code_xml = os.path.join(configuration_directory, \
+                                      settings.component_to_loinc_code_xml)
+        component_to_loinc_code_xsd = proj_root + \
+                                      "bin/utils/component_id_to_loinc_code.xsd"
+        with metrics.stage('configuration lookups'):
+            lookups = load_config_lookups(
+                get_config_cache_path(database_path), form_events_file,
+                translation_table_file, component_to_loinc_code_xml,
+                component_to_loinc_code_xsd)
+
+        if streams_sorted_subjects(settings, workers):
+            alert_summary, person_form_event_tree_with_data, \
+            collection_date_summary_dict = _stream_person_form_event_tree(
+                config_file, configuration_directory, email_settings,
+                raw_data_file, redcap_settings, settings, data_folder,
+                dry_run, lookups, subject_filter, metrics, snapshots)
+        else:
+            if int(settings.sort_buffer_rows):
+                logger.warning("sort_buffer_rows only applies when the raw "
+                    "data is streamed by one worker without the columnar "
+                    "engine. The raw data is sorted in memory.")
+            if settings.columnar_engine:
+                data, collection_date_summary_dict = _create_raw_data_from_columns(
+                    config_file, configuration_directory, raw_data_file, settings,
+                    data_folder, lookups, subject_filter, metrics, snapshots)
+            else:
+                data, collection_date_summary_dict = _create_raw_data_tree(
+                    config_file, configuration_directory, raw_data_file, settings,
+                    data_folder, lookups, subject_filter, metrics, snapshots)
+            form_events_tree = lookups.form_events_tree()
+            all_form_events_per_subject = lookups.all_form_events_tree()
+            with metrics.stage('event names', metrics.rows_out) as stage:
+                # update eventName element
+                alert_summary = update_event_name(data, form_events_tree, 'undefined')
+                # write back the changed global Element Tree
+                snapshots.write(data, 'rawDataWithAllUpdates.xml', final=True)
+                stage['rows_out'] = count_subjects(data)
+            # Research ID - to - Redcap ID converter
+            with metrics.stage('research ID mapping', metrics.rows_out) as stage:
+                research_id_to_redcap_id_converter(
+                    data,
+                    redcap_settings,
+                    email_settings,
+                    settings.research_id_to_redcap_id,dry_run,
+                    configuration_directory)
+                stage['rows_out'] = count_subjects(data)
+            if workers > 1:
+                # build the person form event tree of each partition of the
+                # subjects in its own process; the writer thread must be idle
+                # when the processes are forked
+                snapshots.flush()
+                with metrics.stage('person form event tree',
+                                   metrics.rows_out) as stage:
+                    person_form_event_tree_with_data = \
+                        build_person_form_event_tree_in_parallel(
+                            data, all_form_events_per_subject, form_events_tree,
+                            lookups.status_field_lookup,
+                            settings.sparse_person_form_event_tree, workers)
+                    stage['rows_out'] = count_events(person_form_event_tree_with_data)
+            else:
+                subjects = metrics.rows_out
+                # create person_form_event_tree.xml
+                with metrics.stage('empty event tree', subjects) as stage:
+                    person_form_event_tree = create_empty_event_tree_for_study(
+                        data,
+                        all_form_events_per_subject,
+                        settings.sparse_person_form_event_tree)
+                    # write person_form_event_tree to file
+                    snapshots.write(person_form_event_tree,
+                                    'person_form_event_tree.xml')
+                    stage['rows_out'] = count_events(person_form_event_tree)
+                # copy data to person form event tree
+                with metrics.stage('copy data', subjects) as stage:
+                    if settings.sparse_person_form_event_tree:
+                        # events are added from the template when data is copied to
+                        # them
+                        index = PersonFormEventIndex(person_form_event_tree,
+                                                     all_form_events_per_subject)
+                    else:
+                        index = None
+                    person_form_event_tree_with_data = \
+                        copy_data_to_person_form_event_tree(
+                            data, person_form_event_tree, form_events_tree, index)
+                    stage['rows_out'] = count_events(person_form_event_tree_with_data)
+                # update status field in person form event tree
+                with metrics.stage('status fields', metrics.rows_out) as stage:
+                    updateStatusFieldValueInPersonFormEventTree \
+                        (person_form_event_tree_with_data, translational_table_tree,
+                         lookups.status_field_lookup)
+                    stage['rows_out'] = count_events(person_form_event_tree_with_data)
+        # write person form event tree with data (both regular fields\
+        # and status fields) to file
+        snapshots.write(person_form_event_tree_with_data,
+                        'person_form_event_tree_with_data.xml')
+        # run custom post-processing rules
+        with metrics.stage('rules', metrics.rows_out) as stage:
+            person_form_event_tree_with_data, rule_errors = run_rules(
+                rules, person_form_event_tree_with_data)
+            stage['rows_out'] = count_events(person_form_event_tree_with_data)
+    except:
+        # stop the writer thread and drop its copies of the trees
+        snapshots.close(discard=True)
+        raise
+    snapshots.close()
+    return alert_summary, person_form_event_tree_with_data, rule_errors, \
+    collection_date_summary_dict
 
-    # check if raw element tree is empty
-    if not data:
-        # raise an exception if empty
-        raise Exception('data is empty')
 
-    # add blank elements to each subject in data tree
-    add_elements_to_tree(data)
-    # replace fields in raw_xml
+def _compile_renames(config_file, configuration_directory, settings):
+    """ Compile the fields to rename in the raw data """
+    renames = {}
     if settings.replace_fields_in_raw_data_xml:
         replace_fields_in_raw_data_xml = os.path.join(\
             configuration_directory, settings.replace_fields_in_raw_data_xml)
-        data = replace_fields_in_raw_xml(data, replace_fields_in_raw_data_xml)
+        renames = compile_field_renames(
+            read_fields_to_replace(replace_fields_in_raw_data_xml))
     else:
         logger.warning("Parameter 'replace_fields_in_raw_data_xml' missing"\
         " in {0}. Fields will not be replaced".format(config_file))
+    return renames
 
-    data, collection_date_summary_dict = \
-    verify_and_correct_collection_date(data, settings.input_date_format)
-    # write_element_tree_to_file(data, proj_root+'raw_with_proper_dates.xml')
-
-    # Convert COMPONENT_ID to loinc_code in the raw data
-    component_to_loinc_code_xml = os.path.join(configuration_directory, \
-                                  settings.component_to_loinc_code_xml)
-    component_to_loinc_code_xsd = proj_root + \
-                                  "bin/utils/component_id_to_loinc_code.xsd"
-    component_to_loinc_code_xml_tree = validate_xml_file_and_extract_data \
-        (component_to_loinc_code_xml, component_to_loinc_code_xsd)
-    convert_component_id_to_loinc_code(data, component_to_loinc_code_xml_tree)
-    # parse the formEvents.xml file and fill the etree 'form_events_file'
-    form_events_tree = parse_form_events(form_events_file)
-    forms = form_events_tree.findall("form/name")
-    form_Completed_Field_Names = form_events_tree. \
-        findall("form/formCompletedFieldName")
-    form_data = {}
-    for i in range(len(forms)):
-        form_data[forms[i].text] = form_Completed_Field_Names[i].text
 
+def _write_config_trees(lookups, snapshots):
+    """
+    Check the trees of the configuration lookups, write them with the
+    SnapshotWriter `snapshots` and set the global translational_table_tree
+    """
+    global translational_table_tree
+    form_events_tree = lookups.form_events_tree()
     # check if form element tree is empty
     if not form_events_tree:
         # raise an exception if empty
         raise Exception('form_events_tree is empty')
-    write_element_tree_to_file(form_events_tree, os.path.join(data_folder,\
-     'formData.xml'))
+    snapshots.write(form_events_tree, 'formData.xml')
     # Create empty events for one subject and save it to the
     # all_form_events.xml
-    all_form_events_per_subject = create_empty_events_for_one_subject_helper \
-        (form_events_file, translation_table_file)
-    write_element_tree_to_file(all_form_events_per_subject,\
-     os.path.join(data_folder, 'all_form_events.xml'))
-    # parse the translationTable.xml file and fill the
-    # etree 'translation_table_file'
-    translational_table_tree = parse_translation_table(translation_table_file)
+    all_form_events_per_subject = lookups.all_form_events_tree()
+    snapshots.write(all_form_events_per_subject, 'all_form_events.xml')
+    translational_table_tree = lookups.translation_table_tree()
     # check if translational table element tree is empty
     if not translational_table_tree:
         # raise an exception if empty
         raise Exception('translational_table_tree is empty')
-    write_element_tree_to_file(translational_table_tree,\
-     os.path.join(data_folder, 'translationalData.xml'))
-    # update the timestamp for the global element tree
-    update_time_stamp(data, settings.input_date_format, settings.output_date_format)
-    # write back the changed global Element Tree
-    write_element_tree_to_file(data, os.path.join(data_folder,\
-     'rawData.xml'))
-    # update the redcap form name
-    update_redcap_form(data, translational_table_tree, 'undefined')
-    # write the element tree
-    write_element_tree_to_file(data, os.path.join(data_folder,\
-     'rawDataWithFormName.xml'))
-    # set all formImportedFieldName value to the value mapped from
-    # formEvents.xml
-    update_form_imported_field(data, form_events_tree, 'undefined')
-    # output raw file to check it
-    write_element_tree_to_file(
-        data,
-        os.path.join(data_folder, 'rawDataWithFormImported.xml'))
-    # update the redcapStatusFieldName
-    update_recap_form_status(data, translational_table_tree, 'undefined')
-    # output raw file to check it
-    write_element_tree_to_file(data, os.path.join(data_folder,\
-     'rawDataWithFormStatus.xml'))
-    # update formDateField
-    update_formdatefield(data, form_events_tree)
-    # write back the changed global Element Tree
-    write_element_tree_to_file(data, os.path.join(data_folder,\
-     'rawData.xml'))
-    # update formCompletedFieldName
-    update_formcompletedfieldname(data, form_events_tree, 'undefined')
-    # write back the changed global Element Tree
-    write_element_tree_to_file(
-        data,
-        os.path.join(data_folder, 'rawDataWithFormCompletedField.xml'))
-    # update element that holds the name of the redcap field that will hold
-    # the datum or value.
-    # Also update the name of the redcap field that will hold the units
-    update_redcap_field_name_value_and_units(data, translational_table_tree,
-                                             'undefined')
-    # write back the changed global Element Tree
-    write_element_tree_to_file(
-        data,
-        os.path.join(data_folder, 'rawDataWithDatumAndUnitsFieldNames.xml'))
-    # sort the data tree
-    sort_element_tree(data)
-    write_element_tree_to_file(data, os.path.join(data_folder, \
-        'rawDataSorted.xml'))
-    # update eventName element
-    alert_summary = update_event_name(data, form_events_tree, 'undefined')
-    # write back the changed global Element Tree
-    write_element_tree_to_file(data, os.path.join(data_folder, \
-        'rawDataWithAllUpdates.xml'))
-    # Research ID - to - Redcap ID converter
-    research_id_to_redcap_id_converter(
-        data,
-        redcap_settings,
-        email_settings,
-        settings.research_id_to_redcap_id,dry_run,
-        configuration_directory)
-    # create person_form_event_tree.xml
-    person_form_event_tree = create_empty_event_tree_for_study(
-        data,
-        all_form_events_per_subject)
-    # write person_form_event_tree to file
-    write_element_tree_to_file(person_form_event_tree,
-                               os.path.join(data_folder,\
-                                'person_form_event_tree.xml'))
-    # copy data to person form event tree
-    person_form_event_tree_with_data = copy_data_to_person_form_event_tree \
-        (data, person_form_event_tree, form_events_tree)
+    snapshots.write(translational_table_tree, 'translationalData.xml')
+
+
+def streams_sorted_subjects(settings, workers=1):
+    """
+    Return True if the sorted subjects of the raw data are streamed into the
+    person form event tree by _stream_person_form_event_tree()
+    """
+    return bool(int(settings.sort_buffer_rows)) and workers == 1 and \
+        not settings.columnar_engine and \
+        (settings.stream_raw_data or settings.raw_data_format == 'csv')
+
+
+def _stream_person_form_event_tree(config_file, configuration_directory,
+                                   email_settings, raw_data_file,
+                                   redcap_settings, settings, data_folder,
+                                   dry_run, lookups, subject_filter=None,
+                                   metrics=None, snapshots=None):
+    """
+    Build the person form event tree with status fields without building
+    the raw data tree
+
+    The subjects streamed by stream_raw_subjects() are sorted by a
+    SubjectSorter which spills runs of `sort_buffer_rows` subjects to the
+    data folder. Each subject of the merged runs gets its event name and
+    redcap id and is copied to the person form event tree, where its person
+    is created when the first of its subjects arrives. The subjects are
+    dropped once they are copied, so only the sort buffer, one subject of
+    each run and the person form event tree are held in memory.
+    rawDataSorted.xml is not written and rawDataWithAllUpdates.xml is
+    written as the subjects stream by.
+
+    :return: the alert summary, the person form event tree with data and
+        the collection date summary
+    """
+    if metrics is None:
+        metrics = redi_lib.StageMetrics()
+    if snapshots is None:
+        snapshots = SnapshotWriter(data_folder)
+    renames = _compile_renames(config_file, configuration_directory, settings)
+    _write_config_trees(lookups, snapshots)
+    form_events_tree = lookups.form_events_tree()
+    all_form_events_per_subject = lookups.all_form_events_tree()
+
+    collection_date_summary_dict = {'total': 0, 'blank': 0}
+    unmapped = Counter()
+    sorter = SubjectSorter(settings.sort_buffer_rows, data_folder)
+    try:
+        with metrics.stage('read raw data') as stage:
+            # run the stages up to the annotation on each subject as it is
+            # read and hand it to the sort
+            for subject in stream_raw_subjects(
+                    raw_data_file, settings, lookups, renames, subject_filter,
+                    collection_date_summary_dict, unmapped):
+                sorter.add(subject)
+            if not sorter.count:
+                raise Exception('data is empty')
+            log_collection_date_summary(collection_date_summary_dict)
+            log_unmapped_components(unmapped)
+            logger.info('Read {0} subjects, {1} sorted runs spilled'.format(
+                sorter.count, len(sorter.runs)))
+            stage['rows_out'] = sorter.count
+
+        with metrics.stage('research ID mapping', metrics.rows_out):
+            redcap_dict = fetch_research_id_to_redcap_id(
+                redcap_settings, email_settings,
+                settings.research_id_to_redcap_id, dry_run,
+                configuration_directory)
+
+        with metrics.stage('person form event tree',
+                           metrics.rows_out) as stage:
+            assigner = EventNameAssigner(form_events_tree, 'undefined')
+            bad_ids = defaultdict(int)
+
+            def mapped_subjects(write_subject):
+                for subject in sorter.subjects():
+                    assigner.assign(subject)
+                    write_subject(subject)
+                    if map_research_id(subject, redcap_dict, bad_ids):
+                        yield subject
+
+            with snapshots.subject_stream('rawDataWithAllUpdates.xml',
+                                          final=True) as write_subject:
+                person_form_event_tree = \
+                    build_person_form_event_tree_from_stream(
+                        mapped_subjects(write_subject),
+                        all_form_events_per_subject, form_events_tree,
+                        settings.sparse_person_form_event_tree)
+            log_bad_research_ids(bad_ids)
+            stage['rows_out'] = count_events(person_form_event_tree)
+    finally:
+        sorter.close()
+
     # update status field in person form event tree
-    updateStatusFieldValueInPersonFormEventTree \
-        (person_form_event_tree_with_data, translational_table_tree)
-    # write person form event tree with data (both regular fields\
-    # and status fields) to file
-    write_element_tree_to_file(
-        person_form_event_tree_with_data,
-        os.path.join(data_folder, 'person_form_event_tree_with_data.xml'))
-    # run custom post-processing rules
-    person_form_event_tree_with_data, rule_errors = run_rules(
-        rules, person_form_event_tree_with_data)
-    return alert_summary, person_form_event_tree_with_data, rule_errors, \
-    collection_date_summary_dict
+    with metrics.stage('status fields', metrics.rows_out) as stage:
+        updateStatusFieldValueInPersonFormEventTree \
+            (person_form_event_tree, translational_table_tree,
+             lookups.status_field_lookup)
+        stage['rows_out'] = count_events(person_form_event_tree)
+    return assigner.alert_summary(), person_form_event_tree, \
+        collection_date_summary_dict
+
+
+def count_subjects(raw_data_tree):
+    """ Return the number of subject elements of the raw data """
+    return len(raw_data_tree.getroot().findall('subject'))
+
+
+def count_events(person_form_event_tree):
+    """ Return the number of events of a person form event tree """
+    return len(person_form_event_tree.getroot().findall(
+        'person/all_form_events/form/event'))
+
+
+def _create_raw_data_tree(config_file, configuration_directory,
+                          raw_data_file, settings, data_folder, lookups,
+                          subject_filter=None, metrics=None, snapshots=None):
+    """
+    Read the raw data into an ElementTree and run the transform stages on it
+    up to and including the sort
+
+    With a `subject_filter` only the subjects whose STUDY_ID is in it are
+    read. The stages are recorded in `metrics` and the intermediate files
+    are written by the SnapshotWriter `snapshots`. When the raw data is
+    streamed the stages up to the annotation run on each subject as it is
+    read, so they are recorded as part of 'read raw data' and their
+    intermediate files are not written; the subjects are still collected
+    into one tree for the sort.
+    """
+    if metrics is None:
+        metrics = redi_lib.StageMetrics()
+    if snapshots is None:
+        snapshots = SnapshotWriter(data_folder)
+    renames = _compile_renames(config_file, configuration_directory, settings)
+    _write_config_trees(lookups, snapshots)
+
+    if settings.stream_raw_data or settings.raw_data_format == 'csv':
+        collection_date_summary_dict = {'total': 0, 'blank': 0}
+        unmapped = Counter()
+        with metrics.stage('read raw data') as stage:
+            # read the rows of the EMR csv file, or stream the raw.xml file
+            # one subject at a time, and run the stages up to the annotation
+            # on each subject as it is read
+            data = build_raw_data_tree(stream_raw_subjects(
+                raw_data_file, settings, lookups, renames, subject_filter,
+                collection_date_summary_dict, unmapped))
+            # check if raw element tree is empty
+            if not data:
+                # raise an exception if empty
+                raise Exception('data is empty')
+            log_collection_date_summary(collection_date_summary_dict)
+            log_unmapped_components(unmapped)
+            stage['rows_out'] = count_subjects(data)
+    else:
+        data, collection_date_summary_dict = _transform_raw_data_tree(
+            raw_data_file, settings, lookups, renames, subject_filter,
+            metrics, snapshots)
+    # sort the data tree
+    with metrics.stage('sort', metrics.rows_out) as stage:
+        sort_element_tree(data)
+        snapshots.write(data, 'rawDataSorted.xml')
+        stage['rows_out'] = count_subjects(data)
+    return data, collection_date_summary_dict
+
+
+def _transform_raw_data_tree(raw_data_file, settings, lookups, renames,
+                             subject_filter, metrics, snapshots):
+    """
+    Parse the raw.xml file into an ElementTree and run the stages up to the
+    annotation on the whole tree, one stage after the other
+    """
+    with metrics.stage('read raw data') as stage:
+        # parse the raw.xml file and fill the etree rawElementTree
+        data = parse_raw_xml(raw_data_file)
+        if subject_filter is not None:
+            root = data.getroot()
+            for subject in root.findall('subject'):
+                if subject.findtext('STUDY_ID') not in subject_filter:
+                    root.remove(subject)
+
+        # check if raw element tree is empty
+        if not data:
+            # raise an exception if empty
+            raise Exception('data is empty')
+
+        # add blank elements to each subject in data tree
+        add_elements_to_tree(data)
+        # replace fields in raw_xml
+        rename_fields(data, renames)
+        stage['rows_out'] = count_subjects(data)
+
+    with metrics.stage('collection dates', metrics.rows_out) as stage:
+        data, collection_date_summary_dict = \
+        verify_and_correct_collection_date(data, settings.input_date_format)
+        stage['rows_out'] = count_subjects(data)
+    # write_element_tree_to_file(data, proj_root+'raw_with_proper_dates.xml')
+
+    # Convert COMPONENT_ID to loinc_code in the raw data
+    with metrics.stage('LOINC codes', metrics.rows_out) as stage:
+        component_to_loinc_code_xml_tree = \
+            lookups.component_to_loinc_code_tree()
+        convert_component_id_to_loinc_code(data,
+                                           component_to_loinc_code_xml_tree)
+        stage['rows_out'] = count_subjects(data)
+    # update the timestamp for the global element tree
+    with metrics.stage('timestamps', metrics.rows_out) as stage:
+        update_time_stamp(data, settings.input_date_format,
+                          settings.output_date_format)
+        # write back the changed global Element Tree
+        snapshots.write(data, 'rawData.xml')
+        stage['rows_out'] = count_subjects(data)
+    # look up the redcap form, the form fields and the names of the value,
+    # units and status fields of every subject
+    with metrics.stage('annotate subjects', metrics.rows_out) as stage:
+        annotate_subjects(data, lookups.components, lookups.forms,
+                          'undefined')
+        # write back the changed global Element Tree
+        snapshots.write(data, 'rawDataWithDatumAndUnitsFieldNames.xml')
+        stage['rows_out'] = count_subjects(data)
+    return data, collection_date_summary_dict
+
+
+def stream_raw_subjects(raw_data_file, settings, lookups, renames,
+                        subject_filter, collection_date_summary_dict,
+                        unmapped):
+    """
+    Stream the subjects of the raw data file, read as csv or xml depending
+    on `raw_data_format`, and run the stages up to the annotation on each
+    subject as it is read. The blank specimen taken times are counted in
+    `collection_date_summary_dict` and the components without a loinc_code
+    in the Counter `unmapped`.
+    """
+    mapping, source_names = compile_component_id_conversion(
+        lookups.component_to_loinc_code_tree())
+    subject_stages = [
+        add_elements_to_subject,
+        lambda subject: rename_subject_fields(subject, renames),
+        lambda subject: correct_subject_collection_date(
+            subject, settings.input_date_format,
+            collection_date_summary_dict),
+        lambda subject: convert_subject_component_id(
+            subject, mapping, source_names, unmapped),
+        lambda subject: update_subject_time_stamp(
+            subject, settings.input_date_format, settings.output_date_format),
+        subject_annotator(lookups.components, lookups.forms, 'undefined')]
+    return transform_subjects(
+        select_subjects(
+            iter_raw_subjects(raw_data_file, settings.raw_data_format),
+            subject_filter),
+        subject_stages)
+
+
+def _create_raw_data_from_columns(config_file, configuration_directory,
+                                  raw_data_file, settings, data_folder,
+                                  lookups, subject_filter=None, metrics=None,
+                                  snapshots=None):
+    """
+    Read the raw data into RawDataColumns, run the transform stages on the
+    columns and create the sorted ElementTree from them.
+
+    Only the files which describe the configuration and rawDataSorted.xml
+    are written; the intermediate raw data files of the tree stages are not.
+    The stages are recorded in `metrics` and the files are written by the
+    SnapshotWriter `snapshots`.
+    """
+    global translational_table_tree
+    if metrics is None:
+        metrics = redi_lib.StageMetrics()
+    if snapshots is None:
+        snapshots = SnapshotWriter(data_folder)
+    with metrics.stage('read raw data') as stage:
+        columns = RawDataColumns.from_subjects(select_subjects(
+            iter_raw_subjects(raw_data_file, settings.raw_data_format),
+            subject_filter))
+
+        if settings.replace_fields_in_raw_data_xml:
+            replace_fields_in_raw_data_xml = os.path.join(\
+                configuration_directory,
+                settings.replace_fields_in_raw_data_xml)
+            raw_data_columns.replace_fields(
+                columns,
+                read_fields_to_replace(replace_fields_in_raw_data_xml))
+        else:
+            logger.warning("Parameter 'replace_fields_in_raw_data_xml' "\
+            "missing in {0}. Fields will not be replaced".format(config_file))
+        stage['rows_out'] = len(columns)
+
+    with metrics.stage('collection dates', len(columns)) as stage:
+        columns, collection_date_summary_dict = \
+        raw_data_columns.verify_and_correct_collection_date(
+            columns, settings.input_date_format)
+        stage['rows_out'] = len(columns)
+    with metrics.stage('LOINC codes', len(columns)) as stage:
+        unmapped = Counter()
+        raw_data_columns.convert_component_id_to_loinc_code(columns,
+            compile_component_to_loinc_code(lookups.component_to_loinc_code),
+            unmapped)
+        log_unmapped_components(unmapped)
+        stage['rows_out'] = len(columns)
+
+    snapshots.write(lookups.form_events_tree(), 'formData.xml')
+    snapshots.write(lookups.all_form_events_tree(), 'all_form_events.xml')
+    translational_table_tree = lookups.translation_table_tree()
+    snapshots.write(translational_table_tree, 'translationalData.xml')
+
+    with metrics.stage('timestamps', len(columns)) as stage:
+        raw_data_columns.update_time_stamp(
+            columns, settings.input_date_format, settings.output_date_format)
+        stage['rows_out'] = len(columns)
+    with metrics.stage('annotate subjects', len(columns)) as stage:
+        raw_data_columns.update_from_lookups(
+            columns, lookups.components, lookups.forms, 'undefined')
+        stage['rows_out'] = len(columns)
+    with metrics.stage('sort', len(columns)) as stage:
+        columns.sort(['STUDY_ID', 'redcapFormName', 'timestamp'])
+        data = columns.to_element_tree()
+        snapshots.write(data, 'rawDataSorted.xml')
+        stage['rows_out'] = count_subjects(data)
+    return data, collection_date_summary_dict
 
 
 def _check_input_file(db_path, email_settings, raw_xml_file, settings):
@@ -554,6 +1002,40 @@ def parse_args(arguments=None):
         required=False,
         help='skip blank events when sending event data to RedCAP')
 
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        metavar='N',
+        help='Build the person form event tree in N processes, each one '\
+        'handling a share of the subjects. Defaults to 1.')
+
+    parser.add_argument(
+        '--profile',
+        default=False,
+        action='store_true',
+        help='Profile every stage of the run with cProfile and report the '\
+        'memory it allocates: the allocation sites when the tracemalloc '\
+        'module is available, otherwise the growth of the live objects by '\
+        'type. The reports are written to a profile_<timestamp> folder in '\
+        'the log folder.')
+
+    parser.add_argument(
+        '--invalidate-record',
+        action='append',
+        metavar='RECORD',
+        help='Remove the events of a REDCap record from the payload ledger '\
+        'so they are sent again by the next run, e.g. after the record was '\
+        'edited in REDCap. Can be repeated and combined with '\
+        '--invalidate-form.')
+
+    parser.add_argument(
+        '--invalidate-form',
+        action='append',
+        metavar='FORM',
+        help='Remove the events of a form from the payload ledger so they '\
+        'are sent again by the next run. Can be repeated.')
+
     if arguments:
         parsed = parser.parse_args(arguments)
     else:
@@ -573,20 +1055,184 @@ def parse_raw_xml(raw_xml_file):
         raise Exception\
             ("Error: raw xml file not found at file not found at "
              + raw_xml_file)
-    else:
-        raw = open(raw_xml_file, 'r')
-        logger.debug("Raw XML file read in. " + str(sum(1 for line in raw))
-                    + " total lines in file.")
 
-    parser = etree.XMLParser(remove_comments = True)
-    data = etree.parse(raw_xml_file, parser = parser)
+    # count the lines while lxml reads the file instead of reading it twice
+    with open(raw_xml_file, 'rb') as raw:
+        counting_raw = LineCountingFile(raw)
+        parser = etree.XMLParser(remove_comments = True)
+        data = etree.parse(counting_raw, parser = parser)
+    logger.debug("Raw XML file read in. " + str(counting_raw.lines)
+                + " total lines in file.")
     event_sum = len(data.findall(".//subject"))
     logger.debug(str(event_sum) + " total subject entries read into tree.")
-    raw.close()
     logger.debug("Raw XML file closed.")
     return data
 
 
+def iter_raw_xml(raw_xml_file, counts=None):
+    """
+    Stream the subjects of a raw XML file one at a time using iterparse.
+
+    Each subject is detached from the partially built document before it is
+    yielded, so the caller owns it and the parser holds none of the subjects
+    read so far. Memory is bounded by what the caller keeps. A subject is
+    only detached, and yielded, once the parser has moved past it, as
+    libxml2 still appends the text which follows a subject to it.
+
+    :param raw_xml_file: the input file.
+    :param counts: optional dictionary which receives the number of `lines`
+        and `subjects` read, computed during the same pass over the file
+    :return: generator of subject elements
+    """
+    if not os.path.exists(raw_xml_file):
+        raise Exception\
+            ("Error: raw xml file not found at file not found at "
+             + raw_xml_file)
+    if counts is None:
+        counts = {}
+    counts['subjects'] = 0
+
+    with open(raw_xml_file, 'rb') as raw:
+        counting_raw = LineCountingFile(raw)
+        context = etree.iterparse(counting_raw, events=('end',),
+                                  tag='subject', remove_comments=True)
+        parsed = None
+        for _, subject in context:
+            counts['subjects'] += 1
+            if parsed is not None:
+                yield detach_subject(parsed)
+            parsed = subject
+        if parsed is not None:
+            yield detach_subject(parsed)
+        del context
+
+    counts['lines'] = counting_raw.lines
+    logger.debug("Raw XML file streamed. " + str(counts['lines'])
+                + " total lines in file.")
+    logger.debug(str(counts['subjects'])
+                 + " total subject entries streamed from file.")
+
+
+def detach_subject(subject):
+    """
+    Remove a subject, and the elements before it, from the document being
+    parsed and return it
+    """
+    parent = subject.getparent()
+    while subject.getprevious() is not None:
+        del parent[0]
+    parent.remove(subject)
+    subject.tail = None
+    return subject
+
+
+def stream_raw_xml(raw_xml_file, subject_stages=()):
+    """
+    Build the raw data tree from a stream of subjects instead of parsing the
+    whole document first.
+
+    Every subject read by `iter_raw_xml` is passed through each of the
+    `subject_stages` (callables accepting one subject element) while it is
+    read and then moved into a fresh `<study>` element, so the per-subject
+    transformations do not need another walk over the tree.
+
+    :param raw_xml_file: the input file.
+    :param subject_stages: callables applied to every subject in order
+    :return: ElementTree holding the transformed subjects
+    """
+    return build_raw_data_tree(iter_raw_xml(raw_xml_file), subject_stages)
+
+
+def iter_raw_subjects(raw_data_file, raw_data_format='xml'):
+    """
+    Stream the subjects of the raw data file, read as csv or xml depending
+    on `raw_data_format`
+    """
+    if raw_data_format == 'csv':
+        return GetEmrData.iter_csv_subjects(raw_data_file)
+    return iter_raw_xml(raw_data_file)
+
+
+def select_subjects(subjects, study_ids=None):
+    """
+    Pass on the subjects whose STUDY_ID is in `study_ids`, or all of them
+    when `study_ids` is None
+    """
+    for subject in subjects:
+        if study_ids is None or subject.findtext('STUDY_ID') in study_ids:
+            yield subject
+
+
+def compute_subject_digests(subjects, salt=''):
+    """
+    Compute one sha1 digest per STUDY_ID over the serialized raw rows of
+    that subject, in the order they are read, starting from `salt`
+
+    :return: dictionary from STUDY_ID to hex digest
+    """
+    hashes = {}
+    for subject in subjects:
+        study_id = subject.findtext('STUDY_ID')
+        digest = hashes.get(study_id)
+        if digest is None:
+            digest = hashes[study_id] = hashlib.sha1(salt)
+        digest.update(etree.tostring(subject, with_tail=False))
+    return dict((study_id, digest.hexdigest())
+                for study_id, digest in hashes.iteritems())
+
+
+def changed_subjects(digests, stored_digests):
+    """ Return the set of STUDY_IDs which are new or whose digest changed """
+    return set(study_id for study_id, digest in digests.iteritems()
+               if stored_digests.get(study_id) != digest)
+
+
+def build_raw_data_tree(subjects, subject_stages=()):
+    """
+    Collect a stream of subjects into a `<study>` ElementTree, passing each
+    one through the `subject_stages` on the way in.
+
+    :param subjects: iterable of subject elements; a subject which belongs
+        to another tree is moved out of it
+    :param subject_stages: callables applied to every subject in order
+    :return: ElementTree holding the transformed subjects
+    """
+    root = etree.Element("study")
+    for subject in transform_subjects(subjects, subject_stages):
+        root.append(subject)
+    return etree.ElementTree(root)
+
+
+def transform_subjects(subjects, subject_stages=()):
+    """ Pass every subject of a stream through the `subject_stages` """
+    for subject in subjects:
+        for stage in subject_stages:
+            stage(subject)
+        yield subject
+
+
+class LineCountingFile(object):
+    """Read-only file wrapper which counts the lines handed to the parser"""
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._last = ''
+        self._newlines = 0
+
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        if chunk:
+            self._newlines += chunk.count('\n')
+            self._last = chunk[-1]
+        return chunk
+
+    @property
+    def lines(self):
+        # same as `sum(1 for line in file)`: count a trailing partial line
+        if self._last and self._last != '\n':
+            return self._newlines + 1
+        return self._newlines
+
+
 def parse_form_events(form_events_file):
     """
     Parse the form_events file into an ElementTree
@@ -641,15 +1287,20 @@ def add_elements_to_tree(data):
     :param data: the input ElementTree from the parsed raw XML file.
     """
     for element in data.iter('subject'):
-        element.append(etree.Element("timestamp"))
-        element.append(etree.Element("redcapFormName"))
-        element.append(etree.Element("eventName"))
-        element.append(etree.Element("formDateField"))
-        element.append(etree.Element("formCompletedFieldName"))
-        element.append(etree.Element("formImportedFieldName"))
-        element.append(etree.Element("redcapFieldNameValue"))
-        element.append(etree.Element("redcapFieldNameUnits"))
-        element.append(etree.Element("redcapStatusFieldName"))
+        add_elements_to_subject(element)
+
+
+def add_elements_to_subject(element):
+    """Add the blank elements filled out by later stages to one subject"""
+    element.append(etree.Element("timestamp"))
+    element.append(etree.Element("redcapFormName"))
+    element.append(etree.Element("eventName"))
+    element.append(etree.Element("formDateField"))
+    element.append(etree.Element("formCompletedFieldName"))
+    element.append(etree.Element("formImportedFieldName"))
+    element.append(etree.Element("redcapFieldNameValue"))
+    element.append(etree.Element("redcapFieldNameUnits"))
+    element.append(etree.Element("redcapStatusFieldName"))
 
 
 def update_recap_form_status(data, lookup_data, undefined):
@@ -703,6 +1354,97 @@ def write_element_tree_to_file(element_tree, file_name):
         pretty_print=True)
 
 
+class SnapshotWriter(object):
+    """
+    Writes the intermediate xml files of a run to `data_folder` according to
+    a snapshot policy: 'all' writes every file, 'final' only the ones passed
+    with final=True and 'none' writes no file.
+
+    With `background` set, write() copies the tree and a writer thread
+    serializes the copy while the next stage runs. close() waits for the
+    files and raises the first error of the writer thread; close() with
+    `discard` drops the files still queued and raises nothing.
+    """
+    POLICIES = ('none', 'final', 'all')
+
+    def __init__(self, data_folder, policy='all', background=False):
+        if policy not in self.POLICIES:
+            raise Exception("Invalid snapshot_policy '%s'. Use one of: %s" % (
+                policy, ', '.join(self.POLICIES)))
+        self.data_folder = data_folder
+        self.policy = policy
+        self.error = None
+        self._thread = None
+        self._discard = False
+        if background and policy != 'none':
+            # at most two copies wait for the writer
+            self._queue = Queue.Queue(maxsize=2)
+            self._thread = threading.Thread(target=self._write_queued)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def wants(self, final=False):
+        """ Return True if the policy writes a file """
+        return self.policy == 'all' or (self.policy == 'final' and final)
+
+    def write(self, element_tree, file_name, final=False):
+        if not self.wants(final):
+            return
+        path = os.path.join(self.data_folder, file_name)
+        if self._thread is None:
+            write_element_tree_to_file(element_tree, path)
+        else:
+            snapshot = etree.ElementTree(copy.deepcopy(element_tree.getroot()))
+            self._queue.put((snapshot, path))
+
+    @contextlib.contextmanager
+    def subject_stream(self, file_name, final=False):
+        """
+        Yield a function which writes a subject to the `<study>` element of
+        `file_name` as the subjects are produced, or does nothing if the
+        policy does not write the file. The file is written by the calling
+        thread.
+        """
+        if not self.wants(final):
+            yield lambda subject: None
+            return
+        path = os.path.join(self.data_folder, file_name)
+        logger.debug('Writing subjects to %s', path)
+        with etree.xmlfile(path, encoding='us-ascii') as xf:
+            xf.write_declaration()
+            with xf.element('study'):
+                xf.write('\n')
+                yield lambda subject: xf.write(subject, pretty_print=True)
+
+    def _write_queued(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None and not self._discard:
+                    write_element_tree_to_file(*item)
+            except Exception as e:
+                logger.exception('Could not write %s' % item[1])
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """ Wait until the writer thread wrote the queued files """
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self, discard=False):
+        if self._thread is not None:
+            self._discard = discard
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.error is not None and not discard:
+            raise self.error
+
+
 def update_time_stamp(data, input_date_format, output_date_format):
     """
     Update timestamp using input and output data formats reads from raw
@@ -710,23 +1452,29 @@ def update_time_stamp(data, input_date_format, output_date_format):
     """
     logger.debug('Updating timestamp to ElementTree')
     for subject in data.iter('subject'):
-        # New EMR field SPECIMN_TAKEN_TIME is used in place of Collection Date
-        # and Collection Time
-        specimn_taken_time = subject.find('DATE_TIME_STAMP').text
+        update_subject_time_stamp(subject, input_date_format,
+                                  output_date_format)
+
 
-        if specimn_taken_time is not None:
-            # Converting specimen taken time to redcap accepted time format
-            # YYYY-MM-DD
+def update_subject_time_stamp(subject, input_date_format, output_date_format):
+    """ Update the timestamp of one subject """
+    # New EMR field SPECIMN_TAKEN_TIME is used in place of Collection Date
+    # and Collection Time
+    specimn_taken_time = subject.find('DATE_TIME_STAMP').text
 
-            # construct struct_time structure from String
-            # this will accurately pad each part of the time
-            # Rule : generic input/output of date format
-            temptime = time.strptime(specimn_taken_time, input_date_format)
-            # convert struct into a string representation
-            date_time = time.strftime(output_date_format, temptime)
+    if specimn_taken_time is not None:
+        # Converting specimen taken time to redcap accepted time format
+        # YYYY-MM-DD
 
-            # write the dateTime to ElementTree
-            subject.find('timestamp').text = format(date_time)
+        # construct struct_time structure from String
+        # this will accurately pad each part of the time
+        # Rule : generic input/output of date format
+        temptime = time.strptime(specimn_taken_time, input_date_format)
+        # convert struct into a string representation
+        date_time = time.strftime(output_date_format, temptime)
+
+        # write the dateTime to ElementTree
+        subject.find('timestamp').text = format(date_time)
 
 
 def update_redcap_form(data, lookup_data, undefined):
@@ -781,6 +1529,71 @@ def getkey(elem):
     return (study_id, form_name, timestamp)
 
 
+class SubjectSorter(object):
+    """
+    Sorts a stream of raw data subjects like sort_element_tree while holding
+    at most `buffer_rows` of them in memory.
+
+    add() reads the key of a subject with getkey() once. When `buffer_rows`
+    subjects are buffered they are sorted and spilled as a run to a
+    temporary file in `directory`, one JSON line per subject holding its
+    key, its position in the stream and its XML. subjects() merges the runs
+    and the buffered subjects. Subjects with equal keys keep their order, as
+    with sorted(). With `buffer_rows` 0 no run is spilled.
+    """
+    def __init__(self, buffer_rows=0, directory=None):
+        self.buffer_rows = max(int(buffer_rows), 0)
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, subject):
+        self.buffer.append((getkey(subject), self.count, subject))
+        self.count += 1
+        if self.buffer_rows and len(self.buffer) >= self.buffer_rows:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort(key=lambda item: item[:2])
+        run = tempfile.TemporaryFile(dir=self.directory)
+        self.runs.append(run)
+        for key, position, subject in self.buffer:
+            run.write(json.dumps([key, position,
+                etree.tostring(subject, with_tail=False)]) + '\n')
+        run.seek(0)
+        self.buffer = []
+
+    def subjects(self):
+        """ Yield the subjects added so far in sorted order """
+        self.buffer.sort(key=lambda item: item[:2])
+        buffered, self.buffer = self.buffer, []
+        try:
+            if self.runs:
+                logger.debug('Merging {0} sorted runs of {1} subjects'.format(
+                    len(self.runs), self.buffer_rows))
+            # the positions are unique, so the subjects are never compared
+            for _, _, subject in heapq.merge(
+                    buffered, *[self._read_run(run) for run in self.runs]):
+                if not etree.iselement(subject):
+                    subject = etree.fromstring(subject)
+                yield subject
+        finally:
+            self.close()
+
+    @staticmethod
+    def _read_run(run):
+        for line in run:
+            key, position, subject = json.loads(line)
+            yield tuple(key), position, subject
+
+    def close(self):
+        """ Remove the spilled runs """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+
 def update_formdatefield(data, form_events_tree):
     """function to write formDateField to data ElementTree via lookup of
         formName in formEvents ElementTree
@@ -887,6 +1700,87 @@ def update_redcap_field_name_value_and_units(data, lookup_data, undefined):
         undefined)
 
 
+def annotate_subjects(data, components, forms, undefined):
+    """
+    Set the redcapFormName, formImportedFieldName, redcapStatusFieldName,
+    formDateField, formCompletedFieldName, redcapFieldNameValue and
+    redcapFieldNameUnits of every subject in one pass over the data.
+
+    This gives the same result as running update_redcap_form,
+    update_form_imported_field, update_recap_form_status,
+    update_formdatefield, update_formcompletedfieldname and
+    update_redcap_field_name_value_and_units one after the other.
+
+    :param data: ElementTree of the raw data
+    :param components: loinc_code -> {element name: text} of the
+        clinicalComponents in translationTable.xml
+    :param forms: form name -> {element name: text} of the forms in
+        formEvents.xml
+    :param undefined: value set when a lookup fails
+    """
+    annotate = subject_annotator(components, forms, undefined)
+    for subject in data.iter('subject'):
+        annotate(subject)
+
+
+def subject_annotator(components, forms, undefined):
+    """
+    Return a function which sets the fields annotate_subjects() sets on one
+    subject. The values found for each loinc_code and form name are reused
+    for the following subjects.
+    """
+    def lookup(table, key, name, default=undefined):
+        record = table.get(key)
+        if record is None or name not in record:
+            return default
+        return record[name]
+
+    # the values set for each distinct loinc_code and form name
+    by_loinc_code = {}
+    by_form_name = {}
+
+    def annotate(subject):
+        elements = {}
+        for element in reversed(subject):
+            elements[element.tag] = element
+
+        loinc_element = elements.get('loinc_code')
+        loinc_code = None if loinc_element is None \
+            else convert_none_type_object_to_empty_string(loinc_element.text)
+        if loinc_code not in by_loinc_code:
+            by_loinc_code[loinc_code] = [
+                ('redcapFormName',
+                 lookup(components, loinc_code, 'redcapFormName')),
+                ('redcapStatusFieldName',
+                 lookup(components, loinc_code, 'redcapStatusFieldName')),
+                ('redcapFieldNameValue',
+                 lookup(components, loinc_code, 'redcapFieldNameValue')),
+                ('redcapFieldNameUnits',
+                 lookup(components, loinc_code, 'redcapFieldNameUnits',
+                        "redcapFieldNameUnitsUndefined"))]
+        values = by_loinc_code[loinc_code]
+
+        form_name = values[0][1]
+        if form_name not in by_form_name:
+            form_key = convert_none_type_object_to_empty_string(form_name)
+            if form_name == 'undefined' or form_name not in forms:
+                form_date_field = 'undefined'
+            else:
+                form_date_field = forms[form_name].get('formDateField')
+            by_form_name[form_name] = [
+                ('formImportedFieldName',
+                 lookup(forms, form_key, 'formImportedFieldName')),
+                ('formDateField', form_date_field),
+                ('formCompletedFieldName',
+                 lookup(forms, form_key, 'formCompletedFieldName'))]
+
+        for name, value in values + by_form_name[form_name]:
+            element = elements.get(name)
+            if element is not None:
+                element.text = value
+    return annotate
+
+
 def update_data_from_lookup(
         data,
         element_to_set_in_data,
@@ -939,37 +1833,63 @@ def update_event_name(data, lookup_data, undefined):
         in formEvents ElementTree
 
     """
-    # make a dictionary of form_events
-    element_to_find_in_lookup_data = 'form'
-    index_element_in_lookup_data = 'name'
-    list_element_in_lookup_data = 'event'
-    root_of_lookup_data = lookup_data.getroot()
-    lookup_table = defaultdict(list)
+    assigner = EventNameAssigner(lookup_data, undefined)
+    for subject in data.getroot():
+        assigner.assign(subject)
+    return assigner.alert_summary()
 
-    for child in root_of_lookup_data.findall(element_to_find_in_lookup_data):
-        key = child.find(index_element_in_lookup_data).text
-        for grandchild in child.findall(list_element_in_lookup_data):
-            lookup_table[key].append(grandchild.find('name').text)
-
-    # Recurse over study records setting eventName on each record with
-    # a defined form
-    element_to_set_in_data = 'eventName'
-    last_record_group = 'dummy'
-    last_timestamp_group = 'dummy'
-    event_index = 0
-    lookup_table_length = 1
-    old_form_name = 'dummy'
-    distinct_value = Counter()
-
-    # initialize the Maximum events alert
-    max_event_alert = []
-    # initialize the Multiple values for same key alert
-    multiple_values_alert = []
-    # sample alerts
-    #max_event_alert.append('this is sample max event alert')
-    #multiple_values_alert.append('this is sample multiple values alert')
 
-    for subject in data.getroot():
+class EventNameAssigner(object):
+    """
+    Sets the eventName of the subjects of a sorted stream via lookup of
+    their redcapFormName in the formEvents ElementTree.
+
+    The subjects must be passed to assign() in the order of sort_element_tree:
+    the n-th distinct timestamp of a STUDY_ID and form gets the n-th event of
+    the form.
+    """
+    def __init__(self, lookup_data, undefined):
+        self.undefined = undefined
+        # make a dictionary of form_events
+        element_to_find_in_lookup_data = 'form'
+        index_element_in_lookup_data = 'name'
+        list_element_in_lookup_data = 'event'
+        root_of_lookup_data = lookup_data.getroot()
+        self.lookup_table = defaultdict(list)
+
+        for child in root_of_lookup_data.findall(
+                element_to_find_in_lookup_data):
+            key = child.find(index_element_in_lookup_data).text
+            for grandchild in child.findall(list_element_in_lookup_data):
+                self.lookup_table[key].append(grandchild.find('name').text)
+
+        self.last_record_group = 'dummy'
+        self.last_timestamp_group = 'dummy'
+        self.last_study_id = None
+        self.last_form_name = None
+        self.event_index = 0
+        self.old_form_name = 'dummy'
+        # values seen in the current record group; the stream is sorted, so a
+        # repeated value can only be in the group being assigned
+        self.distinct_value = Counter()
+
+        # initialize the Maximum events alert
+        self.max_event_alert = []
+        # initialize the Multiple values for same key alert
+        self.multiple_values_alert = []
+        # sample alerts
+        #max_event_alert.append('this is sample max event alert')
+        #multiple_values_alert.append('this is sample multiple values alert')
+
+    def alert_summary(self):
+        return {
+            'max_event_alert': self.max_event_alert,
+            'multiple_values_alert': self.multiple_values_alert}
+
+    def assign(self, subject):
+        """ Set the eventName of the next subject of the stream """
+        lookup_table = self.lookup_table
+        element_to_set_in_data = 'eventName'
         study_id = subject.findtext("STUDY_ID")
         form_name = subject.findtext("redcapFormName")
         timestamp = subject.findtext("timestamp")
@@ -980,93 +1900,91 @@ def update_event_name(data, lookup_data, undefined):
         # if the form_name 'undefined, go to the next record!
         if form_name == 'undefined':
             # log something as info
-            element_to_set.text = undefined
-        elif timestamp == '':
+            element_to_set.text = self.undefined
+            return
+        if timestamp == '':
             # Log this as bad data we are skipping
             logger.debug(
                 "update_event_name: timestamp is missing.  Skipping form %s for subject %s",
                 form_name,
                 study_id)
+            return
+
+        lookup_table_length = len(lookup_table[form_name])
+        current_record_group = string.join([study_id, form_name], "_")
+        current_timestamp_group = \
+            string.join([study_id, form_name, timestamp], "_")
+        if self.last_record_group != current_record_group:
+            # Check that the event counter form the previous loop did not
+            # exceed the size of the event list.  If it did we should
+            # issue a warning
+
+            if self.old_form_name is not "dummy" and \
+            self.event_index >= len(lookup_table[self.old_form_name]):
+                self.max_event_alert.append("Exceeded event list for record "\
+                    "group with Subject ID.: " + self.last_study_id + " and "\
+                    "Form Name: " + self.last_form_name + ". Event count "\
+                    "of " + str(self.event_index) + " exceeds maximum of " + \
+                    str(len(lookup_table[self.old_form_name])))
+                logger.warn('update_event_name: %s', self.max_event_alert[-1])
+
+            # reset the event counter so we can restart from the top
+            # of the list. We have moved to a new group
+            logger.debug("update_event_name: Move to new record group: %s",
+                         current_record_group)
+            logger.debug("update_event_name: Move to new record group: \
+                    changing last_timestamp_group %s",
+                         current_timestamp_group)
+
+            self.last_record_group = current_record_group
+            self.last_study_id = study_id
+            self.last_form_name = form_name
+            self.last_timestamp_group = current_timestamp_group
+            self.event_index = 0
+            self.distinct_value.clear()
+        if self.last_timestamp_group != current_timestamp_group:
+            # move to the next event
+            logger.debug("update_event_name: Move to next event: " +
+                         current_timestamp_group)
+            self.event_index += 1
+            self.last_timestamp_group = current_timestamp_group
+        # note which form we were on
+        self.old_form_name = form_name
+        # check that we have not exceeded the event count for this form.
+        # If we have we must issue a warning
+        if self.event_index < lookup_table_length:
+            logger.debug("update_event_name: eventName: %s event_index: %s\
+            redcapFieldName: %s current_timestamp_group: %s",
+                         str(lookup_table[form_name][self.event_index]),
+                         str(self.event_index),
+                         redcap_field_name_value,
+                         str(current_timestamp_group))
+            element_to_set.text = lookup_table[form_name][self.event_index]
+
+            # Increment a counter for each distinct value and test if
+            # it is still distinct
+            connector_string = "_"
+            if study_id is None:
+                study_id = 'none'
+            if form_name is None:
+                form_name = 'none'
+            if redcap_field_name_value is None:
+                redcap_field_name_value = 'none'
+            if timestamp is None:
+                timestamp = 'none'
+            if collection_time is None:
+                collection_time = 'none'
+            field_key = connector_string.join(
+                [study_id, form_name, redcap_field_name_value, timestamp, collection_time])
+            # print field_key
+            self.distinct_value[field_key] += 1
+            if self.distinct_value[field_key] > 1:
+                logger.debug("update_event_name: multiple values \
+                    found for field %s", field_key)
         else:
-            lookup_table_length = len(lookup_table[form_name])
-            current_record_group = string.join([study_id, form_name], "_")
-            current_timestamp_group = \
-                string.join([study_id, form_name, timestamp], "_")
-            if last_record_group != current_record_group:
-                # Check that the event counter form the previous loop did not
-                # exceed the size of the event list.  If it did we should
-                # issue a warning
-
-                if old_form_name is not "dummy" and \
-                event_index >= len(lookup_table[old_form_name]):
-                    max_event_alert.append("Exceeded event list for record "\
-                        "group with Subject ID.: " + last_study_id + " and "\
-                        "Form Name: " + last_form_name + ". Event count "\
-                        "of " + str(event_index) + " exceeds maximum of " + \
-                        str(len(lookup_table[old_form_name])))
-                    logger.warn('update_event_name: %s', max_event_alert)
-
-                # reset the event counter so we can restart from the top
-                # of the list. We have moved to a new group
-                logger.debug("update_event_name: Move to new record group: %s",
-                             current_record_group)
-                logger.debug("update_event_name: Move to new record group: \
-                        changing last_timestamp_group %s",
-                             current_timestamp_group)
-
-                last_record_group = current_record_group
-                last_study_id = study_id
-                last_form_name = form_name
-                last_timestamp_group = current_timestamp_group
-                event_index = 0
-            if last_timestamp_group != current_timestamp_group:
-                # move to the next event
-                logger.debug("update_event_name: Move to next event: " +
-                             current_timestamp_group)
-                event_index += 1
-                last_timestamp_group = current_timestamp_group
-            else:
-                pass
-            # note which form we were on
-            old_form_name = form_name
-            # check that we have not exceeded the event count for this form.
-            # If we have we must issue a warning
-            if event_index < lookup_table_length:
-                logger.debug("update_event_name: eventName: %s event_index: %s\
-                redcapFieldName: %s current_timestamp_group: %s",
-                             str(lookup_table[form_name][event_index]),
-                             str(event_index),
-                             redcap_field_name_value,
-                             str(current_timestamp_group))
-                element_to_set.text = lookup_table[form_name][event_index]
-
-                # Increment a counter for each distinct value and test if
-                # it is still distinct
-                connector_string = "_"
-                if study_id is None:
-                    study_id = 'none'
-                if form_name is None:
-                    form_name = 'none'
-                if redcap_field_name_value is None:
-                    redcap_field_name_value = 'none'
-                if timestamp is None:
-                    timestamp = 'none'
-                if collection_time is None:
-                    collection_time = 'none'
-                field_key = connector_string.join(
-                    [study_id, form_name, redcap_field_name_value, timestamp, collection_time])
-                # print field_key
-                distinct_value[field_key] += 1
-                if distinct_value[field_key] > 1:
-                    logger.debug("update_event_name: multiple values \
-                        found for field %s", field_key)
-            else:
-                element_to_set.text = undefined
-                logger.debug("update_event_name: lookup_table_length exceeded.\
-                  event_index: %s", str(event_index))
-    return {
-        'max_event_alert': max_event_alert,
-        'multiple_values_alert': multiple_values_alert}
+            element_to_set.text = self.undefined
+            logger.debug("update_event_name: lookup_table_length exceeded.\
+              event_index: %s", str(self.event_index))
 
 
 # @TODO: remove settings from signature
@@ -1080,9 +1998,26 @@ def research_id_to_redcap_id_converter(
      2. replace the element tree study_id with the new redcap_id's
      for each bad id, log it as warn
     """
+    redcap_dict = fetch_research_id_to_redcap_id(
+        redcap_settings, email_settings, research_id_to_redcap_id, dry_run,
+        configuration_directory)
+    # list of bad research ids that are not present in redcap list
+    bad_ids = defaultdict(int)
+
+    for subject in data.iter('subject'):
+        if not map_research_id(subject, redcap_dict, bad_ids):
+            data.getroot().remove(subject)
+
+    log_bad_research_ids(bad_ids)
 
-    # read each of the study_id's from the data etree
-    study_id_recap_id_dict = {}
+
+def fetch_research_id_to_redcap_id(
+        redcap_settings, email_settings, research_id_to_redcap_id, dry_run,
+        configuration_directory):
+    """
+    Return the dictionary research_id -> redcap_id of the records in
+    REDCap, read with the field names of the mapping xml
+    """
 
     ''' Configuration data from the mapping xml
 
@@ -1136,36 +2071,41 @@ def research_id_to_redcap_id_converter(
             redcap_id_field_name])
     items = ET.fromstring(response)
     redcap_dict = {}
-    # list of bad research ids that are not present in redcap list
-    bad_ids = defaultdict(int)
 
     for item in items.findall('./item'):
         research_id = item.findtext(research_id_field_name)
         redcap_id = item.findtext(redcap_id_field_name)
         if research_id is not None and research_id != '':
             redcap_dict[research_id] = redcap_id
+    return redcap_dict
 
-    for subject in data.iter('subject'):
-        study_id = subject.findtext('STUDY_ID')
-        # tag = subject.find('STUDY_ID')
-        # if the study id is not null populate the dictionary
-        if study_id is not None and study_id != '' and study_id in redcap_dict:
-            # if the study_id in redcap_dict of redcap id's update the study_id
-            # with redcap id
-            subject.find('STUDY_ID').text = redcap_dict[study_id]
-        elif study_id is not None and study_id != '' and study_id not in redcap_dict:
-            # add the bad research id to list of bad ids
-            bad_ids[study_id] += 1
-            data.getroot().remove(subject)
-        else:
-            logger.error(
-                'Error: research id to redcap id: study_id is invalid')
 
+def map_research_id(subject, redcap_dict, bad_ids):
+    """
+    Replace the research id in the STUDY_ID of a subject with its redcap id.
+    Return False if the research id is not in `redcap_dict`; it is then
+    counted in `bad_ids` and the subject must be dropped.
+    """
+    study_id = subject.findtext('STUDY_ID')
+    # if the study id is not null populate the dictionary
+    if study_id is not None and study_id != '' and study_id in redcap_dict:
+        # if the study_id in redcap_dict of redcap id's update the study_id
+        # with redcap id
+        subject.find('STUDY_ID').text = redcap_dict[study_id]
+    elif study_id is not None and study_id != '' and study_id not in redcap_dict:
+        # add the bad research id to list of bad ids
+        bad_ids[study_id] += 1
+        return False
+    else:
+        logger.error(
+            'Error: research id to redcap id: study_id is invalid')
+    return True
+
+
+def log_bad_research_ids(bad_ids):
     for bad_id in bad_ids.iteritems():
         logger.warn('Bad research id %s found %s times', bad_id[0], bad_id[1])
 
-    pass
-
 
 def configure_logging(data_folder, verbose=False):
     """Configures the Logger"""
@@ -1249,6 +2189,8 @@ def create_summary_report(report_parameters, report_data, alert_summary, \
     updateReportAlerts(root, alert_summary)
     updateReportErrors(root, report_data['errors'])
     updateSummaryOfSpecimenTakenTimes(root, collection_date_summary_dict)
+    if 'stages' in report_data:
+        updateReportStages(root, report_data['stages'])
     tree = etree.ElementTree(root)
     write_element_tree_to_file(tree,report_parameters.get('report_file_path'))
     return tree
@@ -1276,6 +2218,20 @@ def updateReportSummary(root, report_data):
         name_element.text = k
         count_element = etree.SubElement(form, "form_count")
         count_element.text = str(form_data.get(k))
+    if 'unchanged_events' in report_data:
+        unchanged = etree.SubElement(summary, "unchangedEventCount")
+        unchanged.text = str(report_data['unchanged_events'])
+
+
+def updateReportStages(root, stages):
+    stagesRoot = etree.SubElement(root, "stages")
+    for stage in stages:
+        stageElement = etree.SubElement(stagesRoot, "stage")
+        for name in ['name', 'wall_time', 'cpu_time', 'peak_rss_kb',
+                     'rss_growth_kb', 'rows_in', 'rows_out']:
+            element = etree.SubElement(stageElement, name)
+            if stage.get(name) is not None:
+                element.text = str(stage[name])
 
 
 def updateReportAlerts(root, alert_summary):
@@ -1408,11 +2364,7 @@ def create_empty_events_for_one_subject(
             child.insert(
                 child.index(
                     child.find('status')) + 1,
-                etree.XML(
-                    etree.tostring(
-                        all_fields,
-                        method='html',
-                        pretty_print=True)))
+                copy.deepcopy(all_fields))
         etree.strip_tags(form, 'allfields')
 
         root.append(form)
@@ -1420,11 +2372,14 @@ def create_empty_events_for_one_subject(
     return tree
 
 
-def create_empty_event_tree_for_study(raw_data_tree, all_form_events_tree):
+def create_empty_event_tree_for_study(raw_data_tree, all_form_events_tree,
+                                      sparse=False):
     """
     This function uses raw_data_tree and all_form_events_tree and creates a person_form_event_tree for study
     :param raw_data_tree: This parameter holds raw data tree
     :param all_form_events_tree: This parameter holds all form events tree
+    :param sparse: when True the forms are created without their events;
+        an event is only added when data is copied to it
     """
     logger.info('Creating all form events template for all subjects')
     from lxml import etree
@@ -1444,77 +2399,153 @@ def create_empty_event_tree_for_study(raw_data_tree, all_form_events_tree):
     if not subjects_list:
         raise Exception('There is no subjects in the raw data')
 
+    all_form_events_root = person_template(all_form_events_root, sparse)
     for subject_id in subjects_list:
-        person = etree.Element("person")
-        study_id = etree.SubElement(person, "study_id")
-        study_id.text = subject_id
-        person.insert(
-            person.index(
-                person.find('study_id')) + 1,
-            etree.XML(
-                etree.tostring(
-                    all_form_events_root,
-                    method='html',
-                    pretty_print=True)))
-        root.append(person)
+        root.append(create_person(subject_id, all_form_events_root))
 
     tree = etree.ElementTree(root)
     return tree
 
 
-def setStat(
-        event,
-        translation_table_dict,
-        translation_table_status_field_text_list):
+def person_template(all_form_events_root, sparse=False):
     """
-    Ruchi Vivek Desai, May 13 2014
-    to assist the updateStatusFieldValueInPersonFormEventTree function
+    Return the all_form_events element every person is created from; when
+    `sparse` is set its forms are stripped of their events
+    """
+    if sparse:
+        all_form_events_root = copy.deepcopy(all_form_events_root)
+        for form in all_form_events_root.findall('form'):
+            for event in form.findall('event'):
+                form.remove(event)
+    return all_form_events_root
+
+
+def create_person(subject_id, all_form_events_root):
+    """ Return a person element holding a copy of the all form events """
+    person = etree.Element("person")
+    study_id = etree.SubElement(person, "study_id")
+    study_id.text = subject_id
+    person.insert(
+        person.index(
+            person.find('study_id')) + 1,
+        copy.deepcopy(all_form_events_root))
+    return person
+
+
+def event_has_values(event):
+    """
+    Return True if any value of the event holds data. Values which are
+    missing, blank or the text 'None' do not count.
+    """
+    for value in event.iter('value'):
+        if value.text is not None and value.text != 'None' and value.text:
+            return True
+    return False
+
+
+def set_status_fields(event, translation_table_dict, status_field_names):
+    """
+    Set the status field of every empty field of the event to the status
+    value of that field in the translation table.
+
+    The fields of the event are read once into a name index, so this runs
+    in time linear in the number of fields.
+
+    :param event: an event element of the person form event tree
+    :param translation_table_dict: field name -> [redcapStatusFieldName,
+        redcapStatusFieldValue] as built by build_status_field_lookup
+    :param status_field_names: set of the redcapStatusFieldName values
     """
-    # iterates over all fields under event (passed as parameter) in source file
-    for field in event.iter('field'):  # loop3
+    value_elements = {}
+    statuses = []
+    for field in event.iter('field'):
         value = field.find('value')
-        if (value is not None and value.text is not None):
-            #logging.info("text is missing")
+        value_elements.setdefault(field.findtext('name', ""), value)
+        if value is not None and value.text is not None:
             continue
 
         name = field.find('name')
-        if (name is None):
-            #logging.info("tag is missing")
+        if name is None:
             continue
 
-        is_status_field = name.text in translation_table_status_field_text_list
-        if (is_status_field):
-            #logging.info("This tag needs to be skipped as it might stand for status")
+        # status fields are not given a status themselves
+        if name.text in status_field_names:
             continue
 
-        doesnt_have_status_field = name.text not in translation_table_dict or translation_table_dict[
-            name.text][0] == ""
-        if (doesnt_have_status_field):
-            #logging.info( "This tag needs to be skipped as it might stand for form name")
-            continue  # name could have been a redcap form name like cbc_lbdtc
+        # name could have been a redcap form name like cbc_lbdtc
+        status = translation_table_dict.get(name.text)
+        if status is None or status[0] == "":
+            continue
+        statuses.append(status)
 
-        set_status_for(name, event, translation_table_dict)
+    for status_field_name, status_field_value in statuses:
+        if status_field_name in value_elements:
+            value_elements[status_field_name].text = status_field_value
 
 
-def set_status_for(field_name, event, translation_table_dict):
+def build_status_field_lookup(translational_table_tree):
     """
-    Ruchi
+    Build the lookups used to set status fields from the translation table
+
+    :param translational_table_tree: the translation table ElementTree
+    :return: tuple holding a dictionary that maps every redcap field to its
+        [redcapStatusFieldName, redcapStatusFieldValue] pair and the list of
+        redcapStatusFieldName values
     """
-    for field in event.iter('field'):
-        name = field.findtext('name', "")
-        if (name == translation_table_dict[field_name.text][0]):
-            value = field.find('value')
-            value.text = translation_table_dict[field_name.text][1]
-            return
+    # Get root of translation table
+    translation_table_root = translational_table_tree.getroot()
+    if (translation_table_root is None):
+        # Log error: Translation Table Tree is empty
+        raise Exception("Translation Table Tree is empty")
+
+    # This list contains text values of redcapStatusFieldName, to avoid
+    # searching for elements with this text later in setStat function
+    translation_table_status_field_text_list = [
+        x.text for x in translation_table_root.iter('redcapStatusFieldName') if x.text is not None]
+    # Parse translation table and make a dictionary to store the person
+    # form event tree fields along with their respective status field
+    # info
+    translation_table_dict = {}
+    for clinical_component in translation_table_root:
+        if (clinical_component is None):
+            continue
+        redcap_status_field_name = clinical_component.findtext(
+            "redcapStatusFieldName",
+            "")
+        redcap_status_field_value = clinical_component.findtext(
+            "redcapStatusFieldValue",
+            "")
+
+        # For every redcap_field other than redcapStatusFieldName
+        # and redcapStatusFieldValue in this clinical_component add
+        # an entry, {redcap_field.text: [redcapStatusFieldName,
+        # redcapStatusFieldValue]} to translation_table_dict
+        for redcap_field in clinical_component:
+            if (redcap_field is None):
+                continue
+            elif (redcap_field.tag == "redcapFormName" or redcap_field.tag == "redcapStatusFieldName" or redcap_field.tag == "redcapStatusFieldValue"):
+                continue
+            elif (redcap_field.text in translation_table_dict):
+                continue
+            else:
+                translation_table_dict[
+                    redcap_field.text] = [
+                    redcap_status_field_name,
+                    redcap_status_field_value]
+    return translation_table_dict, translation_table_status_field_text_list
 
 
 def updateStatusFieldValueInPersonFormEventTree(
         person_form_event_tree,
-        translational_table_tree):
+        translational_table_tree,
+        status_field_lookup=None):
     """
     Ruchi Vivek Desai, May 13 2014
     This function updates the status field value with either NOT_DONE (value in the translation table)
     or empty string based on certain conditions
+
+    :param status_field_lookup: optional result of build_status_field_lookup
+        which is used instead of reading translational_table_tree
     """
     # Get root of peron form event tree
     person_form_event__tree_root = person_form_event_tree.getroot()
@@ -1523,74 +2554,23 @@ def updateStatusFieldValueInPersonFormEventTree(
         raise Exception('Person Form Event Tree is empty')
 
     else:
-        # Get root of translation table
-        translation_table_root = translational_table_tree.getroot()
-        if (translation_table_root is None):
-            # Log error: Translation Table Tree is empty
-            raise Exception("Translation Table Tree is empty")
-        else:
-            # This list contains text values of redcapStatusFieldName, to avoid
-            # searching for elements with this text later in setStat function
-            translation_table_status_field_text_list = [
-                x.text for x in translation_table_root.iter('redcapStatusFieldName') if x.text is not None]
-            # Parse translation table and make a dictionary to store the person
-            # form event tree fields along with their respective status field
-            # info
-            translation_table_dict = {}
-            for clinical_component in translation_table_root:
-                if (clinical_component is None):
-                    continue
-                else:
-                    redcap_status_field_name = clinical_component.findtext(
-                        "redcapStatusFieldName",
-                        "")
-                    redcap_status_field_value = clinical_component.findtext(
-                        "redcapStatusFieldValue",
-                        "")
-
-                    # For every redcap_field other than redcapStatusFieldName
-                    # and redcapStatusFieldValue in this clinical_component add
-                    # an entry, {redcap_field.text: [redcapStatusFieldName,
-                    # redcapStatusFieldValue]} to translation_table_dict
-                    for redcap_field in clinical_component:
-                        if (redcap_field is None):
-                            continue
-                        elif (redcap_field.tag == "redcapFormName" or redcap_field.tag == "redcapStatusFieldName" or redcap_field.tag == "redcapStatusFieldValue"):
-                            continue
-                        elif (redcap_field.text in translation_table_dict):
-                            continue
-                        else:
-                            translation_table_dict[
-                                redcap_field.text] = [
-                                redcap_status_field_name,
-                                redcap_status_field_value]
-                    # End of for redcap_field in clinical_component:
-            # End of for clinical_component in translation_table_root:
+        if status_field_lookup is None:
+            status_field_lookup = build_status_field_lookup(
+                translational_table_tree)
+        translation_table_dict, translation_table_status_field_text_list = \
+            status_field_lookup
         # At this point we have the dictionary for the translation table ready
 
-        # For every event in person form event tree, get the text of 'value', which is a descendant of event (child of field), and add it to field_values
-        # This checks if the event is completely blank or has some values. We
-        # need to update the status field only if the event has some values
+        status_field_names = set(translation_table_status_field_text_list)
+
+        # We need to update the status field only if the event has some
+        # values
         for event in person_form_event__tree_root.iter('event'):
-            field_values = ""
-            if (event is None):
-                continue
-            else:
-                for value in event.iter('value'):
-                    if(value is None):
-                        continue
-                    elif (str(value.text) == "None"):
-                        field_values += ""
-                    else:
-                        field_values += value.text
-                # End of for value in event.iter('value'):
-                if (field_values == ""):
-                    continue
-                else:
-                    setStat(
-                        event,
-                        translation_table_dict,
-                        translation_table_status_field_text_list)
+            if event_has_values(event):
+                set_status_fields(
+                    event,
+                    translation_table_dict,
+                    status_field_names)
 
         # Write the modified tree to an xml file as output
         # person_form_event_tree.write("op1.xml")
@@ -1599,13 +2579,16 @@ def updateStatusFieldValueInPersonFormEventTree(
 def copy_data_to_person_form_event_tree(
         raw_data_tree,
         person_form_event_tree,
-        form_events_tree):
+        form_events_tree,
+        index=None):
     """
     This function copies data from the raw_data_tree to the person_form_event_tree
 
     :param raw_data_tree: This parameter holds raw data tree
     :param person_form_event_tree: This parameter holds person form event tree
     :param form_events_tree: This parameter holds form events tree
+    :param index: optional PersonFormEventIndex of person_form_event_tree,
+        built here when it is not given
     """
     logger.debug('Copying data to person form event tree')
     raw_data_root = raw_data_tree.getroot()
@@ -1618,156 +2601,306 @@ def copy_data_to_person_form_event_tree(
     if form_event_root is None:
         raise Exception('Form Events tree is empty')
 
+    if index is None:
+        index = PersonFormEventIndex(person_form_event_tree)
+    form_completed_values, form_imported_values = \
+        read_form_field_values(form_events_tree)
     for subject in raw_data_root.iter('subject'):
-        eventName = subject.find("eventName").text
-        if eventName:
-            study_id_object = subject.find("STUDY_ID")
-            formNameObject = subject.find("redcapFormName")
-            fieldNameObject = subject.find("redcapFieldNameValue")
-            fieldValueObject = subject.find("RESULT")
-            dateFieldObject = subject.find("formDateField")
-            dateValueObject = subject.find("timestamp")
-            fieldUnitsNameObject = subject.find("redcapFieldNameUnits")
-            fieldUnitsValueObject = subject.find("REFERENCE_UNIT")
-            formCompletedField = subject.find("formCompletedFieldName")
-
-            if study_id_object is None:
-                raise Exception('Missing required field STUDY_ID')
-            else:
-                subject_id = study_id_object.text
+        copy_subject_to_person_form_event_tree(
+            subject, index, form_completed_values, form_imported_values)
 
-            if formNameObject is None:
-                raise Exception('Missing required field redcapFormName')
-            else:
-                formName = formNameObject.text
-                if formName == 'undefined':
-                    continue
+    tree = etree.ElementTree(person_form_event_tree_root)
+    return tree
 
-            if fieldNameObject is None:
-                raise Exception(
-                    'Missing required field redcapFieldNameValue')
-            else:
-                redcapFieldName = fieldNameObject.text
 
-            if fieldValueObject is None:
-                raise Exception('Missing required field RESULT')
-            else:
-                redcapFieldValue = fieldValueObject.text
+def read_form_field_values(form_events_tree):
+    """
+    Return the dictionaries form name -> formCompletedFieldValue and form
+    name -> formImportedFieldValue of the forms in the form events tree
+    """
+    form_completed_values = {}
+    form_imported_values = {}
+    for form in form_events_tree.getroot().findall('form'):
+        form_name = form.findtext('name')
+        completed = form.find('formCompletedFieldValue')
+        if completed is not None:
+            form_completed_values.setdefault(form_name, completed.text)
+        imported = form.find('formImportedFieldValue')
+        if imported is not None:
+            form_imported_values.setdefault(form_name, imported.text)
+    return form_completed_values, form_imported_values
+
+
+def copy_subject_to_person_form_event_tree(subject, index,
+                                           form_completed_values,
+                                           form_imported_values):
+    """
+    Copy the data of one subject of the raw data to the event of the
+    PersonFormEventIndex `index` named by its eventName
 
-            if dateFieldObject is None:
-                raise Exception('Missing required field formDateField')
-            else:
-                dateField = dateFieldObject.text
+    :param form_completed_values: form name -> formCompletedFieldValue
+    :param form_imported_values: form name -> formImportedFieldValue
+    """
+    eventName = subject.find("eventName").text
+    if eventName:
+        study_id_object = subject.find("STUDY_ID")
+        formNameObject = subject.find("redcapFormName")
+        fieldNameObject = subject.find("redcapFieldNameValue")
+        fieldValueObject = subject.find("RESULT")
+        dateFieldObject = subject.find("formDateField")
+        dateValueObject = subject.find("timestamp")
+        fieldUnitsNameObject = subject.find("redcapFieldNameUnits")
+        fieldUnitsValueObject = subject.find("REFERENCE_UNIT")
+        formCompletedField = subject.find("formCompletedFieldName")
+
+        if study_id_object is None:
+            raise Exception('Missing required field STUDY_ID')
+        else:
+            subject_id = study_id_object.text
 
-            if dateValueObject is None:
-                raise Exception('Missing required field timestamp')
-            else:
-                dateValue = dateValueObject.text
+        if formNameObject is None:
+            raise Exception('Missing required field redcapFormName')
+        else:
+            formName = formNameObject.text
+            if formName == 'undefined':
+                return
 
-            if fieldUnitsNameObject is None:
-                raise Exception(
-                    'Missing required field redcapFieldNameUnits')
-            else:
-                redcapFieldUnitsName = fieldUnitsNameObject.text
+        if fieldNameObject is None:
+            raise Exception(
+                'Missing required field redcapFieldNameValue')
+        else:
+            redcapFieldName = fieldNameObject.text
 
-            if fieldUnitsValueObject is None:
-                raise Exception('Missing required field REFERENCE_UNIT')
-            else:
-                redcapFieldUnitsValue = fieldUnitsValueObject.text
+        if fieldValueObject is None:
+            raise Exception('Missing required field RESULT')
+        else:
+            redcapFieldValue = fieldValueObject.text
 
-            form = person_form_event_tree_root.xpath(
-                "person/study_id[.='" +
-                subject_id +
-                "']/../all_form_events/form/name[.='" +
-                formName +
-                "']")
+        if dateFieldObject is None:
+            raise Exception('Missing required field formDateField')
+        else:
+            dateField = dateFieldObject.text
 
-            if len(form) < 1:
-                raise Exception(
-                    'Form named ' +
-                    formName +
-                    ' Not Found in person form event tree for subject ' +
-                    subject_id)
+        if dateValueObject is None:
+            raise Exception('Missing required field timestamp')
+        else:
+            dateValue = dateValueObject.text
 
-            logger.debug(
-                'Check passed. Copying data with subject_id:' +
-                subject_id +
-                ", formName:" +
+        if fieldUnitsNameObject is None:
+            raise Exception(
+                'Missing required field redcapFieldNameUnits')
+        else:
+            redcapFieldUnitsName = fieldUnitsNameObject.text
+
+        if fieldUnitsValueObject is None:
+            raise Exception('Missing required field REFERENCE_UNIT')
+        else:
+            redcapFieldUnitsValue = fieldUnitsValueObject.text
+
+        if (subject_id, formName) not in index.forms:
+            raise Exception(
+                'Form named ' +
                 formName +
-                ", eventName:" +
-                eventName +
-                ", dateValue:" +
-                dateValue +
-                ", redcapFieldName:" +
-                redcapFieldName +
-                ", redcapFieldUnitsName:" +
-                redcapFieldUnitsName)
-
-            # Copy the first three data fields into the PFE Tree
-            path = "person/study_id[.='" + subject_id + "']/../all_form_events/form/name[.='" + \
-                formName + "']/../event/name[.='" + eventName + "']/../field"
-            fields = person_form_event_tree_root.xpath(path)
-            fieldValues = ""
-            for node in fields:
-                if node.find("name").text == redcapFieldName:
-                    node.find("value").text = redcapFieldValue
-                    fieldValues = fieldValues + \
-                        convert_none_type_object_to_empty_string(redcapFieldValue)
-                    continue
-                if node.find("name").text == dateField:
-                    node.find("value").text = dateValue
-                    fieldValues = fieldValues + \
-                        convert_none_type_object_to_empty_string(dateValue)
-                    continue
-                if node.find("name").text == redcapFieldUnitsName:
-                    node.find("value").text = redcapFieldUnitsValue
-                    fieldValues = fieldValues + \
-                        convert_none_type_object_to_empty_string(redcapFieldUnitsValue)
-                    continue
+                ' Not Found in person form event tree for subject ' +
+                subject_id)
+
+        logger.debug(
+            'Check passed. Copying data with subject_id:' +
+            subject_id +
+            ", formName:" +
+            formName +
+            ", eventName:" +
+            eventName +
+            ", dateValue:" +
+            dateValue +
+            ", redcapFieldName:" +
+            redcapFieldName +
+            ", redcapFieldUnitsName:" +
+            redcapFieldUnitsName)
+
+        # Copy the first three data fields into the PFE Tree
+        fields = index.event_fields(subject_id, formName, eventName)
+        fieldValues = ""
+        copied = set()
+        for name, text in [(redcapFieldName, redcapFieldValue),
+                           (dateField, dateValue),
+                           (redcapFieldUnitsName, redcapFieldUnitsValue)]:
+            if name in copied or name not in fields:
+                continue
+            copied.add(name)
+            fields[name].text = text
+            fieldValues = fieldValues + \
+                convert_none_type_object_to_empty_string(text)
+
+        # If we had values in any of the first three fields, copy the
+        # form_completed and imported fields
+        if fieldValues:
+            completed_value = fields.get(formCompletedField.text)
+            if completed_value is None or \
+                    formName not in form_completed_values:
+                raise Exception(
+                    'formCompletedField not set properly in the person form event tree')
+            completed_value.text = form_completed_values[formName]
 
-            # If we had values in any of the first three fields, copy the
-            # form_completed and imported fields
-            if fieldValues:
-                completedFieldValue = person_form_event_tree_root.xpath(
-                    "person/study_id[.='" +
-                    subject_id +
-                    "']/../all_form_events/form/name[.='" +
-                    formName +
-                    "']/../event/name[.='" +
-                    eventName +
-                    "']/../field/name[.='" +
-                    formCompletedField.text +
-                    "']/../value")
-                completedFieldValue[0].text = form_event_root.xpath(
-                    "form/name[.='" + formName + "']/../formCompletedFieldValue")[0].text
-
-                form_imported_field_name = subject.findtext("formImportedFieldName", default="")
-                imported_field_value = person_form_event_tree_root.xpath(
-                    "person/study_id[.='{subject_id}']/../"
-                    "all_form_events/form/name[.='{form_name}']/../event/"
-                    "name[.='{event_name}']/../field/"
-                    "name[.='{form_imported_field_name}']/../value".format(
-                        subject_id=subject_id,
-                        form_name=formName,
-                        event_name=eventName,
-                        form_imported_field_name=form_imported_field_name))
-
-                if imported_field_value:
-                    try:
-                        imported_field_value[0].text = form_event_root.xpath(
-                            "form/name[.='" + formName + "']/../formImportedFieldValue")[0].text
-                        assert imported_field_value[0].text
-                    except (IndexError, AssertionError):
-                        raise Exception('formImportedField not set properly in the person form event tree')
-
-                if not completedFieldValue[0].text:
-                    raise Exception(
-                        'formCompletedField not set properly in the person form event tree')
+            form_imported_field_name = subject.findtext("formImportedFieldName", default="")
+            imported_value = fields.get(form_imported_field_name)
 
-    tree = etree.ElementTree(person_form_event_tree_root)
+            if imported_value is not None:
+                imported_value.text = form_imported_values.get(formName)
+                if not imported_value.text:
+                    raise Exception('formImportedField not set properly in the person form event tree')
+
+            if not completed_value.text:
+                raise Exception(
+                    'formCompletedField not set properly in the person form event tree')
+
+
+def build_person_form_event_tree_from_stream(subjects, all_form_events_tree,
+                                             form_events_tree, sparse=False):
+    """
+    Copy a stream of raw data subjects to a new person form event tree. The
+    person of a STUDY_ID is created when the first of its subjects arrives,
+    so the persons are in the order of the stream; the subjects are not
+    kept.
+
+    :param subjects: iterable of subjects with their eventName set
+    :param all_form_events_tree: all form events tree every person is
+        created from
+    :param form_events_tree: This parameter holds form events tree
+    :param sparse: when True the forms are created without their events;
+        an event is only added when data is copied to it
+    """
+    logger.info('Copying the subjects to the person form event tree')
+    root = etree.Element("person_form_event")
+    tree = etree.ElementTree(root)
+    all_form_events_root = person_template(all_form_events_tree.getroot(),
+                                           sparse)
+    if sparse:
+        # events are added from the template when data is copied to them
+        index = PersonFormEventIndex(tree, all_form_events_tree)
+    else:
+        index = PersonFormEventIndex(tree)
+    form_completed_values, form_imported_values = \
+        read_form_field_values(form_events_tree)
+    persons = set()
+    for subject in subjects:
+        study_id = subject.findtext('STUDY_ID')
+        if study_id not in persons:
+            persons.add(study_id)
+            person = create_person(study_id, all_form_events_root)
+            root.append(person)
+            index.add_person(person)
+        copy_subject_to_person_form_event_tree(
+            subject, index, form_completed_values, form_imported_values)
+
+    if not persons:
+        raise Exception('There is no subjects in the raw data')
     return tree
 
 
+# state of a build_person_form_event_tree_in_parallel() call which the worker
+# processes inherit when the pool forks them
+_partition_context = {}
+
+
+def subject_partition(study_id, partitions):
+    """
+    Return the partition of a STUDY_ID, which is the same in every process
+    """
+    if isinstance(study_id, unicode):
+        study_id = study_id.encode('utf-8')
+    return (zlib.crc32(study_id) & 0xffffffff) % partitions
+
+
+def _build_partition(partition):
+    """
+    Build the person form event tree with data of the subjects in a
+    partition and return it serialized, or None if the partition is empty.
+    Runs in a worker process of build_person_form_event_tree_in_parallel().
+    """
+    context = _partition_context
+    root = etree.Element(context['raw_data_root_tag'])
+    for subject in context['raw_data'].getroot().findall('subject'):
+        if subject_partition(subject.findtext('STUDY_ID'),
+                             context['partitions']) == partition:
+            root.append(subject)
+    if not len(root):
+        return None
+
+    raw_data = etree.ElementTree(root)
+    person_form_event_tree = create_empty_event_tree_for_study(
+        raw_data, context['all_form_events_tree'], context['sparse'])
+    if context['sparse']:
+        index = PersonFormEventIndex(person_form_event_tree,
+                                     context['all_form_events_tree'])
+    else:
+        index = None
+    person_form_event_tree = copy_data_to_person_form_event_tree(
+        raw_data, person_form_event_tree, context['form_events_tree'], index)
+    updateStatusFieldValueInPersonFormEventTree(
+        person_form_event_tree, translational_table_tree,
+        context['status_field_lookup'])
+    return etree.tostring(person_form_event_tree.getroot())
+
+
+def build_person_form_event_tree_in_parallel(raw_data_tree,
+                                             all_form_events_tree,
+                                             form_events_tree,
+                                             status_field_lookup,
+                                             sparse=False, workers=2):
+    """
+    Build the person form event tree with data in a pool of `workers`
+    processes, each one handling the subjects of one partition of the
+    STUDY_IDs. The result is the tree that create_empty_event_tree_for_study,
+    copy_data_to_person_form_event_tree and
+    updateStatusFieldValueInPersonFormEventTree build in one process.
+
+    :param status_field_lookup: result of build_status_field_lookup
+    :param sparse: see create_empty_event_tree_for_study
+    """
+    logger.info('Building the person form event tree in {0} processes'
+                .format(workers))
+    raw_data_root = raw_data_tree.getroot()
+    if raw_data_root is None:
+        raise Exception('Raw data tree is empty')
+
+    # the persons are merged in the order in which
+    # create_empty_event_tree_for_study adds them
+    subjects_list = set()
+    for subject in raw_data_root.iter('subject'):
+        subjects_list.add(subject.find('STUDY_ID').text)
+    if not subjects_list:
+        raise Exception('There is no subjects in the raw data')
+
+    _partition_context.update({
+        'raw_data': raw_data_tree,
+        'raw_data_root_tag': raw_data_root.tag,
+        'all_form_events_tree': all_form_events_tree,
+        'form_events_tree': form_events_tree,
+        'status_field_lookup': status_field_lookup,
+        'sparse': sparse,
+        'partitions': workers})
+    pool = multiprocessing.Pool(workers)
+    try:
+        fragments = pool.map(_build_partition, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+        _partition_context.clear()
+
+    persons = {}
+    for fragment in fragments:
+        if fragment is None:
+            continue
+        for person in etree.fromstring(fragment).findall('person'):
+            persons[person.findtext('study_id')] = person
+
+    root = etree.Element("person_form_event")
+    for subject_id in subjects_list:
+        root.append(persons[subject_id])
+    return etree.ElementTree(root)
+
+
 def convert_none_type_object_to_empty_string(my_object):
     """
     replace noneType objects with an empty string. Else return the object.
@@ -1775,38 +2908,129 @@ def convert_none_type_object_to_empty_string(my_object):
     return ('' if my_object is None else my_object)
 
 
-def convert_component_id_to_loinc_code(data, component_to_loinc_code_xml_tree):
+def convert_component_id_to_loinc_code(data, component_to_loinc_code_xml_tree,
+                                       unmapped=None):
     """
     This function converts COMPONENT_ID in raw data to loinc_code based on the mapping provided in the xml file
 
     :param data: Raw data xml tree
     :param component_to_loinc_code_xml_tree: COMPONENT_ID to loinc_code mapping xml file tree.
+    :param unmapped: optional Counter which receives the number of subjects
+        for every (source name, value) without a mapping
+
+    """
+    mapping, source_names = compile_component_id_conversion(
+        component_to_loinc_code_xml_tree)
+    if unmapped is None:
+        unmapped = Counter()
+    for subject in data.iter('subject'):
+        convert_subject_component_id(subject, mapping, source_names, unmapped)
+    log_unmapped_components(unmapped)
+    return data
 
+
+def compile_component_id_conversion(component_to_loinc_code_xml_tree):
+    """
+    Return the compile_component_to_loinc_code() mapping of the
+    COMPONENT_ID to loinc_code mapping tree and the names of its source
+    elements
     """
     component2loinc_root = component_to_loinc_code_xml_tree.getroot()
     if component2loinc_root is None:
         raise Exception('component_to_loinc_code_xml is empty')
 
-    for component in component2loinc_root.iter('component'):
-        source_name = component.findtext('source/name')
-        source_value = component.findtext('source/value')
-        target_name = component.findtext('target/name')
-        target_value = component.findtext('target/value')
-        if source_name and source_value and target_name:
-            path = "subject/" + source_name + "[.='" + source_value + "']/.."
-            subjects_to_change = data.xpath(path)
-            if len(subjects_to_change) < 1:
-                logger.debug(
-                    'There are no matching sujects to modify in the Raw Data')
-            for subject in subjects_to_change:
-                new_target_element = etree.Element(target_name)
-                new_target_element.text = target_value
-                source_element = subject.find(source_name)
-                subject.replace(source_element, new_target_element)
-        else:
+    mapping = compile_component_to_loinc_code(
+        read_component_to_loinc_code(component_to_loinc_code_xml_tree))
+    source_names = []
+    for source_name, source_value in mapping:
+        if source_name not in source_names:
+            source_names.append(source_name)
+    return mapping, source_names
+
+
+def convert_subject_component_id(subject, mapping, source_names, unmapped):
+    """
+    Convert the source elements of one subject using the mapping returned by
+    compile_component_id_conversion(), counting the values without a
+    mapping in `unmapped`
+    """
+    # look up every source element before replacing any of them so an
+    # element is converted only once
+    sources = []
+    for source_name in source_names:
+        source_element = subject.find(source_name)
+        if source_element is not None:
+            sources.append(source_element)
+    for source_element in sources:
+        target = mapping.get((source_element.tag, source_element.text))
+        if target is None:
+            unmapped[(source_element.tag, source_element.text)] += 1
+            continue
+        new_target_element = etree.Element(target[0])
+        new_target_element.text = target[1]
+        subject.replace(source_element, new_target_element)
+
+
+def read_component_to_loinc_code(component_to_loinc_code_xml_tree):
+    """
+    Return the (source name, source value, target name, target value) of
+    every component in the mapping file, in the order of the file
+    """
+    mappings = []
+    for component in component_to_loinc_code_xml_tree.getroot().iter(
+            'component'):
+        mappings.append((
+            component.findtext('source/name'),
+            component.findtext('source/value'),
+            component.findtext('target/name'),
+            component.findtext('target/value')))
+    return mappings
+
+
+def compile_component_to_loinc_code(component_to_loinc_code):
+    """
+    Build a dictionary from (source name, source value) of a raw data field
+    to the (target name, target value) it is converted to.
+
+    Applying the mappings one after the other can convert a field more than
+    once when the target of a mapping is the source of a later one; such
+    chains are followed so one lookup gives the final field.
+
+    :param component_to_loinc_code: list of (source name, source value,
+        target name, target value) in the order of the mapping file
+    """
+    positions = {}
+    for position, (source_name, source_value, target_name, target_value) \
+            in enumerate(component_to_loinc_code):
+        if not (source_name and source_value and target_name):
             raise Exception(
                 "Elements source/name and Source/value are not present in the component_to_loinc_code xml")
-    return data
+        positions.setdefault((source_name, source_value), []).append(position)
+
+    mapping = {}
+    for source, found in positions.iteritems():
+        position = found[0]
+        while True:
+            target = component_to_loinc_code[position][2:]
+            later = [next_position
+                     for next_position in positions.get(target, [])
+                     if next_position > position]
+            if not later:
+                break
+            position = later[0]
+        mapping[source] = target
+    return mapping
+
+
+def log_unmapped_components(unmapped):
+    """Log the fields without a loinc_code mapping and their counts"""
+    if not unmapped:
+        return
+    logger.warning(
+        "{0} subjects have no loinc_code mapping: {1}".format(
+            sum(unmapped.values()),
+            ', '.join('{0} {1} ({2})'.format(name, value, count)
+                      for (name, value), count in unmapped.most_common())))
 
 
 def validate_xml_file_and_extract_data(xmlfilename, xsdfilename):
@@ -1844,14 +3068,81 @@ def validate_xml_file_and_extract_data(xmlfilename, xsdfilename):
     return xml
 
 
-def replace_fields_in_raw_xml(data, fields_to_replace_xml):
+def get_config_digest(file_list):
     """
-    replace_fields_in_raw_xml:
-    This function renames all fields which need renaming.Fields which need renaming are read from the xml file.
-    Parameters:
-        data: Raw data xml tree
-        fields_to_replace_xml: Path to xml file which has list of fields which need renaming.
+    Compute one md5 sum over the contents of all the given files, in order.
 
+    :param file_list: paths of the configuration files
+    :return: hex digest string
+    """
+    md5 = hashlib.md5()
+    md5.update(str(CONFIG_LOOKUPS_VERSION))
+    for file_name in file_list:
+        md5.update(file_name)
+        with open(file_name, 'rb') as config_file:
+            for chunk in iter(lambda: config_file.read(2 ** 20), ''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def compile_config_lookups(form_events_file, translation_table_file,
+                           component_to_loinc_code_xml,
+                           component_to_loinc_code_xsd):
+    """
+    Parse and validate the configuration files and compile their lookups.
+
+    :return: ConfigLookups
+    """
+    form_events_tree = parse_form_events(form_events_file)
+    translation_table_tree = parse_translation_table(translation_table_file)
+    component_to_loinc_code_xml_tree = validate_xml_file_and_extract_data(
+        component_to_loinc_code_xml, component_to_loinc_code_xsd)
+    return ConfigLookups(form_events_tree, translation_table_tree,
+                         component_to_loinc_code_xml_tree)
+
+
+def load_config_lookups(cache_file, form_events_file, translation_table_file,
+                        component_to_loinc_code_xml,
+                        component_to_loinc_code_xsd):
+    """
+    Return the compiled configuration lookups, reusing the ones stored in
+    `cache_file` as long as none of the source files changed.
+
+    The cache is keyed by an md5 sum of the contents of the form events,
+    translation table, component-to-loinc mapping and its xsd. When the sum
+    does not match, the files are parsed, validated and compiled again and
+    the cache is rewritten.
+    """
+    digest = get_config_digest([form_events_file, translation_table_file,
+                                component_to_loinc_code_xml,
+                                component_to_loinc_code_xsd])
+    if os.path.exists(cache_file):
+        try:
+            cached = _load(cache_file)
+            if cached['digest'] == digest:
+                logger.info('Using compiled configuration from %s',
+                            cache_file)
+                return ConfigLookups.from_state(cached['lookups'])
+        except Exception:
+            logger.warning('Ignoring unreadable configuration cache %s',
+                           cache_file)
+    logger.info('Configuration changed. Compiling lookups to %s', cache_file)
+    lookups = compile_config_lookups(form_events_file, translation_table_file,
+                                     component_to_loinc_code_xml,
+                                     component_to_loinc_code_xsd)
+    _save({'digest': digest, 'lookups': lookups.get_state()}, cache_file)
+    return lookups
+
+
+def get_config_cache_path(db_path):
+    """The compiled configuration is stored next to the batch database"""
+    return os.path.join(os.path.dirname(db_path), 'config_lookups.obj')
+
+
+def read_fields_to_replace(fields_to_replace_xml):
+    """
+    Return the (source, target) pairs of the fields which need renaming
+    from the xml file at `fields_to_replace_xml`
     """
     file_path = fields_to_replace_xml
     if not os.path.exists(file_path):
@@ -1869,18 +3160,60 @@ def replace_fields_in_raw_xml(data, fields_to_replace_xml):
     if fields_to_replace_xml_tree_root is None:
         raise Exception('replace_fields_in_raw_data.xml is empty')
 
-    for field in fields_to_replace_xml_tree_root.iter('field'):
-        source = field.findtext('source')
-        target = field.findtext('target')
+    return [(field.findtext('source'), field.findtext('target'))
+            for field in fields_to_replace_xml_tree_root.iter('field')]
+
+
+def replace_fields_in_raw_xml(data, fields_to_replace_xml):
+    """
+    replace_fields_in_raw_xml:
+    This function renames all fields which need renaming.Fields which need renaming are read from the xml file.
+    Parameters:
+        data: Raw data xml tree
+        fields_to_replace_xml: Path to xml file which has list of fields which need renaming.
+
+    """
+    return rename_fields(data, compile_field_renames(
+        read_fields_to_replace(fields_to_replace_xml)))
+
+
+def compile_field_renames(fields_to_replace):
+    """
+    Build one dictionary from the original name of a field to its name
+    after all the renames in `fields_to_replace` were applied in order.
+
+    :param fields_to_replace: list of (source, target) field names
+    """
+    renames = {}
+    for source, target in fields_to_replace:
+        # fields already renamed to the source are renamed again
+        for field, renamed in renames.items():
+            if renamed == source:
+                renames[field] = target
+        if source not in renames:
+            renames[source] = target
+    for field, renamed in renames.items():
+        if field == renamed:
+            del renames[field]
+    return renames
+
+
+def rename_fields(data, renames):
+    """Rename the fields of every subject using a compile_field_renames() map"""
+    if renames:
         for subject in data.iter('subject'):
-            source_element = subject.find(source)
-            if source_element is not None:
-                new_target_element = etree.Element(target)
-                new_target_element.text = source_element.text
-                subject.replace(source_element, new_target_element)
+            rename_subject_fields(subject, renames)
     return data
 
 
+def rename_subject_fields(subject, renames):
+    """Rename the fields of one subject in place"""
+    for element in subject:
+        renamed = renames.get(element.tag)
+        if renamed is not None:
+            element.tag = renamed
+
+
 def load_rules(rules, root='./'):
     """
     Load custom post-processing rules.
@@ -1939,40 +3272,50 @@ def verify_and_correct_collection_date(data, input_date_format):
     # number of times specimen taken date is missing
     collection_date_summary_dict = {'total': 0, 'blank': 0}
     for subject in data.iter('subject'):
-        study_id = subject.findtext('STUDY_ID')
-        collection_date_summary_dict['total'] += 1
-        collection_date_element = subject.find('DATE_TIME_STAMP')
-        result_date_element = subject.find('RESULT_DATE')
-        if collection_date_element is not None and \
-        result_date_element is not None:
-            if not collection_date_element.text:
-                # subtract 4 days from result date and assign the value to
-                # date_time_stamp
-                result_date_object = datetime.strptime(
-                    result_date_element.text, input_date_format) - \
-                timedelta(days=4)
-                collection_date_element.text = str(result_date_object)
-                collection_date_summary_dict['blank'] += 1
-        elif collection_date_element is None and \
-        result_date_element is not None:
-            new_collection_date_element = etree.Element('DATE_TIME_STAMP')
+        correct_subject_collection_date(subject, input_date_format,
+                                        collection_date_summary_dict)
+    log_collection_date_summary(collection_date_summary_dict)
+    return data, collection_date_summary_dict
+
+
+def correct_subject_collection_date(subject, input_date_format,
+                                    collection_date_summary_dict):
+    """
+    Set a missing DATE_TIME_STAMP of one subject to 4 days before its
+    RESULT_DATE and count the subject in `collection_date_summary_dict`
+    """
+    collection_date_summary_dict['total'] += 1
+    collection_date_element = subject.find('DATE_TIME_STAMP')
+    result_date_element = subject.find('RESULT_DATE')
+    if collection_date_element is not None and \
+    result_date_element is not None:
+        if not collection_date_element.text:
             # subtract 4 days from result date and assign the value to
             # date_time_stamp
             result_date_object = datetime.strptime(
                 result_date_element.text, input_date_format) - \
             timedelta(days=4)
-            new_collection_date_element.text = str(result_date_object)
-            subject.replace(result_date_element, new_collection_date_element)
+            collection_date_element.text = str(result_date_object)
             collection_date_summary_dict['blank'] += 1
-            continue
-        else:
-            continue
         subject.remove(result_date_element)
+    elif collection_date_element is None and \
+    result_date_element is not None:
+        new_collection_date_element = etree.Element('DATE_TIME_STAMP')
+        # subtract 4 days from result date and assign the value to
+        # date_time_stamp
+        result_date_object = datetime.strptime(
+            result_date_element.text, input_date_format) - \
+        timedelta(days=4)
+        new_collection_date_element.text = str(result_date_object)
+        subject.replace(result_date_element, new_collection_date_element)
+        collection_date_summary_dict['blank'] += 1
+
+
+def log_collection_date_summary(collection_date_summary_dict):
     if collection_date_summary_dict['blank'] > 0:
         logger.info("There were {0} out of {1} blank specimen taken times "\
             "in this run.".format(collection_date_summary_dict['blank'],
                 collection_date_summary_dict['total']))
-    return data, collection_date_summary_dict
 
 
 def get_email_settings(settings):
@@ -1997,35 +3340,293 @@ def get_redcap_settings(settings):
     redcap_settings['redcap_uri'] = settings.redcap_uri
     redcap_settings['token'] = settings.token
     redcap_settings['rate_limiter_value_in_redcap'] = settings.rate_limiter_value_in_redcap
+    redcap_settings['redcap_batch_rows'] = settings.redcap_batch_rows
+    redcap_settings['redcap_batch_bytes'] = settings.redcap_batch_bytes
+    redcap_settings['redcap_upload_workers'] = settings.redcap_upload_workers
+    redcap_settings['diff_mode'] = settings.diff_mode
+    redcap_settings['diff_export_records'] = settings.diff_export_records
     redcap_settings['verify_ssl'] = settings.verify_ssl
     return redcap_settings
 
 
+class ConfigLookups(object):
+    """
+    Lookup tables compiled from formEvents.xml, translationTable.xml and the
+    component-to-loinc mapping.
+
+    Only strings, lists and dictionaries are kept so the object can be stored
+    with pickle; the documents themselves are kept serialized and parsed
+    again on demand.
+    """
+    def __init__(self, form_events_tree, translation_table_tree,
+                 component_to_loinc_code_xml_tree):
+        self.form_events_xml = etree.tostring(form_events_tree)
+        self.translation_table_xml = etree.tostring(translation_table_tree)
+        self.component_to_loinc_code_xml = etree.tostring(
+            component_to_loinc_code_xml_tree)
+
+        # loinc_code -> {element name: text} for every clinicalComponent
+        self.components = {}
+        for component in translation_table_tree.getroot().findall(
+                'clinicalComponent'):
+            record = self.components.setdefault(
+                component.findtext('loinc_code'), {})
+            for child in reversed(component):
+                if child.tag != 'loinc_code':
+                    record[child.tag] = child.text
+
+        # form name -> {element name: text} and form name -> [event names]
+        self.forms = {}
+        self.form_events = {}
+        for form in form_events_tree.getroot().findall('form'):
+            form_name = form.findtext('name')
+            record = self.forms.setdefault(form_name, {})
+            events = self.form_events.setdefault(form_name, [])
+            for child in reversed(form):
+                if child.tag not in ('name', 'event'):
+                    record[child.tag] = child.text
+            for event in form.findall('event'):
+                events.append(event.findtext('name'))
+
+        # form name -> names of the fields of the form
+        all_form_events = create_empty_events_for_one_subject(
+            copy.deepcopy(form_events_tree), translation_table_tree)
+        self.form_fields = {}
+        for form in all_form_events.getroot().iter('form'):
+            event = form.find('event')
+            self.form_fields[form.findtext('name')] = [] if event is None \
+                else [field.findtext('name') for field in event.iter('field')]
+        self.all_form_events_xml = etree.tostring(all_form_events)
+
+        self.status_field_lookup = build_status_field_lookup(
+            translation_table_tree)
+
+        # (source name, source value, target name, target value) in the order
+        # of the mapping file
+        self.component_to_loinc_code = read_component_to_loinc_code(
+            component_to_loinc_code_xml_tree)
+
+    @classmethod
+    def from_state(cls, state):
+        lookups = cls.__new__(cls)
+        lookups.__dict__.update(state)
+        return lookups
+
+    def get_state(self):
+        return dict(self.__dict__)
+
+    def form_events_tree(self):
+        return etree.ElementTree(etree.fromstring(self.form_events_xml))
+
+    def translation_table_tree(self):
+        return etree.ElementTree(etree.fromstring(self.translation_table_xml))
+
+    def component_to_loinc_code_tree(self):
+        return etree.ElementTree(
+            etree.fromstring(self.component_to_loinc_code_xml))
+
+    def all_form_events_tree(self):
+        return etree.ElementTree(etree.fromstring(self.all_form_events_xml))
+
+
+class PersonFormEventIndex(object):
+    """
+    Index of a person form event tree built in one pass over the tree.
+
+    `forms` maps (study_id, form name) to the form element and `events` maps
+    (study_id, form name, event name) to a dictionary from field name to the
+    value element of that field.
+
+    For a sparse tree, pass the all_form_events template; event_fields()
+    then adds a missing event from the template in the order of the
+    template.
+    """
+    def __init__(self, person_form_event_tree, all_form_events_tree=None):
+        self.forms = {}
+        self.events = {}
+        # (study_id, form name) -> template positions and elements of the
+        # events of the form which are in the template, in template order
+        self.form_positions = {}
+        for person in person_form_event_tree.getroot().findall('person'):
+            self.add_person(person)
+
+        # (form name, event name) -> (position, template event)
+        self.template_events = {}
+        if all_form_events_tree is not None:
+            for form in all_form_events_tree.getroot().findall('form'):
+                for position, event in enumerate(form.findall('event')):
+                    self.template_events.setdefault(
+                        (form.findtext('name'), event.findtext('name')),
+                        (position, event))
+
+    def add_person(self, person):
+        """ Index the forms and events of a person added to the tree """
+        study_id = person.findtext('study_id')
+        for form in person.findall('all_form_events/form'):
+            form_name = form.findtext('name')
+            self.forms.setdefault((study_id, form_name), form)
+            for event in form.findall('event'):
+                self._add_event(study_id, form_name, event)
+
+    def _add_event(self, study_id, form_name, event):
+        fields = self.events.setdefault(
+            (study_id, form_name, event.findtext('name')), {})
+        for field in event.findall('field'):
+            fields.setdefault(field.findtext('name'), field.find('value'))
+        return fields
+
+    def event_fields(self, study_id, form_name, event_name):
+        """
+        Return the field name -> value element dictionary of an event,
+        adding the event from the template if the form does not have it
+        """
+        fields = self.events.get((study_id, form_name, event_name))
+        if fields is not None:
+            return fields
+        form = self.forms.get((study_id, form_name))
+        template = self.template_events.get((form_name, event_name))
+        if form is None or template is None:
+            return {}
+
+        position, template_event = template
+        event = copy.deepcopy(template_event)
+        positions, events = self._form_positions(study_id, form_name, form)
+        index = bisect.bisect_right(positions, position)
+        if index < len(events):
+            events[index].addprevious(event)
+        else:
+            form.append(event)
+        positions.insert(index, position)
+        events.insert(index, event)
+        return self._add_event(study_id, form_name, event)
+
+    def _form_positions(self, study_id, form_name, form):
+        """
+        Return the sorted template positions of the events of `form` and the
+        event elements at those positions. Events which are not in the
+        template get position -1 and are left out; a new event is never
+        placed before them.
+        """
+        key = (study_id, form_name)
+        if key not in self.form_positions:
+            positions, events = [], []
+            for existing in form.findall('event'):
+                position = self.template_events.get(
+                    (form_name, existing.findtext('name')), (-1,))[0]
+                if position >= 0:
+                    index = bisect.bisect_right(positions, position)
+                    positions.insert(index, position)
+                    events.insert(index, existing)
+            self.form_positions[key] = (positions, events)
+        return self.form_positions[key]
+
+
 class PersonFormEventsRepository(object):
-    """Wrapper for the person-form-events XML file"""
-    def __init__(self, filename, logger=None):
+    """
+    Wrapper for the person-form-events XML file
+
+    generate_output() saves the statuses of the events it sends or leaves
+    out with store_statuses(), which stores the whole file unless `journal`
+    is set. With `journal` set, store_statuses() appends the new event statuses to
+    `<filename>.journal` instead of rewriting the whole file. fetch()
+    replays the journal onto the file and store() folds it back into the
+    file.
+    """
+    def __init__(self, filename, logger=None, journal=False):
         # simple test to catch obvious errors with a filename supplied
         self._filename = filename
         self._logger = logger
+        self._journal = journal
+        self._journal_filename = filename + '.journal'
+        self._journal_file = None
 
     def delete(self):
-        try:
-            os.remove(self._filename)
-        except OSError:
-            # It is okay that the file we wanted to delete does not exist
-            pass
+        self._close_journal()
+        for filename in [self._filename, self._journal_filename]:
+            try:
+                os.remove(filename)
+            except OSError:
+                # It is okay that the file we wanted to delete does not exist
+                pass
 
     def fetch(self):
-        return etree.parse(self._filename)
+        pfe_tree = etree.parse(self._filename)
+        if os.path.exists(self._journal_filename):
+            self._replay_journal(pfe_tree)
+        return pfe_tree
 
     def store(self, pfe_tree):
         if self._logger:
             self._logger.debug('Writing ElementTree to %s', self._filename)
-        pfe_tree.write(self._filename,
+        # write a new file and rename it so a crash leaves either the old or
+        # the new snapshot; the journal is only dropped after the rename
+        temp_filename = self._filename + '.tmp'
+        pfe_tree.write(temp_filename,
                        encoding="us-ascii",
                        xml_declaration=True,
                        method="xml",
                        pretty_print=True)
+        os.rename(temp_filename, self._filename)
+        if self._journal:
+            self._close_journal()
+            try:
+                os.remove(self._journal_filename)
+            except OSError:
+                pass
+
+    def store_statuses(self, pfe_tree, statuses):
+        """
+        Save new event statuses given as (study_id, form name, event name,
+        status) tuples which are already set in pfe_tree
+        """
+        if not self._journal:
+            self.store(pfe_tree)
+            return
+        if self._journal_file is None:
+            self._journal_file = open(self._journal_filename, 'a')
+        for status in statuses:
+            self._journal_file.write(json.dumps(list(status)) + '\n')
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+
+    def _close_journal(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def _replay_journal(self, pfe_tree):
+        events = {}
+        for person in pfe_tree.getroot().findall('person'):
+            study_id = person.findtext('study_id')
+            for form in person.findall('all_form_events/form'):
+                form_name = form.findtext('name')
+                for event in form.findall('event'):
+                    events[(study_id, form_name, event.findtext('name'))] = \
+                        event
+
+        replayed = 0
+        with open(self._journal_filename) as journal:
+            for line in journal:
+                try:
+                    study_id, form_name, event_name, status = json.loads(line)
+                except ValueError:
+                    # the last record may be cut short by a crash
+                    if self._logger:
+                        self._logger.warning(
+                            'Ignoring a broken record in %s',
+                            self._journal_filename)
+                    continue
+                event = events.get((study_id, form_name, event_name))
+                if event is None:
+                    continue
+                status_element = event.find('status')
+                if status_element is None:
+                    status_element = etree.SubElement(event, 'status')
+                status_element.text = status
+                replayed += 1
+        if self._logger:
+            self._logger.info('Replayed %s event statuses from %s', replayed,
+                              self._journal_filename)
 
 
 if __name__ == "__main__":
@@ -8,8 +8,15 @@ __author__ = "University of Florida CTS-IT Team"
 __copyright__ = "Copyright 2014, University of Florida"
 __license__ = "BSD 2-Clause"
 
+import collections
+import contextlib
+import cProfile
 import datetime
+import gc
+import json
 import os
+import pstats
+import re
 import stat
 import time
 import ast
@@ -20,11 +27,21 @@ import md5
 import hashlib
 import redi
 import utils.redi_email as redi_email
-from utils.redcapClient import redcapClient
+from utils.redcapClient import redcapClient, asyncRedcapClient
 from requests import RequestException
 from lxml import etree
 import logging
+import Queue
 import sys
+import threading
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 proj_root = redi.get_proj_root()
@@ -57,7 +74,7 @@ def create_import_data_json(
 
     import_data_dict['redcap_event_name'] = event_name.text
 
-    event_field_value_list = root.xpath('//event/field/name')
+    event_field_value_list = root.xpath('field/name')
 
     for name in event_field_value_list:
         if name.text is None:
@@ -90,19 +107,631 @@ def get_child_text_safely(etree, ele):
     else:
         return ele.text
 
+def set_event_status(event, value):
+    status = event.find('status')
+    if status is not None:
+        status.text = value
+    else:
+        status_element = etree.Element("status")
+        status_element.text = value
+        event.append(status_element)
+
+
+class RedcapDiff(object):
+    """
+    Holds the values REDCap has for the records and events of the unsent
+    events in `person_tree`. They are exported with one request per
+    `chunk_size` records.
+
+    changes() leaves out the rows, or with `fields_only` the fields, whose
+    values REDCap already holds.
+    """
+
+    def __init__(self, client, person_tree, chunk_size=100,
+                 fields_only=False):
+        self.record_field = client.project.def_field
+        self.fields_only = fields_only
+        self.unchanged_events = 0
+        self.unchanged_fields = 0
+        self.current = {}
+
+        records, events, fields = set(), set(), set()
+        for person in person_tree.getroot().findall('person'):
+            for event in person.findall('all_form_events/form/event'):
+                if event.findtext('status') == 'sent':
+                    continue
+                records.add(person.findtext('study_id'))
+                events.add(event.findtext('name'))
+                fields.update(event.xpath('field/name/text()'))
+
+        records = sorted(records)
+        chunk_size = max(int(chunk_size), 1)
+        for start in range(0, len(records), chunk_size):
+            response = client.get_data_from_redcap(
+                records_to_fetch=records[start:start + chunk_size],
+                events_to_fetch=sorted(events),
+                fields_to_fetch=[self.record_field] + sorted(fields),
+                return_format='json')
+            for row in response:
+                self.current[(row.get(self.record_field),
+                              row.get('redcap_event_name'))] = row
+        logger.info('Exported %s event rows from REDCap for %s records' % (
+            len(self.current), len(records)))
+
+    def changes(self, row):
+        """
+        Return the row to send for `row`, or None if REDCap holds its values
+        """
+        current = self.current.get(
+            (row[self.record_field], row['redcap_event_name']))
+        if current is None:
+            return row
+
+        keys = (self.record_field, 'redcap_event_name')
+        changed = dict((name, value) for name, value in row.iteritems()
+                       if name not in keys and current.get(name) != value)
+        if not changed:
+            self.unchanged_events += 1
+            return None
+        if not self.fields_only:
+            return row
+
+        self.unchanged_fields += len(row) - len(keys) - len(changed)
+        for name in keys:
+            changed[name] = row[name]
+        return changed
+
+
+class PayloadLedger(object):
+    """
+    Hashes of the event payloads REDCap accepted, kept in the RediSentPayload
+    table of the batch database. An event whose payload has the same hash
+    as the last accepted one does not need to be sent again.
+    """
+
+    def __init__(self, db_path):
+        self.db = lite.connect(db_path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS RediSentPayload (
+    rspRecord TEXT NOT NULL,
+    rspForm TEXT NOT NULL,
+    rspEvent TEXT NOT NULL,
+    rspHash TEXT NOT NULL,
+    rspSentTime TEXT NOT NULL,
+    PRIMARY KEY (rspRecord, rspForm, rspEvent)
+)""")
+        self.hashes = dict(
+            ((record, form, event), digest) for record, form, event, digest in
+            self.db.execute("""
+SELECT rspRecord, rspForm, rspEvent, rspHash FROM RediSentPayload"""))
+        self.pending = {}
+        self.unchanged_events = 0
+
+    @staticmethod
+    def digest(row):
+        return hashlib.sha1(json.dumps(row, sort_keys=True)).hexdigest()
+
+    def check(self, event, record, form_name, row):
+        """
+        Return True if the payload `row` of `event` was already accepted;
+        otherwise remember its hash for sent()
+        """
+        key = (record, form_name, event.findtext('name'))
+        digest = self.digest(row)
+        if self.hashes.get(key) == digest:
+            self.unchanged_events += 1
+            return True
+        self.pending[event] = key + (digest,)
+        return False
+
+    def sent(self, events):
+        """ Record the hashes of events REDCap accepted """
+        now = get_db_friendly_date_time()
+        rows = []
+        for event in events:
+            pending = self.pending.pop(event, None)
+            if pending is not None:
+                self.hashes[pending[:3]] = pending[3]
+                rows.append(pending + (now,))
+        with self.db:
+            self.db.executemany("""
+INSERT OR REPLACE INTO RediSentPayload
+    (rspRecord, rspForm, rspEvent, rspHash, rspSentTime)
+VALUES (?, ?, ?, ?, ?)""", rows)
+
+    def invalidate(self, records=None, forms=None):
+        """
+        Forget the hashes of `records`, of `forms`, or with both only of
+        those forms of those records, so their events are sent again
+
+        @return the number of events forgotten
+        """
+        conditions = []
+        parameters = []
+        for column, values in [('rspRecord', records), ('rspForm', forms)]:
+            if values:
+                conditions.append('%s IN (%s)' % (
+                    column, ', '.join('?' * len(values))))
+                parameters.extend(values)
+        if not conditions:
+            raise Exception('Expected records or forms to invalidate')
+        with self.db:
+            cursor = self.db.execute(
+                'DELETE FROM RediSentPayload WHERE ' +
+                ' AND '.join(conditions), parameters)
+        return cursor.rowcount
+
+    def close(self):
+        self.db.close()
+
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by the threads sending requests to REDCap.
+
+    The bucket holds at most `capacity` tokens and gains
+    `requests_per_minute` tokens per minute; acquire() blocks until a token
+    is available and takes it.
+    """
+
+    def __init__(self, requests_per_minute, capacity=1):
+        self.rate = float(requests_per_minute) / 60
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ImportBatch(object):
+    """
+    Collects the rows of unsent events and sends them to REDCap with one
+    import_records call once `max_rows` rows are collected or the JSON
+    payload would grow past `max_bytes` (0 means no byte limit). The events
+    of a batch are marked `sent` only after REDCap accepted the batch.
+    Events left out by skip() are saved with the statuses of the next batch
+    or by flush().
+
+    Requests take a token from `rate_limiter` before they are sent. `lock`
+    guards the person tree, the repository and the report counters. The
+    payloads of accepted batches, and of skipped events REDCap already
+    holds, are recorded in `ledger` if one is given.
+    """
+
+    def __init__(self, client, person_tree, data_repository, report_data,
+                 subject_details, form_details, rate_limiter,
+                 max_rows=1, max_bytes=0, lock=None, ledger=None):
+        self.client = client
+        self.person_tree = person_tree
+        self.data_repository = data_repository
+        self.report_data = report_data
+        self.subject_details = subject_details
+        self.form_details = form_details
+        self.rate_limiter = rate_limiter
+        self.max_rows = max(int(max_rows), 1)
+        self.max_bytes = int(max_bytes)
+        self.lock = lock or threading.Lock()
+        self.ledger = ledger
+        self.requests_sent = 0
+        self.entries = []
+        self.size = 0
+        self.skipped = []
+
+    def add(self, event, row, study_id, form_key, contains_data):
+        # the payload is a JSON list; count the ', ' between the rows and
+        # the enclosing brackets
+        row_size = len(json.dumps(row)) + 2
+        if self.entries and self.max_bytes and \
+                self.size + row_size > self.max_bytes:
+            self.flush()
+        self.entries.append((event, row, study_id, form_key, contains_data))
+        self.size += row_size
+        if len(self.entries) >= self.max_rows:
+            self.flush()
+
+    def skip(self, event, study_id, form_key=None, contains_data=False):
+        """
+        Mark `event` `sent` without sending it because REDCap already holds
+        its values; an event with data is counted like a sent one
+        """
+        with self.lock:
+            set_event_status(event, 'sent')
+            self.skipped.append((event, (
+                study_id, event.getparent().findtext('name'),
+                event.findtext('name'), 'sent')))
+            if contains_data:
+                self.subject_details[study_id][form_key] += 1
+                self.form_details[form_key] += 1
+
+    def flush(self):
+        """ Send the collected rows and return True if REDCap accepted them """
+        if not self.entries:
+            self._store_skipped()
+            return True
+        entries, self.entries, self.size = self.entries, [], 0
+
+        self.rate_limiter.acquire()
+        try:
+            self.client.send_data_to_redcap(
+                [row for _, row, _, _, _ in entries], overwrite=True)
+            error = None
+        except RedcapError as e:
+            error = e
+        return self.complete(entries, error)
+
+    def complete(self, entries, error):
+        """
+        Mark the events of a sent batch `sent` unless REDCap returned `error`
+        """
+        self.requests_sent += 1
+        with self.lock:
+            if error is not None:
+                handle_errors_in_redcap_xml_response(
+                    error.message,
+                    self.report_data)
+                logger.warning('REDCap did not accept a batch of %s rows; '
+                               'the events stay unsent' % len(entries))
+                return False
+
+            skipped, self.skipped = self.skipped, []
+            statuses = [status for _, status in skipped]
+            for event, _, study_id, form_key, contains_data in entries:
+                set_event_status(event, 'sent')
+                statuses.append((study_id, event.getparent().findtext('name'),
+                                 event.findtext('name'), 'sent'))
+                if contains_data:
+                    # if no errors encountered update event counters
+                    self.subject_details[study_id][form_key] += 1
+                    self.form_details[form_key] += 1
+            self._save([event for event, _ in skipped] +
+                       [event for event, _, _, _, _ in entries], statuses)
+        return True
+
+    def _store_skipped(self):
+        with self.lock:
+            if self.skipped:
+                skipped, self.skipped = self.skipped, []
+                self._save([event for event, _ in skipped],
+                           [status for _, status in skipped])
+
+    def _save(self, events, statuses):
+        if self.ledger is not None:
+            # the payload of an event the diff left out is held by REDCap
+            # too, so the ledger leaves it out on the next run
+            self.ledger.sent(events)
+        self.data_repository.store_statuses(self.person_tree, statuses)
+
+
+class ConcurrentImportBatch(ImportBatch):
+    """
+    Keeps up to `workers` import requests in flight through an
+    asyncRedcapClient while the rows are still being added.
+
+    Each record is assigned to one lane when its first row is added. A lane
+    collects rows into batches of `max_rows` rows within `max_bytes` and
+    starts a request as soon as a batch is full. A lane has at most one
+    request in flight, so the rows of a record are sent in order, and holds
+    at most one more full batch, so the rows waiting in memory stay bounded.
+
+    The finished requests are completed in the calling thread by add() and
+    flush(). flush() sends the partly filled batches and waits for all
+    requests.
+    """
+
+    def __init__(self, workers, client, *args, **kwargs):
+        ImportBatch.__init__(self, client, *args, **kwargs)
+        self.workers = workers
+        self.lane_for_record = {}
+        # the rows being collected and their payload size, the full batches
+        # waiting to be sent and whether a request is in flight, per lane
+        self.lanes = [{'entries': [], 'size': 0,
+                       'ready': collections.deque(), 'in_flight': False}
+                      for _ in range(workers)]
+        self.in_flight = 0
+        self.finished = Queue.Queue()
+        self.async_client = None
+        self.accepted = True
+
+    def add(self, event, row, study_id, form_key, contains_data):
+        lane = self.lanes[self.lane_for_record.setdefault(
+            study_id, len(self.lane_for_record) % self.workers)]
+        row_size = len(json.dumps(row)) + 2
+        if lane['entries'] and self.max_bytes and \
+                lane['size'] + row_size > self.max_bytes:
+            self._close_batch(lane)
+        lane['entries'].append((event, row, study_id, form_key,
+                                contains_data))
+        lane['size'] += row_size
+        if len(lane['entries']) >= self.max_rows:
+            self._close_batch(lane)
+
+        self._complete_finished(block=False)
+        while len(lane['ready']) > 1:
+            self._complete_finished(block=True)
+
+    def flush(self):
+        """
+        Send the rows collected so far, wait for all requests and return
+        True if REDCap accepted every batch since the last flush()
+        """
+        for lane in self.lanes:
+            if lane['entries']:
+                self._close_batch(lane)
+        try:
+            while self.in_flight:
+                self._complete_finished(block=True)
+        finally:
+            if self.async_client is not None:
+                self.async_client.close()
+                self.async_client = None
+        self._store_skipped()
+        accepted, self.accepted = self.accepted, True
+        return accepted
+
+    def _close_batch(self, lane):
+        lane['ready'].append(lane['entries'])
+        lane['entries'], lane['size'] = [], 0
+        self._send(lane)
+
+    def _send(self, lane):
+        """ Start the next batch of `lane` unless it has a request in flight """
+        if lane['in_flight'] or not lane['ready']:
+            return
+        if self.async_client is None:
+            self.async_client = asyncRedcapClient(self.client, self.workers)
+        entries = lane['ready'].popleft()
+        self.rate_limiter.acquire()
+        future = self.async_client.import_records(
+            [row for _, row, _, _, _ in entries], overwrite=True)
+        lane['in_flight'] = True
+        self.in_flight += 1
+        future.add_done_callback(
+            lambda future, entries=entries, lane=lane:
+            self.finished.put((future, entries, lane)))
+
+    def _complete_finished(self, block):
+        """
+        Complete the finished requests and start the next batch of their
+        lanes. With `block` wait for one request, otherwise complete the
+        ones which already finished.
+        """
+        while self.in_flight:
+            try:
+                future, entries, lane = self.finished.get(block)
+            except Queue.Empty:
+                return
+            self.in_flight -= 1
+            lane['in_flight'] = False
+            error = future.exception()
+            if error is not None and not isinstance(error, RedcapError):
+                raise error
+            self.accepted = self.complete(entries, error) and self.accepted
+            self._send(lane)
+            if block:
+                return
+
+
 """
 Note: This function communicates with the redcap application.
 Steps:
     - loop for each person/form/event element
-    - generate a csv fragment `using create_eav_output`
-    - send csv fragment to RedCap using `send_eav_data_to_redcap`
+    - build the import row of each unsent event `using create_import_data_json`
+    - with a `ledger`, leave out the events whose payload was already
+      accepted in an earlier run
+    - with `diff_mode` set, leave out the rows or fields REDCap already
+      holds using `RedcapDiff`
+    - send the rows to RedCap in batches of `redcap_batch_rows` rows using
+      `ImportBatch`, or with up to `redcap_upload_workers` requests in
+      flight using `ConcurrentImportBatch`
 
 
 @return the report_data dictionary
 """
 
 
-def generate_output(person_tree, redcap_settings, email_settings, data_repository, skip_blanks=False):
+def get_peak_rss_kb():
+    """
+    Return the peak resident set size of this process in KB, or None on
+    platforms without the resource module
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # OS X reports bytes instead of KB
+        peak //= 1024
+    return peak
+
+
+class StageProfiler(object):
+    """
+    Profiles one stage of a run with cProfile and traces the memory it
+    allocates: with tracemalloc where the module can be imported (Python 3.4
+    or the pytracemalloc backport), otherwise by counting the live objects
+    the garbage collector tracks before and after the stage.
+
+    stop() writes to `directory`, named after the `number` and `name` of the
+    stage:
+        - <number>-<name>.pstats: the profile, for pstats or a viewer
+        - <number>-<name>.txt: the functions sorted by cumulative and by
+          internal time
+        - <number>-<name>.allocations.txt: with tracemalloc, the lines which
+          allocated the most memory that was still held at the end of the
+          stage; otherwise the types whose live objects grew the most, with
+          their shallow size, below the growth of the peak resident set
+          size. The gc count leaves out strings, numbers, the containers
+          holding only those and the nodes lxml keeps outside of Python
+          objects.
+    """
+
+    def __init__(self, directory, number, name, limit=40):
+        self.path = os.path.join(directory, '%02d-%s' % (
+            number, re.sub(r'\W+', '_', name).strip('_')))
+        self.name = name
+        self.limit = limit
+        self.profile = cProfile.Profile()
+        self.snapshot = None
+        self.objects = None
+        self.peak_rss_kb = None
+        self.started_tracing = False
+
+    def start(self):
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.snapshot = tracemalloc.take_snapshot()
+        else:
+            self.objects = self.count_objects()
+            self.peak_rss_kb = get_peak_rss_kb()
+        self.profile.enable()
+
+    @staticmethod
+    def count_objects():
+        """
+        Return the number and the shallow size of the live objects the
+        garbage collector tracks, by type
+        """
+        gc.collect()
+        counts = collections.defaultdict(lambda: [0, 0])
+        for obj in gc.get_objects():
+            count = counts[type(obj)]
+            count[0] += 1
+            count[1] += sys.getsizeof(obj, 0)
+        # tuples of numbers are not tracked, so the counts kept from start()
+        # do not show up in the counts of stop()
+        return dict((kind, tuple(count)) for kind, count in counts.iteritems())
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.path + '.pstats')
+        with open(self.path + '.txt', 'w') as fp:
+            for sort in ('cumulative', 'time'):
+                fp.write("Stage '%s' sorted by %s time\n" % (self.name, sort))
+                stats = pstats.Stats(self.profile, stream=fp)
+                stats.strip_dirs().sort_stats(sort).print_stats(self.limit)
+
+        if self.snapshot is not None:
+            differences = tracemalloc.take_snapshot().compare_to(
+                self.snapshot, 'lineno')
+            with open(self.path + '.allocations.txt', 'w') as fp:
+                fp.write("Stage '%s': top %s allocation sites\n" % (
+                    self.name, self.limit))
+                for difference in differences[:self.limit]:
+                    fp.write('%s\n' % difference)
+            self.snapshot = None
+            if self.started_tracing:
+                tracemalloc.stop()
+        elif self.objects is not None:
+            before, self.objects = self.objects, None
+            growth = []
+            for kind, (count, size) in self.count_objects().iteritems():
+                count_before, size_before = before.get(kind, (0, 0))
+                if count > count_before:
+                    growth.append((count - count_before, size - size_before,
+                                   '%s.%s' % (kind.__module__, kind.__name__)))
+            growth.sort(reverse=True)
+            with open(self.path + '.allocations.txt', 'w') as fp:
+                fp.write("Stage '%s': top %s types by growth of the live "
+                         "objects (gc)\n" % (self.name, self.limit))
+                if self.peak_rss_kb is not None:
+                    fp.write('Peak RSS grew by %s KB\n' % (
+                        get_peak_rss_kb() - self.peak_rss_kb))
+                for count, size, kind in growth[:self.limit]:
+                    fp.write('%s: count=+%s size=%+d B\n' % (kind, count, size))
+
+
+class StageMetrics(object):
+    """
+    Records the wall time, CPU time, peak resident set size and rows in and
+    out of the named stages of a run.
+
+    `stages` is the list of records in the order the stages ended. The CPU
+    time includes the child processes the stage waited for, and
+    `rss_growth_kb` is how much the stage raised the peak of the process.
+    `rows_out` is the rows_out of the last stage which set it, so the next
+    stage can take it as its rows_in without counting the rows again.
+
+    With `profile_dir` set every stage is profiled with a StageProfiler
+    which writes its reports to that folder.
+    """
+
+    def __init__(self, stages=None, profile_dir=None):
+        self.stages = stages or []
+        self.profile_dir = profile_dir
+        self.rows_out = None
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Time the body of the `with` block; set 'rows_out' on the yielded
+        record to count the rows the stage produced
+        """
+        record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = StageProfiler(self.profile_dir, len(self.stages) + 1,
+                                     name)
+            profiler.start()
+        peak_before = get_peak_rss_kb()
+        times_before = os.times()
+        wall_before = time.time()
+        try:
+            yield record
+        except:
+            # the profile of a stage which failed is written too
+            if profiler is not None:
+                profiler.stop()
+            raise
+        wall_time = time.time() - wall_before
+        times_after = os.times()
+        peak_after = get_peak_rss_kb()
+        if profiler is not None:
+            profiler.stop()
+
+        record['wall_time'] = round(wall_time, 3)
+        record['cpu_time'] = round(sum(times_after[:4]) -
+                                   sum(times_before[:4]), 3)
+        record['peak_rss_kb'] = peak_after
+        if peak_after is None:
+            record['rss_growth_kb'] = None
+        else:
+            record['rss_growth_kb'] = peak_after - peak_before
+        if record['rows_out'] is not None:
+            self.rows_out = record['rows_out']
+        self.stages.append(record)
+        logger.info("Stage '%s': %.3fs wall, %.3fs CPU, peak RSS %s KB "
+                    "(+%s KB), rows %s -> %s" % (
+                        name, record['wall_time'], record['cpu_time'],
+                        record['peak_rss_kb'], record['rss_growth_kb'],
+                        record['rows_in'], record['rows_out']))
+
+    def write(self, path):
+        """ Write the stages to a JSON file """
+        with open(path, 'w') as fp:
+            json.dump({'stages': self.stages}, fp, indent=2, sort_keys=True)
+
+    @classmethod
+    def read(cls, path, profile_dir=None):
+        """ Return the StageMetrics of a file written by write() """
+        with open(path) as fp:
+            return cls(json.load(fp)['stages'], profile_dir)
+
+
+def generate_output(person_tree, redcap_settings, email_settings, data_repository, skip_blanks=False, ledger=None, metrics=None):
     # redi.configure_logger(system_log_file_full_path)
 
     # the global dictionary to be returned
@@ -126,129 +755,151 @@ def generate_output(person_tree, redcap_settings, email_settings, data_repositor
     # count how many `person` elements are parsed
     person_count = 0
 
+    if metrics is None:
+        metrics = StageMetrics()
+
     root = person_tree.getroot()
     persons = root.xpath('//person')
 
     try:
         # Communication with redcap
-        redcapClientObject = redcapClient(redcap_settings['redcap_uri'],
-                                          redcap_settings['token'],
-                                          redcap_settings['verify_ssl'])
+        with metrics.stage('connect to REDCap'):
+            redcapClientObject = redcapClient(redcap_settings['redcap_uri'],
+                                              redcap_settings['token'],
+                                              redcap_settings['verify_ssl'])
     except RequestException:
         redi_email.send_email_redcap_connection_error(email_settings)
         quit()
 
-    rate_limiter_value_in_redcap = float(redcap_settings['rate_limiter_value_in_redcap'])
-
-
-    ideal_time_per_request = 60 / float(rate_limiter_value_in_redcap)
-    time_stamp_after_request = 0
-
-    # main loop for each person
-    for person in persons:
-        time_begin = datetime.datetime.now()
-        person_count += 1
-        study_id = (person.xpath('study_id') or [None])[0]
-
-        if study_id is None:
-            raise Exception('Expected a valid value for study_id')
-
-        # count how many csv fragments are created per person
-        event_count = 0
-        logger.info('Start sending data for study_id: %s' % study_id.text)
-
-        forms = person.xpath('./all_form_events/form')
-
-        # loop through the forms of one person
-        for form in forms:
-            form_name = form.xpath('name')[0].text
-            form_key = 'Total_' + form_name + '_Forms'
-            study_id_key = study_id.text
-
-            # init dictionary for a new person in (study_id)
-            if study_id_key not in subject_details:
-                subject_details[study_id_key] = {}
-
-            if not form_key in subject_details[study_id_key]:
-                subject_details[study_id_key][form_key] = 0
-
-            if form_key not in form_details:
-                form_details[form_key] = 0
-
-            logger.debug(
-                'parsing study_id ' +
-                study_id.text +
-                ' form: ' +
-                form_name)
+    rate_limiter = TokenBucket(
+        redcap_settings['rate_limiter_value_in_redcap'])
+    batch_args = (redcapClientObject, person_tree, data_repository,
+                  report_data, subject_details, form_details, rate_limiter,
+                  redcap_settings.get('redcap_batch_rows', 1),
+                  redcap_settings.get('redcap_batch_bytes', 0))
+    diff_mode = redcap_settings.get('diff_mode', 'off')
+    if diff_mode in ('events', 'fields'):
+        diff = RedcapDiff(redcapClientObject, person_tree,
+                          redcap_settings.get('diff_export_records', 100),
+                          diff_mode == 'fields')
+    else:
+        diff = None
 
-            # loop through the events of one form
-            for event in form.xpath('event'):
-                event_status = event.findtext('status')
-                if event_status == 'sent':
-                    continue
-                event_count += 1
-
-                try:
-                    import_dict = {
-                        redcapClientObject.project.def_field: study_id.text}
-                    import_dict = create_import_data_json(
-                        import_dict,
-                        event)
-                    json_data_dict = import_dict['json_data']
-                    contains_data = import_dict['contains_data']
-
-                    # If we're skipping blanks and this event is blank, we
-                    # assume all following events are blank; therefore, break
-                    # out of this for-loop and move on to the next form.
-                    if skip_blanks and not contains_data:
-                        break
-
-                    time_lapse_since_last_request = time.time(
-                    ) - time_stamp_after_request
-                    sleepTime = max(
-                        ideal_time_per_request -
-                        time_lapse_since_last_request,
-                        0)
-                    # print 'Sleep for: %s seconds' % sleepTime
-                    time.sleep(sleepTime)
-
-                    if (0 == event_count % 50):
-                        logger.info('Requests sent: %s' % (event_count))
-
-                    # to speedup testing uncomment the following line
-                    # if (0 == event_count % 2) : continue
+    workers = int(redcap_settings.get('redcap_upload_workers', 1))
+    if workers > 1:
+        batch = ConcurrentImportBatch(workers, *batch_args, ledger=ledger)
+    else:
+        batch = ImportBatch(*batch_args, ledger=ledger)
+
+    sent_before = len(root.xpath("//event/status[.='sent']"))
+    with metrics.stage('send to REDCap', len(root.xpath('//event')) -
+                       sent_before) as stage:
+        # main loop for each person
+        for person in persons:
+            time_begin = datetime.datetime.now()
+            person_count += 1
+            study_id = (person.xpath('study_id') or [None])[0]
+
+            if study_id is None:
+                raise Exception('Expected a valid value for study_id')
+
+            # count how many csv fragments are created per person
+            event_count = 0
+            requests_before = batch.requests_sent
+            logger.info('Start sending data for study_id: %s' % study_id.text)
+
+            forms = person.xpath('./all_form_events/form')
+
+            # loop through the forms of one person
+            for form in forms:
+                form_name = form.xpath('name')[0].text
+                form_key = 'Total_' + form_name + '_Forms'
+                study_id_key = study_id.text
+
+                # init dictionary for a new person in (study_id)
+                if study_id_key not in subject_details:
+                    subject_details[study_id_key] = {}
+
+                if not form_key in subject_details[study_id_key]:
+                    subject_details[study_id_key][form_key] = 0
+
+                if form_key not in form_details:
+                    form_details[form_key] = 0
+
+                logger.debug(
+                    'parsing study_id ' +
+                    study_id.text +
+                    ' form: ' +
+                    form_name)
+
+                # loop through the events of one form
+                for event in form.xpath('event'):
+                    event_status = event.findtext('status')
+                    if event_status == 'sent':
+                        continue
+                    event_count += 1
 
                     try:
-                        found_error = False
-                        response = redcapClientObject.send_data_to_redcap([json_data_dict], overwrite = True)
-                        status = event.find('status')
-                        if status is not None:
-                            status.text = 'sent'
-                        else:
-                            status_element = etree.Element("status")
-                            status_element.text = 'sent'
-                            event.append(status_element)
-                        data_repository.store(person_tree)
-                    except RedcapError as e:
-                        found_error = handle_errors_in_redcap_xml_response(
-                            e.message,
-                            report_data)
-
-                    time_stamp_after_request = time.time()
-
-                    if contains_data:
-                        if not found_error:
-                            # if no errors encountered update event counters
-                            subject_details[study_id_key][form_key] += 1
-                            form_details[form_key] += 1
-
-                except Exception as e:
-                    logger.error(e.message)
-                    raise
-
-        time_end = datetime.datetime.now()
-        logger.info("Total execution time for study_id %s was %s" % (study_id_key, (time_end - time_begin)))
-        logger.info("Total REDCap requests sent: %s \n" % (event_count))
+                        import_dict = {
+                            redcapClientObject.project.def_field: study_id.text}
+                        import_dict = create_import_data_json(
+                            import_dict,
+                            event)
+                        json_data_dict = import_dict['json_data']
+                        contains_data = import_dict['contains_data']
+
+                        # If we're skipping blanks and this event is blank, we
+                        # assume all following events are blank; therefore, break
+                        # out of this for-loop and move on to the next form.
+                        if skip_blanks and not contains_data:
+                            break
+
+                        if ledger is not None and ledger.check(
+                                event, study_id_key, form_name, json_data_dict):
+                            # this payload was accepted in an earlier run
+                            batch.skip(event, study_id_key, form_key,
+                                       contains_data)
+                            continue
+
+                        if diff is not None:
+                            json_data_dict = diff.changes(json_data_dict)
+                            if json_data_dict is None:
+                                # REDCap already holds the values of this event
+                                batch.skip(event, study_id_key, form_key,
+                                           contains_data)
+                                continue
+
+                        if (0 == event_count % 50):
+                            logger.info('Events prepared: %s' % (event_count))
+
+                        batch.add(event, json_data_dict, study_id_key, form_key,
+                                  contains_data)
+
+                    except Exception as e:
+                        logger.error(e.message)
+                        raise
+
+            time_end = datetime.datetime.now()
+            logger.info("Total execution time for study_id %s was %s" % (study_id_key, (time_end - time_begin)))
+            logger.info("Total REDCap requests sent: %s \n" % (
+                batch.requests_sent - requests_before))
+
+        # send the rows left over from the last person
+        batch.flush()
+        logger.info("Total REDCap requests sent for %s persons: %s" % (
+            person_count, batch.requests_sent))
+        stage['rows_out'] = len(root.xpath("//event/status[.='sent']")) - \
+            sent_before
+
+    if diff is not None:
+        logger.info("Unchanged events left out: %s, unchanged fields left "
+                    "out: %s" % (diff.unchanged_events, diff.unchanged_fields))
+        report_data['unchanged_events'] = diff.unchanged_events
+    if ledger is not None:
+        logger.info("Events left out because the ledger has their payload: "
+                    "%s" % ledger.unchanged_events)
+        report_data['unchanged_events'] = report_data.get(
+            'unchanged_events', 0) + ledger.unchanged_events
 
     report_data.update({
         'total_subjects': person_count,
@@ -493,6 +1144,71 @@ def check_input_file(batch_warning_days, db_path, email_settings, raw_xml_file):
     return old_batch
 
 
+"""
+Create the table holding the digest of the raw data of every subject sent
+by an earlier batch if it does not exist yet
+"""
+
+
+def create_subject_digest_table(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS RediSubjectDigest (
+    rsdStudyId TEXT PRIMARY KEY,
+    rsdDigest TEXT NOT NULL,
+    rbID INTEGER
+)""")
+
+
+"""
+@see bin/redi.py#_select_changed_subjects()
+@return a dictionary from STUDY_ID to the digest of its raw data stored by
+    the last batch which processed the subject
+"""
+
+
+def get_subject_digests(db_path):
+    digests = {}
+    db = None
+    try:
+        db = lite.connect(db_path)
+        create_subject_digest_table(db)
+        cur = db.cursor()
+        cur.execute("SELECT rsdStudyId, rsdDigest FROM RediSubjectDigest")
+        digests = dict(cur.fetchall())
+    except lite.Error as e:
+        logger.error("SQLite error in get_subject_digests() for file %s - %s" % (db_path, e.args[0]))
+    finally:
+        if db:
+            db.close()
+    return digests
+
+
+"""
+Store the digests of the subjects sent by the batch `batch_id`
+"""
+
+
+def store_subject_digests(db_path, digests, batch_id):
+    db = None
+    try:
+        db = lite.connect(db_path)
+        create_subject_digest_table(db)
+        db.executemany("""
+INSERT OR REPLACE INTO RediSubjectDigest
+    (rsdStudyId, rsdDigest, rbID)
+VALUES
+    (?, ?, ?)
+""", [(study_id, digest, batch_id)
+      for study_id, digest in digests.iteritems()])
+        db.commit()
+    except lite.Error as e:
+        logger.error("SQLite error in store_subject_digests() for file %s - %s" % (db_path, e.args[0]))
+        return False
+    finally:
+        if db:
+            db.close()
+    return True
+
+
 """
 Retrieve the row corresponding to the last REDI batch completed
 """
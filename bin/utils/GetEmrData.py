@@ -8,6 +8,7 @@ import csv
 from xml.sax import saxutils
 
 import pysftp
+from lxml import etree
 
 from csv2xml import openio, Writer
 
@@ -100,14 +101,56 @@ def generate_xml(input_filename, output_filename):
             writer.write_file(csvreader)
 
 
+def iter_csv_subjects(input_filename, counts=None):
+    """
+    Stream the rows of an EMR csv file as <subject> elements.
+
+    The first row holds the field names. The subjects are the same ones that
+    parsing the xml written by generate_xml() would produce, but no escaped
+    copy or xml file is written and nothing has to be parsed back.
+
+    @param input_filename : string
+    @param counts         : optional dictionary which receives the number of
+                            `subjects` read
+    """
+    if counts is None:
+        counts = {}
+    counts['subjects'] = 0
+
+    with open(input_filename, 'rb') as raw:
+        csvreader = csv.reader(raw,
+                               delimiter=',',
+                               doublequote=True,
+                               escapechar=None,
+                               quotechar='"',
+                               quoting=csv.QUOTE_MINIMAL,
+                               skipinitialspace=False)
+        header = next(csvreader)
+        for record in csvreader:
+            subject = etree.Element('subject')
+            for index, field in enumerate(record):
+                element = etree.SubElement(subject, header[index])
+                if field:
+                    element.text = field.decode('cp1252')
+            counts['subjects'] += 1
+            yield subject
+
+
 def cleanup(file_to_delete):
     os.remove(file_to_delete)
 
 
-def get_emr_data(configuration_directory_path, props):
+def get_emr_data(configuration_directory_path, props, write_xml=True,
+                 csv_file='raw.txt', xml_file='raw.xml'):
     """
     @param configuration_directory_path : string
     @param props                        : EmrConnectionDetails object
+    @param write_xml                    : when False only the csv file is
+                                          downloaded and no xml is written
+    @param csv_file                     : name of the downloaded csv file in
+                                          the configuration directory
+    @param xml_file                     : name of the xml file generated from
+                                          it in the configuration directory
     """
 
     project_name    = props.project_name + "/"
@@ -117,18 +160,21 @@ def get_emr_data(configuration_directory_path, props):
     # download csv file
     download_file(
         project_name + data_file,
-        configuration_directory_path + 'raw.txt',
+        configuration_directory_path + csv_file,
         props.server, props.username, props.password)
 
+    if not write_xml:
+        return
+
     # replace certain characters with escape sequences
     data_preprocessing(
-        configuration_directory_path + 'raw.txt',
+        configuration_directory_path + csv_file,
         configuration_directory_path + 'rawEscaped.txt')
 
     # run csv2xml.py to generate data in xml format
     generate_xml(
         configuration_directory_path + 'rawEscaped.txt',
-        configuration_directory_path + 'raw.xml')
+        configuration_directory_path + xml_file)
 
     # delete rawEscaped.txt
     cleanup(configuration_directory_path + 'rawEscaped.txt')
@@ -111,12 +111,28 @@ optional_parameters_dict = {
     "rules": {},
     "batch_warning_days": 13,
     "rate_limiter_value_in_redcap": 600,
+    "redcap_batch_rows": 1,
+    "redcap_batch_bytes": 1000000,
+    "redcap_upload_workers": 1,
+    "status_journal": False,
+    "diff_mode": "off",
+    "diff_export_records": 100,
+    "payload_ledger": False,
+    "incremental_subjects": False,
     "batch_info_database": "redi.db",
     "send_email": 'N',
     "verify_ssl": True,
     "replace_fields_in_raw_data_xml": None,
     "include_rule_errors_in_report": False,
     "redcap_support_sender_email": 'please-do-not-reply@example.com',
+    "stream_raw_data": False,
+    "raw_data_format": "xml",
+    "raw_csv_file": "raw.txt",
+    "columnar_engine": False,
+    "sparse_person_form_event_tree": False,
+    "snapshot_policy": "all",
+    "snapshot_background": False,
+    "sort_buffer_rows": 0,
 }
 
 class ConfigurationError(Exception):
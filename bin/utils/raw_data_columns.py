@@ -0,0 +1,481 @@
+"""
+raw_data_columns.py - column oriented storage of the raw clinical data
+
+Every field of the raw data is held in a DictionaryColumn: the distinct
+values of the field in a list and, for every subject, the index of its value
+in that list. The transform stages then work on whole columns and do their
+lookups once per distinct value instead of once per subject element. NumPy
+is used for the index arrays when it is installed.
+
+An ElementTree with the same subjects as the one built by redi.py is only
+created when to_element_tree() is called.
+"""
+
+import array
+import logging
+import time
+from datetime import datetime, timedelta
+
+from lxml import etree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class _Missing(object):
+    """Value of a field which a subject does not have"""
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+# elements added to every subject by redi.add_elements_to_subject
+DERIVED_FIELDS = [
+    'timestamp',
+    'redcapFormName',
+    'eventName',
+    'formDateField',
+    'formCompletedFieldName',
+    'formImportedFieldName',
+    'redcapFieldNameValue',
+    'redcapFieldNameUnits',
+    'redcapStatusFieldName']
+
+
+def findtext(value):
+    """Return what subject.findtext() returns for a stored value"""
+    if value is MISSING:
+        return None
+    return '' if value is None else value
+
+
+def _make_codes(codes):
+    if numpy is not None:
+        return numpy.array(codes, dtype=numpy.int32)
+    return array.array('l', codes)
+
+
+class DictionaryColumn(object):
+    """
+    A column of field values stored as codes into a list of values.
+
+    Columns are not changed in place; every operation returns a new column
+    which may share the values list or the codes with the old one.
+    """
+    def __init__(self, values, codes):
+        self.values = values
+        self.codes = codes
+
+    @classmethod
+    def encode(cls, items):
+        """Build a column from an iterable of values"""
+        values = []
+        index = {}
+        codes = []
+        for item in items:
+            code = index.get(item)
+            if code is None:
+                code = index[item] = len(values)
+                values.append(item)
+            codes.append(code)
+        return cls(values, _make_codes(codes))
+
+    @classmethod
+    def constant(cls, value, length):
+        return cls([value], _make_codes([0] * length))
+
+    @classmethod
+    def combine(cls, columns, function):
+        """
+        Build a column from the row-wise values of several columns.
+
+        `function` is called once for every distinct combination of values.
+        """
+        if numpy is not None:
+            keys = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+            for column in columns:
+                keys = keys * len(column.values) + column.codes
+            distinct, codes = numpy.unique(keys, return_inverse=True)
+            values = []
+            for key in distinct.tolist():
+                row = []
+                for column in reversed(columns):
+                    key, code = divmod(key, len(column.values))
+                    row.append(column.values[code])
+                values.append(function(*reversed(row)))
+            return cls(values, codes.astype(numpy.int32))
+
+        cache = {}
+        values = []
+        codes = []
+        for key in zip(*[column.codes for column in columns]):
+            code = cache.get(key)
+            if code is None:
+                code = cache[key] = len(values)
+                values.append(function(*[column.values[c]
+                    for column, c in zip(columns, key)]))
+            codes.append(code)
+        return cls(values, _make_codes(codes))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        values = self.values
+        for code in self.codes:
+            yield values[code]
+
+    def map(self, function):
+        """Apply `function` once to every distinct value"""
+        return DictionaryColumn([function(value) for value in self.values],
+                                self.codes)
+
+    def mask(self, predicate):
+        """Return a row mask of the values for which `predicate` is true"""
+        matches = [bool(predicate(value)) for value in self.values]
+        if numpy is not None:
+            return numpy.array(matches, dtype=bool)[self.codes]
+        return [matches[code] for code in self.codes]
+
+    def assign(self, mask, value):
+        """Return a copy of the column with the masked rows set to `value`"""
+        values = list(self.values)
+        values.append(value)
+        code = len(values) - 1
+        if numpy is not None:
+            codes = self.codes.copy()
+            codes[mask] = code
+        else:
+            codes = _make_codes(code if selected else old
+                                for old, selected in zip(self.codes, mask))
+        return DictionaryColumn(values, codes)
+
+    def take(self, order):
+        """Return the rows in `order`"""
+        if numpy is not None:
+            return DictionaryColumn(self.values, self.codes[order])
+        codes = self.codes
+        return DictionaryColumn(self.values,
+                                _make_codes(codes[row] for row in order))
+
+    def value_counts(self):
+        """Return a dictionary of the number of rows holding each value"""
+        if numpy is not None:
+            counts = numpy.bincount(self.codes,
+                                    minlength=len(self.values)).tolist()
+        else:
+            counts = [0] * len(self.values)
+            for code in self.codes:
+                counts[code] += 1
+        value_counts = {}
+        for value, number in zip(self.values, counts):
+            value_counts[value] = value_counts.get(value, 0) + number
+        return value_counts
+
+    def count(self, predicate):
+        """Count the rows whose value satisfies `predicate`"""
+        return sum(number for value, number in self.value_counts().items()
+                   if predicate(value))
+
+    def ranks(self, key=None):
+        """
+        Return the sort rank of every row; equal values share a rank.
+        """
+        if key is None:
+            key = lambda value: value
+        keys = [key(value) for value in self.values]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        rank_of_code = [0] * len(keys)
+        rank = 0
+        for position, code in enumerate(order):
+            if position and keys[code] != keys[order[position - 1]]:
+                rank += 1
+            rank_of_code[code] = rank
+        if numpy is not None:
+            return numpy.array(rank_of_code, dtype=numpy.int32)[self.codes]
+        return [rank_of_code[code] for code in self.codes]
+
+
+class RawDataColumns(object):
+    """
+    The subjects of the raw data held as one DictionaryColumn per field.
+
+    `fields` keeps the names of the columns in the order the elements appear
+    in the subjects. The DERIVED_FIELDS always follow the raw fields.
+    """
+    def __init__(self, fields, columns, length):
+        self.fields = fields
+        self.columns = columns
+        self.length = length
+
+    @classmethod
+    def from_subjects(cls, subjects):
+        """
+        Read an iterable of <subject> elements into columns.
+
+        If a subject holds the same element twice only the first one is kept,
+        which is the one find() would return.
+        """
+        fields = []
+        values = {}
+        index = {}
+        codes = {}
+        length = 0
+        for subject in subjects:
+            row = {}
+            for element in subject:
+                if not isinstance(element.tag, basestring):
+                    continue
+                if element.tag not in row:
+                    row[element.tag] = element.text
+                if element.tag not in codes:
+                    fields.append(element.tag)
+                    values[element.tag] = [MISSING]
+                    index[element.tag] = {MISSING: 0}
+                    codes[element.tag] = [0] * length
+            for field in fields:
+                value = row.get(field, MISSING)
+                code = index[field].get(value)
+                if code is None:
+                    code = index[field][value] = len(values[field])
+                    values[field].append(value)
+                codes[field].append(code)
+            length += 1
+
+        columns = {}
+        for field in fields:
+            columns[field] = DictionaryColumn(values[field],
+                                              _make_codes(codes[field]))
+        for field in DERIVED_FIELDS:
+            columns[field] = DictionaryColumn.constant(None, length)
+        return cls(fields + DERIVED_FIELDS, columns, length)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __setitem__(self, field, column):
+        if field not in self.columns:
+            self.fields.insert(self.fields.index(DERIVED_FIELDS[0]), field)
+        self.columns[field] = column
+
+    def insert_after(self, existing_field, field, column):
+        """Add a new column next to `existing_field`"""
+        self.fields.insert(self.fields.index(existing_field) + 1, field)
+        self.columns[field] = column
+
+    def drop(self, field):
+        self.fields.remove(field)
+        del self.columns[field]
+
+    def sort(self, fields):
+        """
+        Reorder the subjects on the text of `fields`, like a stable sort on
+        subject.findtext() would.
+        """
+        ranks = [self.columns[field].ranks(findtext) for field in fields]
+        if numpy is not None:
+            order = numpy.lexsort(list(reversed(ranks)))
+        else:
+            order = sorted(range(self.length),
+                           key=lambda row: [rank[row] for rank in ranks])
+        for field in self.fields:
+            self.columns[field] = self.columns[field].take(order)
+
+    def to_element_tree(self):
+        """Create the `<study>` ElementTree holding the subjects"""
+        root = etree.Element('study')
+        columns = [(field, list(self.columns[field])) for field in self.fields]
+        for row in range(self.length):
+            subject = etree.SubElement(root, 'subject')
+            for field, values in columns:
+                value = values[row]
+                if value is not MISSING:
+                    etree.SubElement(subject, field).text = value
+        return etree.ElementTree(root)
+
+
+def replace_fields(columns, fields_to_replace):
+    """
+    Rename fields of the raw data
+
+    :param columns: RawDataColumns
+    :param fields_to_replace: list of (source, target) field names
+    """
+    for source, target in fields_to_replace:
+        if source not in columns or source == target:
+            continue
+        if target not in columns:
+            columns.insert_after(source, target, columns[source])
+        else:
+            columns[target] = DictionaryColumn.combine(
+                [columns[target], columns[source]],
+                lambda old, new: old if new is MISSING else new)
+        columns.drop(source)
+    return columns
+
+
+def verify_and_correct_collection_date(columns, input_date_format):
+    """
+    Fill blank DATE_TIME_STAMP values with RESULT_DATE minus four days and
+    drop the RESULT_DATE field, as redi.verify_and_correct_collection_date
+    does for a tree.
+    """
+    summary = {'total': len(columns), 'blank': 0}
+    if 'RESULT_DATE' not in columns:
+        return columns, summary
+    if 'DATE_TIME_STAMP' not in columns:
+        columns.insert_after('RESULT_DATE', 'DATE_TIME_STAMP',
+            DictionaryColumn.constant(MISSING, len(columns)))
+
+    def is_blank(collection_date, result_date):
+        return result_date is not MISSING and \
+            (collection_date is MISSING or not collection_date)
+
+    def corrected(collection_date, result_date):
+        if not is_blank(collection_date, result_date):
+            return collection_date
+        return str(datetime.strptime(result_date, input_date_format) -
+                   timedelta(days=4))
+
+    pair = [columns['DATE_TIME_STAMP'], columns['RESULT_DATE']]
+    summary['blank'] = DictionaryColumn.combine(pair, is_blank).count(bool)
+    columns['DATE_TIME_STAMP'] = DictionaryColumn.combine(pair, corrected)
+    columns.drop('RESULT_DATE')
+    if summary['blank'] > 0:
+        logger.info("There were {0} out of {1} blank specimen taken times "\
+            "in this run.".format(summary['blank'], summary['total']))
+    return columns, summary
+
+
+def convert_component_id_to_loinc_code(columns, mapping, unmapped=None):
+    """
+    Replace the source field of every subject matching a mapping with the
+    target field of the mapping
+
+    :param columns: RawDataColumns
+    :param mapping: (source name, source value) -> (target name, target
+        value) as built by redi.compile_component_to_loinc_code
+    :param unmapped: optional dictionary which receives the number of
+        subjects for every (source name, value) without a mapping
+    """
+    source_names = []
+    for source_name, source_value in mapping:
+        if source_name not in source_names:
+            source_names.append(source_name)
+
+    # read all source columns first so a field is converted only once
+    sources = [(source_name, columns[source_name])
+               for source_name in source_names if source_name in columns]
+    for source_name, source in sources:
+        def target(value):
+            if value is MISSING:
+                return None
+            return mapping.get((source_name, value))
+
+        if unmapped is not None:
+            for value, count in source.value_counts().items():
+                if value is not MISSING and target(value) is None:
+                    unmapped[(source_name, value)] = \
+                        unmapped.get((source_name, value), 0) + count
+
+        target_names = []
+        for value in source.values:
+            if target(value) is not None and \
+                    target(value)[0] not in target_names:
+                target_names.append(target(value)[0])
+        if not target_names:
+            logger.debug(
+                'There are no matching sujects to modify in the Raw Data')
+            continue
+
+        for target_name in target_names:
+            if target_name == source_name:
+                continue
+            if target_name not in columns:
+                columns.insert_after(source_name, target_name,
+                    DictionaryColumn.constant(MISSING, len(columns)))
+
+            def converted(old, value, target_name=target_name):
+                found = target(value)
+                if found is None or found[0] != target_name:
+                    return old
+                return found[1]
+
+            columns[target_name] = DictionaryColumn.combine(
+                [columns[target_name], source], converted)
+
+        def remaining(value):
+            found = target(value)
+            if found is None:
+                return value
+            return found[1] if found[0] == source_name else MISSING
+
+        columns[source_name] = source.map(remaining)
+    return columns
+
+
+def update_time_stamp(columns, input_date_format, output_date_format):
+    """Set timestamp from DATE_TIME_STAMP in the output date format"""
+    def convert(specimn_taken_time):
+        if specimn_taken_time is MISSING:
+            raise Exception('DATE_TIME_STAMP is missing in the raw data')
+        if specimn_taken_time is None:
+            return None
+        return format(time.strftime(output_date_format,
+            time.strptime(specimn_taken_time, input_date_format)))
+
+    columns['timestamp'] = columns['DATE_TIME_STAMP'].map(convert)
+    return columns
+
+
+def _lookup(table, key, name, undefined):
+    record = table.get(key)
+    if record is None or name not in record:
+        return undefined
+    return record[name]
+
+
+def update_from_lookups(columns, components, forms, undefined):
+    """
+    Set the fields which redi.py looks up in translationTable.xml and
+    formEvents.xml
+
+    :param components: loinc_code -> {element name: text}
+    :param forms: form name -> {element name: text}
+    """
+    loinc_code = columns['loinc_code'] if 'loinc_code' in columns else \
+        DictionaryColumn.constant(MISSING, len(columns))
+
+    def from_component(name, default=undefined):
+        return loinc_code.map(lambda value: _lookup(
+            components, findtext(value), name, default))
+
+    columns['redcapFormName'] = from_component('redcapFormName')
+    form_name = columns['redcapFormName']
+    columns['formImportedFieldName'] = form_name.map(lambda value: _lookup(
+        forms, findtext(value), 'formImportedFieldName', undefined))
+    columns['redcapStatusFieldName'] = from_component('redcapStatusFieldName')
+
+    def form_date_field(value):
+        if value == 'undefined' or value not in forms:
+            return 'undefined'
+        return forms[value].get('formDateField')
+
+    columns['formDateField'] = form_name.map(form_date_field)
+    columns['formCompletedFieldName'] = form_name.map(lambda value: _lookup(
+        forms, findtext(value), 'formCompletedFieldName', undefined))
+    columns['redcapFieldNameValue'] = from_component('redcapFieldNameValue')
+    columns['redcapFieldNameUnits'] = from_component(
+        'redcapFieldNameUnits', "redcapFieldNameUnitsUndefined")
+    return columns
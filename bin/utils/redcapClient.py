@@ -2,6 +2,8 @@ from lxml import etree
 from redcap import Project, RedcapError
 from requests import RequestException
 import pprint
+import Queue
+import threading
 import redi_email
 import logging
 logger = logging.getLogger(__name__)
@@ -85,3 +87,114 @@ class redcapClient:
         except RedcapError as e:
             logger.debug(e.message)
             raise
+
+
+class RedcapFuture(object):
+    """
+    Result of a request sent by asyncRedcapClient
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the request and return its response or raise its error """
+        if not self._done.wait(timeout):
+            raise RuntimeError('REDCap request did not finish in time')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('REDCap request did not finish in time')
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """ Call `callback(future)` when the request finishes """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class asyncRedcapClient(object):
+    """
+    Non-blocking variant of redcapClient.
+
+    export_records() and import_records() return a RedcapFuture right away.
+    The requests are sent by `max_in_flight` threads; a call blocks while
+    `max_in_flight` requests are already waiting or in flight, so the
+    caller can drive many requests from one loop.
+    """
+
+    def __init__(self, client, max_in_flight=4):
+        self.client = client
+        self.project = client.project
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._requests = Queue.Queue()
+        self._threads = []
+        for _ in range(max_in_flight):
+            thread = threading.Thread(target=self._send_requests)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _send_requests(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            future, function, args, kwargs = request
+            try:
+                response = function(*args, **kwargs)
+            except Exception as e:
+                self._slots.release()
+                future._set(exception=e)
+            else:
+                self._slots.release()
+                future._set(result=response)
+
+    def submit(self, function, *args, **kwargs):
+        self._slots.acquire()
+        future = RedcapFuture()
+        self._requests.put((future, function, args, kwargs))
+        return future
+
+    def export_records(self, **kwargs):
+        """ @see redcapClient.get_data_from_redcap """
+        return self.submit(self.client.get_data_from_redcap, **kwargs)
+
+    def import_records(self, data, overwrite=False):
+        """ @see redcapClient.send_data_to_redcap """
+        return self.submit(self.client.send_data_to_redcap, data, overwrite)
+
+    def close(self):
+        """ Wait for the submitted requests and stop the threads """
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -68,6 +68,11 @@
 						</tr>
                     </tbody>
                 </table>
+                <xsl:if test="report/summary/unchangedEventCount">
+                    <p>Events not sent because REDCap already holds their values:
+                        <xsl:value-of select="report/summary/unchangedEventCount" />
+                    </p>
+                </xsl:if>
                 <br />
                 <!-- Alerts start here -->
                 <h3>Import Alerts</h3>
@@ -151,6 +156,36 @@
                     </tr>
                     </xsl:for-each>
                 </table>
+                <xsl:if test="report/stages/stage">
+                    <br />
+                    <h3>Stages</h3>
+                    <table>
+                        <thead>
+                            <tr>
+                                <th>Stage</th>
+                                <th>Wall time (s)</th>
+                                <th>CPU time (s)</th>
+                                <th>Peak RSS (KB)</th>
+                                <th>RSS growth (KB)</th>
+                                <th>Rows in</th>
+                                <th>Rows out</th>
+                            </tr>
+                        </thead>
+                        <tbody>
+                            <xsl:for-each select="report/stages/stage">
+                                <tr>
+                                    <td><xsl:value-of select="name" /></td>
+                                    <td><xsl:value-of select="wall_time" /></td>
+                                    <td><xsl:value-of select="cpu_time" /></td>
+                                    <td><xsl:value-of select="peak_rss_kb" /></td>
+                                    <td><xsl:value-of select="rss_growth_kb" /></td>
+                                    <td><xsl:value-of select="rows_in" /></td>
+                                    <td><xsl:value-of select="rows_out" /></td>
+                                </tr>
+                            </xsl:for-each>
+                        </tbody>
+                    </table>
+                </xsl:if>
             </body>
         </html>
     </xsl:template>
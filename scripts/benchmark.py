@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+""" Runs the stages of redi against a generated project and a REDCap client
+which answers locally, or the REDCap stand-in server, and reports and stores
+the time, memory and rows per second of every stage """
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+import redi
+import redi_lib
+import utils.SimpleConfigParser as SimpleConfigParser
+from utils.redcapClient import redcapClient
+import generate_benchmark_data
+
+
+class BenchmarkProject(object):
+    def __init__(self, study_ids):
+        self.def_field = 'dm_subjid'
+        self.study_ids = study_ids
+        self.rows = 0
+        self.requests = 0
+
+
+class BenchmarkRedcapClient(object):
+    """
+    Stands in for utils.redcapClient.redcapClient. Every research id of the
+    raw data maps to the same REDCap id, and imports are accepted after
+    `latency` seconds.
+    """
+    study_ids = []
+    latency = 0
+
+    def __init__(self, redcap_uri, token, verify_ssl):
+        self.project = BenchmarkProject(self.study_ids)
+
+    def get_data_from_redcap(self, records_to_fetch=None,
+                             events_to_fetch=None, fields_to_fetch=None,
+                             forms_to_fetch=None, return_format='xml'):
+        items = ''.join(
+            '<item><dm_usubjid>{0}</dm_usubjid><dm_subjid>{0}</dm_subjid>'
+            '</item>'.format(study_id) for study_id in self.study_ids)
+        return '<records>{0}</records>'.format(items)
+
+    def send_data_to_redcap(self, data, overwrite=False):
+        if self.latency:
+            time.sleep(self.latency)
+        self.project.requests += 1
+        self.project.rows += len(data)
+        return {'count': len(data)}
+
+
+def read_settings(configuration_directory, overrides):
+    settings = SimpleConfigParser.SimpleConfigParser()
+    settings.read(os.path.join(configuration_directory, 'settings.ini'))
+    for name, value in overrides:
+        settings.set(SimpleConfigParser.NOSECTION, name, value)
+    settings.set_attributes()
+    return settings
+
+
+def start_stand_in(configuration_directory, latency=0):
+    """
+    Start redcap_stand_in.py for the project in `configuration_directory`
+    on a free port and return the process and the API url
+    """
+    process = subprocess.Popen(
+        [sys.executable,
+         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'redcap_stand_in.py'),
+         '--config', configuration_directory, '--port', '0',
+         '--latency', str(latency)],
+        stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if not line:
+        raise Exception('The REDCap stand-in did not start')
+    return process, line.split()[-1]
+
+
+def store_research_ids(configuration_directory, settings, study_ids):
+    """
+    Import one record for every research id, holding the research id in the
+    research id field and the first event of the project
+    """
+    id_map = etree.parse(os.path.join(configuration_directory,
+                                      settings.research_id_to_redcap_id))
+    form_events = etree.parse(os.path.join(configuration_directory,
+                                           settings.form_events_file))
+    event = form_events.findtext('form/event/name')
+    client = redcapClient(settings.redcap_uri, settings.token, False)
+    client.send_data_to_redcap([
+        {id_map.findtext('redcap_id_field_name'): study_id,
+         id_map.findtext('research_id_field_name'): study_id,
+         'redcap_event_name': event} for study_id in study_ids])
+
+
+def run(configuration_directory, work_directory, overrides, workers=1,
+        redcap_uri=None):
+    """
+    Run the transform stages and the upload of redi once and return the
+    StageMetrics of the run. With `redcap_uri` the REDCap API at that url is
+    used instead of BenchmarkRedcapClient.
+    """
+    if redcap_uri is not None:
+        overrides = overrides + [['redcap_uri', redcap_uri]]
+    settings = read_settings(configuration_directory, overrides)
+    if settings.raw_data_format == 'csv':
+        raw_data_file = os.path.join(configuration_directory,
+                                     settings.raw_csv_file)
+    else:
+        raw_data_file = os.path.join(configuration_directory,
+                                     settings.raw_xml_file)
+    study_ids = sorted(set(
+        subject.findtext('STUDY_ID') for subject in
+        redi.iter_raw_subjects(raw_data_file, settings.raw_data_format)))
+    if redcap_uri is None:
+        BenchmarkRedcapClient.study_ids = study_ids
+        redi.redcapClient = BenchmarkRedcapClient
+        redi_lib.redcapClient = BenchmarkRedcapClient
+    else:
+        store_research_ids(configuration_directory, settings, study_ids)
+
+    data_folder = os.path.join(work_directory, 'data')
+    os.makedirs(data_folder)
+    email_settings = redi.get_email_settings(settings)
+    redcap_settings = redi.get_redcap_settings(settings)
+    repository = redi.PersonFormEventsRepository(
+        os.path.join(data_folder, 'person_form_event_tree_with_data.xml'),
+        redi.logger, settings.status_journal)
+    metrics = redi_lib.StageMetrics()
+
+    _, person_form_event_tree, _, _ = \
+        redi._create_person_form_event_tree_with_data(
+            os.path.join(configuration_directory, 'settings.ini'),
+            configuration_directory, email_settings,
+            os.path.join(configuration_directory, settings.form_events_file),
+            raw_data_file, redcap_settings,
+            redi.load_rules(settings.rules, configuration_directory),
+            settings, data_folder,
+            os.path.join(configuration_directory,
+                         settings.translation_table_file),
+            False, os.path.join(work_directory, 'redi.db'), None, workers,
+            metrics)
+    repository.store(person_form_event_tree)
+    redi_lib.generate_output(person_form_event_tree, redcap_settings,
+                             email_settings, repository, False, None,
+                             metrics)
+    return metrics
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rows_per_second(stage):
+    rows = stage['rows_in'] if stage['rows_in'] is not None \
+        else stage['rows_out']
+    if rows is None or not stage['wall_time']:
+        return None
+    return int(rows / stage['wall_time'])
+
+
+def none_as_blank(value):
+    return '' if value is None else value
+
+
+def print_report(result, baseline=None):
+    baseline_stages = {}
+    if baseline is not None:
+        baseline_stages = dict((stage['name'], stage)
+                               for stage in baseline['stages'])
+        print "compared with {0} ({1})".format(baseline['label'],
+                                               baseline['revision'])
+    print "{0:24} {1:>9} {2:>9} {3:>10} {4:>10} {5:>10} {6:>8}".format(
+        'stage', 'wall s', 'cpu s', 'peak KB', 'growth KB', 'rows/s',
+        'change')
+    for stage in result['stages']:
+        previous = baseline_stages.get(stage['name'])
+        if previous and previous['wall_time']:
+            change = '{0:+.0%}'.format(
+                stage['wall_time'] / previous['wall_time'] - 1)
+        else:
+            change = ''
+        print "{0:24} {1:9.3f} {2:9.3f} {3:>10} {4:>10} {5:>10} {6:>8}".format(
+            stage['name'], stage['wall_time'], stage['cpu_time'],
+            none_as_blank(stage['peak_rss_kb']),
+            none_as_blank(stage['rss_growth_kb']),
+            none_as_blank(stage['rows_per_second']), change)
+    print "{0:24} {1:9.3f}".format('total', result['wall_time'])
+
+
+def main():
+    """ Main entry point """
+    parser = argparse.ArgumentParser(
+        description='Runs redi against a generated project and reports the '
+                    'time, memory and rows per second of every stage')
+    parser.add_argument('--config',
+                        help='configuration directory written by '
+                             'generate_benchmark_data.py; when it is not '
+                             'given a project is generated for the run')
+    generate_benchmark_data.add_scale_arguments(parser)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='override a setting of settings.ini, e.g. '
+                             'columnar_engine=Y; can be repeated')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes building the person form event tree '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the REDCap client takes for every '
+                             'import request (default: %(default)s)')
+    redcap = parser.add_mutually_exclusive_group()
+    redcap.add_argument('--stand-in', action='store_true',
+                        help='send the requests over HTTP to a REDCap '
+                             'stand-in server started for the run')
+    redcap.add_argument('--redcap-uri',
+                        help='send the requests to the REDCap API at this '
+                             'url, e.g. a running redcap_stand_in.py')
+    parser.add_argument('--label', default='benchmark',
+                        help='name of the run in the stored results')
+    parser.add_argument('--output', default='benchmarks',
+                        help='directory the results are stored in '
+                             '(default: %(default)s)')
+    parser.add_argument('--compare', metavar='RESULTS_FILE',
+                        help='results of an earlier run to compare with')
+    args = parser.parse_args()
+    overrides = [override.split('=', 1) for override in args.set]
+
+    work_directory = tempfile.mkdtemp(prefix='redi-benchmark-')
+    stand_in = None
+    try:
+        redi.configure_logging(work_directory)
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and \
+                    not isinstance(handler, logging.FileHandler):
+                handler.setLevel(logging.ERROR)
+
+        configuration_directory = args.config
+        if configuration_directory is None:
+            configuration_directory = os.path.join(work_directory, 'config')
+            generate_benchmark_data.generate(
+                configuration_directory, args.subjects, args.results,
+                args.forms, args.events, args.components,
+                args.raw_data_format, args.seed)
+        BenchmarkRedcapClient.latency = args.latency
+        redcap_uri = args.redcap_uri
+        if args.stand_in:
+            stand_in, redcap_uri = start_stand_in(configuration_directory,
+                                                  args.latency)
+
+        start = time.time()
+        metrics = run(configuration_directory,
+                      os.path.join(work_directory, 'run'), overrides,
+                      args.workers, redcap_uri)
+        wall_time = time.time() - start
+    finally:
+        if stand_in is not None:
+            stand_in.terminate()
+            stand_in.wait()
+        shutil.rmtree(work_directory)
+
+    for stage in metrics.stages:
+        stage['rows_per_second'] = rows_per_second(stage)
+    if args.config:
+        parameters = {'config': args.config}
+    else:
+        parameters = {
+            'subjects': args.subjects,
+            'results': args.results,
+            'forms': args.forms,
+            'events': args.events,
+            'components': args.components,
+            'format': args.raw_data_format,
+            'seed': args.seed}
+    parameters.update({'settings': dict(overrides),
+                       'workers': args.workers,
+                       'latency': args.latency,
+                       'stand_in': args.stand_in,
+                       'redcap_uri': args.redcap_uri})
+    now = datetime.datetime.now()
+    result = {
+        'label': args.label,
+        'date': now.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'wall_time': round(wall_time, 3),
+        'stages': metrics.stages}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    print_report(result, baseline)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    results_file = os.path.join(args.output, '{0}-{1}.json'.format(
+        now.strftime('%Y%m%d-%H%M%S'), args.label))
+    with open(results_file, 'w') as fp:
+        json.dump(result, fp, indent=2, sort_keys=True)
+    print "results stored in {0}".format(results_file)
+
+
+if __name__ == '__main__':
+    main()
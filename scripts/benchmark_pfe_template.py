@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Times building the person form event tree from the all-form-events
+template by copying the template versus serializing and parsing it again """
+
+import argparse
+import os
+import sys
+import time
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+import redi
+
+
+def make_template(forms, events, fields):
+    """ Build an all_form_events template like create_empty_events_for_one_subject """
+    root = etree.Element('all_form_events')
+    for form_number in range(forms):
+        form = etree.SubElement(root, 'form')
+        etree.SubElement(form, 'name').text = 'form_%d' % form_number
+        for event_number in range(events):
+            event = etree.SubElement(form, 'event')
+            etree.SubElement(event, 'name').text = '%d_arm_1' % event_number
+            etree.SubElement(event, 'status').text = 'unsent'
+            for field_number in range(fields):
+                field = etree.SubElement(event, 'field')
+                etree.SubElement(field, 'name').text = 'form_%d_field_%d' % (
+                    form_number, field_number)
+                etree.SubElement(field, 'value')
+    return etree.ElementTree(root)
+
+
+def make_raw_data(subjects):
+    root = etree.Element('study')
+    for subject_number in range(subjects):
+        subject = etree.SubElement(root, 'subject')
+        etree.SubElement(subject, 'STUDY_ID').text = str(subject_number)
+    return etree.ElementTree(root)
+
+
+def build_by_serialization(raw_data_tree, all_form_events_tree):
+    """ The way create_empty_event_tree_for_study used to copy the template """
+    root = etree.Element('person_form_event')
+    all_form_events_root = all_form_events_tree.getroot()
+    subjects = set(subject.findtext('STUDY_ID')
+                   for subject in raw_data_tree.getroot().iter('subject'))
+    for subject_id in subjects:
+        person = etree.SubElement(root, 'person')
+        etree.SubElement(person, 'study_id').text = subject_id
+        person.append(etree.XML(etree.tostring(
+            all_form_events_root, method='html', pretty_print=True)))
+    return etree.ElementTree(root)
+
+
+def build_by_copy(raw_data_tree, all_form_events_tree):
+    return redi.create_empty_event_tree_for_study(raw_data_tree,
+                                                  all_form_events_tree)
+
+
+def main():
+    """ Main entry point """
+    parser = argparse.ArgumentParser(
+        description='Times building the person form event tree from the '
+                    'all-form-events template')
+    parser.add_argument('--subjects', type=int, default=10000)
+    parser.add_argument('--forms', type=int, default=20)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--fields', type=int, default=3,
+                        help='fields in every event (default: %(default)s)')
+    args = parser.parse_args()
+
+    redi.configure_logging(os.getcwd())
+    template = make_template(args.forms, args.events, args.fields)
+    raw_data = make_raw_data(args.subjects)
+    print "{0} subjects x {1} forms x {2} events x {3} fields".format(
+        args.subjects, args.forms, args.events, args.fields)
+
+    for name, build in [('serialize and parse', build_by_serialization),
+                        ('copy template', build_by_copy)]:
+        start = time.time()
+        tree = build(raw_data, template)
+        elapsed = time.time() - start
+        print "{0:20} {1:8.2f} s  {2} persons".format(
+            name, elapsed, len(tree.getroot()))
+        del tree
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+""" Generates a synthetic EMR data file and the matching configuration files
+of a redi project at a chosen scale, for benchmarking """
+
+import argparse
+import csv
+import datetime
+import os
+import random
+
+from lxml import etree
+
+RAW_FIELDS = ['STUDY_ID', 'COMPONENT_ID', 'ORD_VALUE', 'UNIT',
+              'DATE_TIME_STAMP', 'RESULT_DATE', 'Collection_Time']
+
+UNITS = ['g/dL', 'mg/dL', 'K/uL', 'IU/L', '%', '']
+
+SETTINGS = """# generated by generate_benchmark_data.py
+translation_table_file = translationTable.xml
+form_events_file = formEvents.xml
+raw_xml_file = raw.xml
+raw_csv_file = raw.txt
+raw_data_format = {raw_data_format}
+research_id_to_redcap_id = research_id_to_redcap_id_map.xml
+component_to_loinc_code_xml = clinical-component-to-loinc.xml
+replace_fields_in_raw_data_xml = replace_fields_in_raw_data.xml
+redcap_uri = http://localhost/api/
+token = benchmark
+redcap_server = http://localhost
+redcap_support_receiver_email = redi@localhost
+smtp_host_for_outbound_mail = localhost
+smtp_port_for_outbound_mail = 25
+send_email = N
+# the benchmark REDCap client answers at once; do not throttle it
+rate_limiter_value_in_redcap = 6000000
+emr_sftp_server_hostname = localhost
+emr_sftp_server_username = redi
+emr_sftp_server_password = redi
+emr_sftp_project_name = redi
+emr_data_file = raw.txt
+"""
+
+
+class Project(object):
+    """
+    The forms, events and clinical components of a generated project.
+
+    Form `f` is named form_<f> and holds the components <f + 1>001,
+    <f + 1>002, ... which map to the LOINC codes L<f + 1>001, ...
+    """
+
+    def __init__(self, forms, events, components):
+        self.forms = ['form_%d' % form for form in range(forms)]
+        self.events = ['%d_arm_1' % (event + 1) for event in range(events)]
+        self.components = dict(
+            (form_name, ['%d%03d' % (form + 1, component + 1)
+                         for component in range(components)])
+            for form, form_name in enumerate(self.forms))
+
+    def component_fields(self, component_id):
+        """ Return the value, units and status field names of a component """
+        return ['c%s_lborres' % component_id, 'c%s_lborresu' % component_id,
+                'c%s_lbstat' % component_id]
+
+    def write_form_events(self, path):
+        root = etree.Element('redcapProject')
+        etree.SubElement(root, 'name').text = 'Benchmark'
+        for form_name in self.forms:
+            form = etree.SubElement(root, 'form')
+            etree.SubElement(form, 'name').text = form_name
+            for tag, text in [('formDateField', form_name + '_lbdtc'),
+                              ('formCompletedFieldName',
+                               form_name + '_complete'),
+                              ('formImportedFieldName',
+                               form_name + '_nximport'),
+                              ('formCompletedFieldValue', '2'),
+                              ('formImportedFieldValue', 'Y')]:
+                etree.SubElement(form, tag).text = text
+            for event_name in self.events:
+                event = etree.SubElement(form, 'event')
+                etree.SubElement(event, 'name').text = event_name
+        write(root, path)
+
+    def write_translation_table(self, path):
+        root = etree.Element('rediFieldMap')
+        for form_name in self.forms:
+            for component_id in self.components[form_name]:
+                component = etree.SubElement(root, 'clinicalComponent')
+                value, units, status = self.component_fields(component_id)
+                for tag, text in [('loinc_code', 'L' + component_id),
+                                  ('clinicalComponentName',
+                                   'Component ' + component_id),
+                                  ('redcapFormName', form_name),
+                                  ('redcapFieldNameValue', value),
+                                  ('redcapFieldNameUnits', units),
+                                  ('redcapStatusFieldName', status),
+                                  ('redcapStatusFieldValue', 'NOT_DONE')]:
+                    etree.SubElement(component, tag).text = text
+        write(root, path)
+
+    def write_component_to_loinc_code(self, path):
+        root = etree.Element('clinical_datum')
+        etree.SubElement(root, 'version').text = '1.0'
+        etree.SubElement(root, 'Description').text = \
+            'Generated mapping of component ids to LOINC codes'
+        components = etree.SubElement(root, 'components')
+        for form_name in self.forms:
+            for component_id in self.components[form_name]:
+                component = etree.SubElement(components, 'component')
+                etree.SubElement(component, 'description').text = \
+                    'Component ' + component_id
+                for parent, name, value in [
+                        ('source', 'COMPONENT_ID', component_id),
+                        ('target', 'loinc_code', 'L' + component_id)]:
+                    element = etree.SubElement(component, parent)
+                    etree.SubElement(element, 'name').text = name
+                    etree.SubElement(element, 'value').text = value
+        write(root, path)
+
+
+def write(root, path):
+    etree.ElementTree(root).write(path, encoding='utf-8',
+                                  xml_declaration=True, pretty_print=True)
+
+
+def write_static_files(directory):
+    root = etree.Element('rediFieldMap')
+    for source, target in [('ORD_VALUE', 'RESULT'),
+                           ('UNIT', 'REFERENCE_UNIT')]:
+        field = etree.SubElement(root, 'field')
+        etree.SubElement(field, 'source').text = source
+        etree.SubElement(field, 'target').text = target
+    write(root, os.path.join(directory, 'replace_fields_in_raw_data.xml'))
+
+    root = etree.Element('subject_id_field_mapping')
+    etree.SubElement(root, 'redcap_id_field_name').text = 'dm_subjid'
+    etree.SubElement(root, 'research_id_field_name').text = 'dm_usubjid'
+    write(root, os.path.join(directory, 'research_id_to_redcap_id_map.xml'))
+
+
+def generate_results(project, subjects, results, seed):
+    """
+    Yield the raw data rows of every subject as lists in the order of
+    RAW_FIELDS.
+
+    Every subject has as many visit days as the forms have events. Each
+    result is taken on one of the visit days for a component of one of the
+    forms, so the results of a form on the same day belong to one event.
+    About one in fifty results has no value and one in a hundred is for a
+    component which is not mapped to a LOINC code.
+    """
+    generator = random.Random(seed)
+    start = datetime.datetime(2014, 1, 1)
+    for subject in range(subjects):
+        study_id = str(1000 + subject)
+        days = sorted(generator.sample(range(365), len(project.events)))
+        for result in range(results):
+            day = start + datetime.timedelta(
+                days=generator.choice(days),
+                minutes=generator.randrange(8 * 60, 18 * 60))
+            if generator.random() < 0.01:
+                component_id = '9%03d' % generator.randrange(1000)
+            else:
+                form_name = generator.choice(project.forms)
+                component_id = generator.choice(
+                    project.components[form_name])
+            if generator.random() < 0.02:
+                value = ''
+            else:
+                value = '%.1f' % generator.uniform(0.1, 500)
+            yield [study_id, component_id, value, generator.choice(UNITS),
+                   day.strftime('%Y-%m-%d %H:%M:%S'),
+                   (day + datetime.timedelta(days=1)).strftime(
+                       '%Y-%m-%d 00:00:00'),
+                   day.strftime('%H:%M')]
+
+
+def write_raw_xml(rows, path):
+    with open(path, 'w') as raw:
+        raw.write('<?xml version="1.0" encoding="utf8"?>\n<study>\n')
+        for row in rows:
+            subject = etree.Element('subject')
+            for name, value in zip(RAW_FIELDS, row):
+                etree.SubElement(subject, name).text = value or None
+            raw.write(etree.tostring(subject) + '\n')
+        raw.write('</study>\n')
+
+
+def write_raw_csv(rows, path):
+    with open(path, 'wb') as raw:
+        writer = csv.writer(raw, quoting=csv.QUOTE_ALL)
+        writer.writerow(RAW_FIELDS)
+        writer.writerows(rows)
+
+
+def generate(directory, subjects=100, results=30, forms=3, events=10,
+             components=5, raw_data_format='xml', seed=1):
+    """
+    Write the settings.ini, the configuration files and the raw data of a
+    generated project to `directory`
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    project = Project(forms, events, components)
+    project.write_form_events(os.path.join(directory, 'formEvents.xml'))
+    project.write_translation_table(
+        os.path.join(directory, 'translationTable.xml'))
+    project.write_component_to_loinc_code(
+        os.path.join(directory, 'clinical-component-to-loinc.xml'))
+    write_static_files(directory)
+    with open(os.path.join(directory, 'settings.ini'), 'w') as settings:
+        settings.write(SETTINGS.format(raw_data_format=raw_data_format))
+
+    rows = generate_results(project, subjects, results, seed)
+    if raw_data_format == 'csv':
+        write_raw_csv(rows, os.path.join(directory, 'raw.txt'))
+    else:
+        write_raw_xml(rows, os.path.join(directory, 'raw.xml'))
+
+
+def add_scale_arguments(parser):
+    parser.add_argument('--subjects', type=int, default=100,
+                        help='number of subjects (default: %(default)s)')
+    parser.add_argument('--results', type=int, default=30,
+                        help='results per subject (default: %(default)s)')
+    parser.add_argument('--forms', type=int, default=3,
+                        help='forms of the project (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=10,
+                        help='events of every form (default: %(default)s)')
+    parser.add_argument('--components', type=int, default=5,
+                        help='clinical components of every form '
+                             '(default: %(default)s)')
+    parser.add_argument('--format', dest='raw_data_format', default='xml',
+                        choices=['xml', 'csv'],
+                        help='write raw.xml or the EMR csv file raw.txt '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the random data (default: %(default)s)')
+
+
+def main():
+    """ Main entry point """
+    parser = argparse.ArgumentParser(
+        description='Generates the raw data and configuration files of a '
+                    'synthetic redi project for benchmarking')
+    parser.add_argument('directory',
+                        help='configuration directory to write the files to')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    generate(args.directory, args.subjects, args.results, args.forms,
+             args.events, args.components, args.raw_data_format, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+""" A local HTTP server which answers the REDCap API calls redi makes, so
+the upload and the research id lookup can be load tested on one machine """
+
+import argparse
+import BaseHTTPServer
+import collections
+import csv
+import json
+import os
+import random
+import signal
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bin'))
+import utils.SimpleConfigParser as SimpleConfigParser
+
+REDCAP_VERSION = '6.0.0'
+
+
+def metadata_field(field_name, form_name):
+    return {'field_name': field_name,
+            'form_name': form_name,
+            'field_label': field_name,
+            'field_type': 'text',
+            'section_header': '',
+            'select_choices_or_calculations': '',
+            'field_note': '',
+            'text_validation_type_or_show_slider_number': '',
+            'required_field': ''}
+
+
+def metadata_from_config(configuration_directory):
+    """
+    Return the metadata and the form event mapping of the REDCap project a
+    redi configuration directory uploads to.
+
+    The record id field and the research id field of the research id map
+    are on the form `demographics`. Every form of formEvents.xml holds its
+    date, imported and clinical component fields.
+    """
+    settings = SimpleConfigParser.SimpleConfigParser()
+    settings.read(os.path.join(configuration_directory, 'settings.ini'))
+    settings.set_attributes()
+
+    id_map = etree.parse(os.path.join(configuration_directory,
+                                      settings.research_id_to_redcap_id))
+    metadata = [metadata_field(id_map.findtext('redcap_id_field_name'),
+                               'demographics'),
+                metadata_field(id_map.findtext('research_id_field_name'),
+                               'demographics')]
+    form_events = []
+
+    translation_table = etree.parse(os.path.join(
+        configuration_directory, settings.translation_table_file))
+    form_fields = collections.defaultdict(list)
+    for component in translation_table.iter('clinicalComponent'):
+        form_fields[component.findtext('redcapFormName')].extend(
+            component.findtext(tag) for tag in
+            ('redcapFieldNameValue', 'redcapFieldNameUnits',
+             'redcapStatusFieldName') if component.findtext(tag))
+
+    form_events_tree = etree.parse(os.path.join(configuration_directory,
+                                                settings.form_events_file))
+    for form in form_events_tree.iter('form'):
+        form_name = form.findtext('name')
+        fields = [form.findtext(tag) for tag in
+                  ('formDateField', 'formImportedFieldName',
+                   'formCompletedFieldName') if form.findtext(tag)]
+        fields.extend(form_fields[form_name])
+        for field_name in fields:
+            # REDCap adds the <form>_complete field of every form itself
+            if field_name != form_name + '_complete':
+                metadata.append(metadata_field(field_name, form_name))
+        form_events.extend((form_name, event) for event in
+                           form.xpath('event/name/text()'))
+    return metadata, form_events
+
+
+class RedcapStandIn(object):
+    """
+    Keeps the records of one longitudinal REDCap project in memory and
+    answers the API requests for it.
+
+    Every request waits `latency` seconds, plus `latency_per_record` seconds
+    for every row it imports or exports. With `rate_limit` set, the requests
+    after `rate_limit` in a minute are refused with status 429. A fraction
+    `error_rate` of the record requests fails with status 500.
+    """
+
+    def __init__(self, metadata, form_events, token=None, latency=0,
+                 latency_per_record=0, rate_limit=None, error_rate=0,
+                 seed=None):
+        if not metadata:
+            raise Exception('The project of the REDCap stand-in has no fields')
+        self.metadata = metadata
+        self.def_field = metadata[0]['field_name']
+        self.form_events = form_events
+        self.events = []
+        for _, event in form_events:
+            if event not in self.events:
+                self.events.append(event)
+
+        self.forms = []
+        self.form_fields = collections.defaultdict(list)
+        for field in metadata:
+            if field['form_name'] not in self.forms:
+                self.forms.append(field['form_name'])
+            self.form_fields[field['form_name']].append(field['field_name'])
+        for form in self.forms:
+            self.form_fields[form].append(form + '_complete')
+        self.field_names = [name for form in self.forms
+                            for name in self.form_fields[form]]
+
+        self.token = token
+        self.latency = latency
+        self.latency_per_record = latency_per_record
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = collections.deque()
+        self.records = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def load(self, path):
+        """ Store the rows of the JSON file `path` """
+        with open(path) as fp:
+            self.store(json.load(fp), overwrite=True)
+
+    def save(self, path):
+        """ Write the stored rows to the JSON file `path` """
+        with self.lock:
+            rows = [self.export_row(record, event, values, self.field_names)
+                    for (record, event), values in self.records.iteritems()]
+        with open(path, 'w') as fp:
+            json.dump(rows, fp, indent=1)
+
+    def handle(self, params):
+        """
+        Answer the request with the POST parameters `params` and return the
+        status, content type and body of the response
+        """
+        content = params.get('content')
+        self.count(content)
+        if self.token is not None and params.get('token') != self.token:
+            return error(403, 'You do not have permissions to use the API')
+        if not self.admit():
+            return error(429, 'You have exceeded the maximum number of API '
+                              'requests per minute')
+
+        if content == 'record':
+            if self.random.random() < self.error_rate:
+                self.count('injected errors')
+                time.sleep(self.latency)
+                return error(500, 'Injected error of the REDCap stand-in')
+            if 'data' in params:
+                response, rows = self.import_records(params)
+            else:
+                response, rows = self.export_records(params)
+        else:
+            response, rows = self.project_info(content, params), 0
+        time.sleep(self.latency + self.latency_per_record * rows)
+        return response
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def admit(self):
+        """ Return False if the request exceeds the rate limit """
+        if not self.rate_limit:
+            return True
+        now = time.time()
+        with self.lock:
+            while self.requests and self.requests[0] <= now - 60:
+                self.requests.popleft()
+            if len(self.requests) >= self.rate_limit:
+                self.counts['rate limited'] += 1
+                return False
+            self.requests.append(now)
+        return True
+
+    def project_info(self, content, params):
+        if content == 'metadata':
+            return respond(self.metadata, params.get('format'))
+        if content == 'exportFieldNames':
+            return respond([{'original_field_name': name,
+                             'choice_value': '',
+                             'export_field_name': name}
+                            for name in self.field_names],
+                           params.get('format'))
+        if content == 'version':
+            return 200, 'text/plain', REDCAP_VERSION
+        if content == 'project':
+            return respond({'project_id': 1,
+                            'project_title': 'REDCap stand-in',
+                            'is_longitudinal': 1 if self.events else 0,
+                            'record_autonumbering_enabled': 0,
+                            'in_production': 0}, params.get('format'))
+        if content in ('event', 'arm', 'formEventMapping') and \
+                not self.events:
+            return error(400, 'You cannot export arms, events or form event '
+                              'mappings for classic projects')
+        if content == 'event':
+            return respond([{'event_name': event, 'arm_num': 1,
+                             'unique_event_name': event, 'day_offset': 0,
+                             'offset_min': 0, 'offset_max': 0}
+                            for event in self.events], params.get('format'))
+        if content == 'arm':
+            return respond([{'arm_num': 1, 'name': 'Arm 1'}],
+                           params.get('format'))
+        if content == 'formEventMapping':
+            return respond([{'arm_num': 1, 'form': form,
+                             'unique_event_name': event}
+                            for form, event in self.form_events],
+                           params.get('format'))
+        return error(400, 'The value of the parameter "content" is not valid')
+
+    def import_records(self, params):
+        data_format = params.get('format', 'json')
+        if data_format == 'json':
+            rows = json.loads(params['data'])
+        elif data_format == 'csv':
+            rows = list(csv.DictReader(StringIO.StringIO(params['data'])))
+        else:
+            return error(400, 'The stand-in imports json and csv only'), 0
+
+        known = set(self.field_names)
+        unknown = set()
+        for row in rows:
+            unknown.update(name for name in row if name not in known and
+                           name != 'redcap_event_name')
+        if unknown:
+            return error(400, 'The following fields were not found in the '
+                              'project as real data fields: ' +
+                              ', '.join(sorted(unknown))), len(rows)
+        bad_events = set(row.get('redcap_event_name') for row in rows
+                         if row.get('redcap_event_name') not in self.events)
+        if self.events and bad_events:
+            return error(400, 'The following values are not valid unique '
+                              'event names: ' +
+                              ', '.join(sorted(map(str, bad_events)))), \
+                len(rows)
+
+        records = self.store(rows, params.get('overwriteBehavior') ==
+                             'overwrite')
+        return_content = params.get('returnContent', 'count')
+        if return_content == 'ids':
+            body = records
+        elif return_content == 'nothing':
+            return (200, 'text/plain', ''), len(rows)
+        else:
+            body = {'count': len(records)}
+        return respond(body, params.get('returnFormat', 'json')), len(rows)
+
+    def store(self, rows, overwrite=False):
+        """
+        Store `rows` and return their record ids. Blank values only erase
+        stored values with `overwrite`.
+        """
+        records = []
+        with self.lock:
+            for row in rows:
+                record = unicode(row[self.def_field])
+                key = (record, row.get('redcap_event_name', ''))
+                values = self.records.setdefault(key, {})
+                for name, value in row.iteritems():
+                    if name in (self.def_field, 'redcap_event_name'):
+                        continue
+                    value = unicode(value)
+                    if value or overwrite:
+                        values[name] = value
+                if record not in records:
+                    records.append(record)
+        return records
+
+    def export_records(self, params):
+        fields = split(params.get('fields'))
+        for form in split(params.get('forms')):
+            fields.extend(self.form_fields[form])
+        if fields:
+            # the record id field is always exported
+            fields = [name for name in self.field_names
+                      if name in fields or name == self.def_field]
+        else:
+            fields = self.field_names
+        records = set(split(params.get('records')))
+        events = set(split(params.get('events')))
+
+        with self.lock:
+            rows = [self.export_row(record, event, values, fields)
+                    for (record, event), values in self.records.iteritems()
+                    if (not records or record in records) and
+                    (not events or event in events)]
+        return respond(rows, params.get('format', 'json'),
+                       self.export_columns(fields)), len(rows)
+
+    def export_columns(self, fields):
+        columns = list(fields)
+        if self.events:
+            columns.insert(1, 'redcap_event_name')
+        return columns
+
+    def export_row(self, record, event, values, fields):
+        row = collections.OrderedDict()
+        for name in self.export_columns(fields):
+            if name == self.def_field:
+                row[name] = record
+            elif name == 'redcap_event_name':
+                row[name] = event
+            else:
+                row[name] = values.get(name, '')
+        return row
+
+
+def split(value):
+    return [item for item in (value or '').split(',') if item]
+
+
+def error(status, message):
+    return status, 'application/json', json.dumps({'error': message})
+
+
+def respond(data, data_format, columns=None):
+    """ Return a response with `data` encoded as json, xml or csv """
+    if data_format == 'json' or data_format is None:
+        return 200, 'application/json', json.dumps(data)
+
+    rows = data if isinstance(data, list) else [data]
+    if columns is None:
+        columns = []
+        for row in rows:
+            columns.extend(name for name in row if name not in columns)
+    if data_format == 'xml':
+        root = etree.Element('records')
+        for row in rows:
+            item = etree.SubElement(root, 'item')
+            for name in columns:
+                etree.SubElement(item, name).text = unicode(row.get(name, ''))
+        return 200, 'text/xml', etree.tostring(
+            root, encoding='UTF-8', xml_declaration=True)
+    if data_format == 'csv':
+        body = StringIO.StringIO()
+        writer = csv.writer(body)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([unicode(row.get(name, '')).encode('utf-8')
+                             for name in columns])
+        return 200, 'text/csv', body.getvalue()
+    return error(400, 'The value of the parameter "format" is not valid')
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        params = dict((name, values[-1]) for name, values in
+                      urlparse.parse_qs(self.rfile.read(length),
+                                        keep_blank_values=True).iteritems())
+        # PyCap sends the lists of export_records() as name=a,b and the
+        # REDCap API also takes them as name[0]=a&name[1]=b
+        for name in ('records', 'fields', 'forms', 'events'):
+            items = sorted((int(key[len(name) + 1:-1]), value)
+                           for key, value in params.items()
+                           if key.startswith(name + '[') and
+                           key[len(name) + 1:-1].isdigit())
+            if items:
+                params[name] = ','.join(value for _, value in items)
+        status, content_type, body = self.server.stand_in.handle(params)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, stand_in, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.stand_in = stand_in
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}/api/'.format(host, port)
+
+
+def main():
+    """ Main entry point """
+    parser = argparse.ArgumentParser(
+        description='Serves the REDCap API calls redi makes for a project '
+                    'kept in memory')
+    project = parser.add_mutually_exclusive_group(required=True)
+    project.add_argument('--config',
+                         help='redi configuration directory; the fields and '
+                              'events of the project are taken from its '
+                              'translation table, formEvents.xml and '
+                              'research id map')
+    project.add_argument('--metadata',
+                         help='JSON file with the metadata export of a '
+                              'REDCap project')
+    parser.add_argument('--event', action='append', default=[],
+                        help='unique event name of the project given with '
+                             '--metadata; can be repeated')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on, 0 for any free port '
+                             '(default: %(default)s)')
+    parser.add_argument('--token',
+                        help='the only API token accepted; by default any '
+                             'token is')
+    parser.add_argument('--storage',
+                        help='JSON file the records are read from at start '
+                             'and written to at exit')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds every request takes '
+                             '(default: %(default)s)')
+    parser.add_argument('--latency-per-record', type=float, default=0,
+                        help='seconds added for every imported or exported '
+                             'row (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=int,
+                        help='requests per minute; the requests over it are '
+                             'refused with status 429')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of the record requests which fail '
+                             'with status 500 (default: %(default)s)')
+    parser.add_argument('--seed', type=int,
+                        help='seed of the injected errors')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+
+    if args.config:
+        metadata, form_events = metadata_from_config(args.config)
+    else:
+        with open(args.metadata) as fp:
+            metadata = json.load(fp)
+        forms = []
+        for field in metadata:
+            if field['form_name'] not in forms:
+                forms.append(field['form_name'])
+        form_events = [(form, event) for event in args.event
+                       for form in forms]
+    stand_in = RedcapStandIn(metadata, form_events, args.token, args.latency,
+                             args.latency_per_record, args.rate_limit,
+                             args.error_rate, args.seed)
+    if args.storage and os.path.exists(args.storage):
+        stand_in.load(args.storage)
+
+    server = StandInServer((args.host, args.port), stand_in, args.verbose)
+    # stop serving on SIGTERM as on Ctrl-C, so the records are saved
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print "REDCap stand-in listening on {0}".format(server.url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.storage:
+            stand_in.save(args.storage)
+        print "requests: {0}".format(', '.join(
+            '{0} {1}'.format(name, count) for name, count in
+            sorted(stand_in.counts.items())))
+
+
+if __name__ == '__main__':
+    main()
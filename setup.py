@@ -38,6 +38,9 @@ setup(
         "PyCap >= 1.0",
         "pysftp >= 0.2.8",
     ],
+    extras_require={
+        'columnar': ["numpy"],
+    },
     entry_points={
         'console_scripts': [
             'redi = bin.redi:main',
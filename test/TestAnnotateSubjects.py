@@ -0,0 +1,81 @@
+'''
+This file tests that annotate_subjects sets the same values as the separate
+lookup stages it replaces
+
+'''
+import unittest
+import os
+from lxml import etree
+import redi
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+goal_dir = os.path.join(file_dir, "../")
+proj_root = os.path.abspath(goal_dir)+'/'
+
+DEFAULT_DATA_DIRECTORY = os.getcwd()
+
+
+class TestAnnotateSubjects(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(DEFAULT_DATA_DIRECTORY)
+        subjects = ''
+        for loinc_code in ['26464-8', '26499-4', '785-6', '11111-1', '',
+                           None]:
+            subjects += '<subject><STUDY_ID>22</STUDY_ID>'
+            if loinc_code is not None:
+                subjects += '<loinc_code>%s</loinc_code>' % loinc_code
+            subjects += '</subject>'
+        self.raw_xml = '<study>%s</study>' % subjects
+
+        self.form_events_tree = etree.parse(
+            os.path.join(proj_root, 'config-example/formEvents.xml'))
+        self.translation_table_tree = etree.parse(
+            os.path.join(proj_root, 'config-example/translationTable.xml'))
+        self.lookups = redi.ConfigLookups(
+            self.form_events_tree, self.translation_table_tree,
+            etree.ElementTree(etree.fromstring(
+                '<clinical_datum><components/></clinical_datum>')))
+
+    def raw_data(self):
+        data = etree.ElementTree(etree.fromstring(self.raw_xml))
+        redi.add_elements_to_tree(data)
+        return data
+
+    def test_annotate_subjects(self):
+        expected = self.raw_data()
+        redi.update_redcap_form(
+            expected, self.translation_table_tree, 'undefined')
+        redi.update_form_imported_field(
+            expected, self.form_events_tree, 'undefined')
+        redi.update_recap_form_status(
+            expected, self.translation_table_tree, 'undefined')
+        redi.update_formdatefield(expected, self.form_events_tree)
+        redi.update_formcompletedfieldname(
+            expected, self.form_events_tree, 'undefined')
+        redi.update_redcap_field_name_value_and_units(
+            expected, self.translation_table_tree, 'undefined')
+
+        data = self.raw_data()
+        redi.annotate_subjects(
+            data, self.lookups.components, self.lookups.forms, 'undefined')
+
+        self.assertEqual(etree.tostring(expected), etree.tostring(data))
+        cbc = data.getroot()[0]
+        self.assertEqual('cbc', cbc.findtext('redcapFormName'))
+        self.assertEqual('cbc_lbdtc', cbc.findtext('formDateField'))
+        unknown = data.getroot()[3]
+        self.assertEqual('undefined', unknown.findtext('formDateField'))
+        self.assertEqual('redcapFieldNameUnitsUndefined',
+                         unknown.findtext('redcapFieldNameUnits'))
+
+    def test_annotate_subjects_without_derived_elements(self):
+        data = etree.ElementTree(etree.fromstring(self.raw_xml))
+        redi.annotate_subjects(
+            data, self.lookups.components, self.lookups.forms, 'undefined')
+        self.assertEqual(etree.tostring(etree.fromstring(self.raw_xml)),
+                         etree.tostring(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+'''
+This file tests the non-blocking REDCap client in bin/utils/redcapClient.py
+
+'''
+import unittest
+import threading
+import time
+from redcap import RedcapError
+from utils.redcapClient import asyncRedcapClient
+
+
+class MockClient(object):
+    project = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.imported = []
+
+    def send_data_to_redcap(self, data, overwrite=False):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+            self.imported.extend(data)
+        if data == ['bad']:
+            raise RedcapError('rejected')
+        return {'count': len(data)}
+
+    def get_data_from_redcap(self, records_to_fetch=None, fields_to_fetch=None,
+                             **kwargs):
+        return '<records>%s</records>' % ','.join(fields_to_fetch)
+
+
+class TestAsyncRedcapClient(unittest.TestCase):
+
+    def test_import_records(self):
+        client = MockClient()
+        with asyncRedcapClient(client, max_in_flight=3) as async_client:
+            futures = [async_client.import_records([number])
+                       for number in range(12)]
+            self.assertEqual([{'count': 1}] * 12,
+                             [future.result() for future in futures])
+        self.assertEqual(range(12), sorted(client.imported))
+        self.assertTrue(1 < client.most_in_flight <= 3)
+
+    def test_errors_and_callbacks(self):
+        client = MockClient()
+        finished = []
+        with asyncRedcapClient(client, max_in_flight=2) as async_client:
+            bad = async_client.import_records(['bad'])
+            bad.add_done_callback(finished.append)
+            export = async_client.export_records(fields_to_fetch=['a', 'b'])
+            self.assertEqual('<records>a,b</records>', export.result())
+            self.assertRaises(RedcapError, bad.result)
+            self.assertTrue(isinstance(bad.exception(), RedcapError))
+        self.assertEqual([bad], finished)
+
+        # a callback added after the request finished is called right away
+        bad.add_done_callback(finished.append)
+        self.assertEqual([bad, bad], finished)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+This file tests the compiled configuration lookups and their cache
+
+'''
+import unittest
+import os
+import shutil
+import tempfile
+from mock import patch
+import redi
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+goal_dir = os.path.join(file_dir, "../")
+proj_root = os.path.abspath(goal_dir)+'/'
+
+DEFAULT_DATA_DIRECTORY = os.getcwd()
+
+
+class TestConfigLookups(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(DEFAULT_DATA_DIRECTORY)
+        self.temp_dir = tempfile.mkdtemp()
+        for name in ['formEvents.xml', 'translationTable.xml']:
+            shutil.copy(os.path.join(proj_root, 'config-example', name),
+                        self.temp_dir)
+        with open(os.path.join(self.temp_dir, 'loinc.xml'), 'w') as mapping:
+            mapping.write("""<?xml version='1.0' encoding='US-ASCII'?>
+<clinical_datum>
+    <version>0.1.0</version>
+    <Description>Test Description</Description>
+    <components>
+        <component>
+            <description>Test Component 1</description>
+            <source>
+                <name>COMPONENT_ID</name>
+                <value>8675309</value>
+            </source>
+            <target>
+                <name>loinc_code</name>
+                <value>26464-8</value>
+            </target>
+        </component>
+    </components>
+</clinical_datum>
+""")
+        self.files = [
+            os.path.join(self.temp_dir, 'formEvents.xml'),
+            os.path.join(self.temp_dir, 'translationTable.xml'),
+            os.path.join(self.temp_dir, 'loinc.xml'),
+            os.path.join(proj_root,
+                         'bin/utils/component_id_to_loinc_code.xsd')]
+        self.cache_file = redi.get_config_cache_path(
+            os.path.join(self.temp_dir, 'redi.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_compiled_lookups(self):
+        lookups = redi.load_config_lookups(self.cache_file, *self.files)
+
+        self.assertEqual('cbc', lookups.components['26464-8']['redcapFormName'])
+        self.assertEqual('wbc_lborres',
+            lookups.components['26464-8']['redcapFieldNameValue'])
+        self.assertEqual('cbc_lbdtc', lookups.forms['cbc']['formDateField'])
+        self.assertEqual('Y', lookups.forms['cbc']['formImportedFieldValue'])
+        self.assertEqual(['%d_arm_1' % i for i in range(1, 11)],
+                         lookups.form_events['cbc'])
+        self.assertTrue('cbc_complete' in lookups.form_fields['cbc'])
+        self.assertTrue('wbc_lbstat' in lookups.form_fields['cbc'])
+        self.assertEqual(
+            ('COMPONENT_ID', '8675309', 'loinc_code', '26464-8'),
+            lookups.component_to_loinc_code[0])
+        self.assertEqual(10, len(lookups.all_form_events_tree().findall(
+            'form/event')))
+
+    def test_cache_is_reused_while_files_are_unchanged(self):
+        redi.load_config_lookups(self.cache_file, *self.files)
+        self.assertTrue(os.path.exists(self.cache_file))
+
+        with patch.object(redi, 'compile_config_lookups') as compiler:
+            lookups = redi.load_config_lookups(self.cache_file, *self.files)
+            self.assertFalse(compiler.called)
+        self.assertEqual('cbc', lookups.components['26464-8']['redcapFormName'])
+
+    def test_cache_is_rebuilt_when_a_file_changes(self):
+        redi.load_config_lookups(self.cache_file, *self.files)
+
+        with open(self.files[1]) as table:
+            content = table.read()
+        with open(self.files[1], 'w') as table:
+            table.write(content.replace('wbc_lborres', 'wbc_result'))
+
+        lookups = redi.load_config_lookups(self.cache_file, *self.files)
+        self.assertEqual('wbc_result',
+            lookups.components['26464-8']['redcapFieldNameValue'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ This file tests for the function parse_raw_xml
 '''
 import unittest
 import os
+from collections import Counter
 from lxml import etree
 import redi
 
@@ -135,6 +136,41 @@ class TestConvertComponentIdToLoincCode(unittest.TestCase):
     
         self.assertRaises(Exception,redi.convert_component_id_to_loinc_code,self.rawxmlDataTree, self.mapxmlDataTree)
                 
+    def test_convert_component_id_to_loinc_code_reports_unmapped(self):
+        mapping = """<clinical_datum><components>
+    <component>
+        <source><name>Comp_id</name><value>123</value></source>
+        <target><name>lcode</name><value>456</value></target>
+    </component>
+</components></clinical_datum>"""
+        raw = """<study>
+    <subject><Comp_id>123</Comp_id></subject>
+    <subject><Comp_id>999</Comp_id></subject>
+    <subject><Comp_id>999</Comp_id></subject>
+    <subject><Comp_id>888</Comp_id></subject>
+</study>"""
+        data = etree.ElementTree(etree.fromstring(raw))
+        unmapped = Counter()
+        redi.convert_component_id_to_loinc_code(
+            data, etree.ElementTree(etree.fromstring(mapping)), unmapped)
+
+        self.assertEqual(['lcode', 'Comp_id', 'Comp_id', 'Comp_id'],
+                         [subject[0].tag for subject in data.getroot()])
+        self.assertEqual({('Comp_id', '999'): 2, ('Comp_id', '888'): 1},
+                         dict(unmapped))
+
+    def test_compile_component_to_loinc_code_follows_chains(self):
+        mapping = redi.compile_component_to_loinc_code([
+            ('Comp_id', '1', 'Comp_id', '2'),
+            ('Comp_id', '2', 'lcode', '20'),
+            ('Comp_id', '3', 'lcode', '30'),
+            ('Comp_id', '3', 'lcode', '31'),
+            ('lcode', '30', 'lcode', '300')])
+
+        self.assertEqual(('lcode', '20'), mapping[('Comp_id', '1')])
+        self.assertEqual(('lcode', '20'), mapping[('Comp_id', '2')])
+        self.assertEqual(('lcode', '300'), mapping[('Comp_id', '3')])
+
     def tearDown(self):
         return()
 
@@ -692,5 +692,119 @@ class TestCopyDataToPersonFormEventTree(unittest.TestCase):
         expect = etree.tostring(etree.fromstring(output))
         self.assertEqual(expect, etree.tostring(result))
 
+    def test_person_form_event_index(self):
+        pfe_tree = etree.ElementTree(etree.fromstring("""<person_form_event>
+    <person><study_id>123</study_id><all_form_events>
+        <form><name>cbc</name>
+            <event><name>1_arm_1</name>
+                <field><name>hemo_lborres</name><value/></field>
+                <field><name>cbc_complete</name><value/></field>
+            </event>
+            <event><name>2_arm_1</name>
+                <field><name>hemo_lborres</name><value>12</value></field>
+            </event>
+        </form>
+    </all_form_events></person>
+</person_form_event>"""))
+        index = redi.PersonFormEventIndex(pfe_tree)
+
+        self.assertEqual([('123', 'cbc')], index.forms.keys())
+        self.assertEqual(['cbc_complete', 'hemo_lborres'],
+                         sorted(index.events[('123', 'cbc', '1_arm_1')]))
+        self.assertEqual('12', index.events[
+            ('123', 'cbc', '2_arm_1')]['hemo_lborres'].text)
+
+        # the index passed in is the one the values are copied through
+        subject = etree.ElementTree(etree.fromstring("""<study><subject>
+    <RESULT>987</RESULT><REFERENCE_UNIT>g/dL</REFERENCE_UNIT>
+    <STUDY_ID>123</STUDY_ID><timestamp>1906-12-25</timestamp>
+    <redcapFormName>cbc</redcapFormName><eventName>1_arm_1</eventName>
+    <formDateField>cbc_lbdtc</formDateField>
+    <formCompletedFieldName>cbc_complete</formCompletedFieldName>
+    <formImportedFieldName>cbc_nximport</formImportedFieldName>
+    <redcapFieldNameValue>hemo_lborres</redcapFieldNameValue>
+    <redcapFieldNameUnits>hemo_lborresu</redcapFieldNameUnits>
+</subject></study>"""))
+        redi.copy_data_to_person_form_event_tree(
+            subject, pfe_tree, self.data_form_event_tree, index)
+        event = index.events[('123', 'cbc', '1_arm_1')]
+        self.assertEqual('987', event['hemo_lborres'].text)
+        self.assertEqual('2', event['cbc_complete'].text)
+
+    def test_sparse_person_form_event_tree(self):
+        template = etree.ElementTree(etree.fromstring("""<all_form_events>
+    <form><name>cbc</name>
+        <event><name>1_arm_1</name>
+            <field><name>hemo_lborres</name><value/></field>
+            <field><name>cbc_complete</name><value/></field>
+        </event>
+        <event><name>2_arm_1</name>
+            <field><name>hemo_lborres</name><value/></field>
+            <field><name>cbc_complete</name><value/></field>
+        </event>
+        <event><name>3_arm_1</name>
+            <field><name>hemo_lborres</name><value/></field>
+            <field><name>cbc_complete</name><value/></field>
+        </event>
+    </form>
+</all_form_events>"""))
+        raw = ''
+        for event_name, result in [('3_arm_1', '11'), ('1_arm_1', '13')]:
+            raw += """<subject>
+    <RESULT>%s</RESULT><REFERENCE_UNIT>g/dL</REFERENCE_UNIT>
+    <STUDY_ID>123</STUDY_ID><timestamp>1906-12-25</timestamp>
+    <redcapFormName>cbc</redcapFormName><eventName>%s</eventName>
+    <formDateField>cbc_lbdtc</formDateField>
+    <formCompletedFieldName>cbc_complete</formCompletedFieldName>
+    <formImportedFieldName>cbc_nximport</formImportedFieldName>
+    <redcapFieldNameValue>hemo_lborres</redcapFieldNameValue>
+    <redcapFieldNameUnits>hemo_lborresu</redcapFieldNameUnits>
+</subject>""" % (result, event_name)
+        data = etree.ElementTree(etree.fromstring('<study>%s</study>' % raw))
+        pfe_tree = redi.create_empty_event_tree_for_study(
+            data, template, sparse=True)
+        self.assertEqual([], pfe_tree.getroot().findall('.//event'))
+
+        index = redi.PersonFormEventIndex(pfe_tree, template)
+        self.assertEqual({}, index.event_fields('123', 'inr', '1_arm_1'))
+        self.assertEqual({}, index.event_fields('123', 'cbc', '9_arm_1'))
+        redi.copy_data_to_person_form_event_tree(
+            data, pfe_tree, self.data_form_event_tree, index)
+
+        events = pfe_tree.getroot().findall('person/all_form_events/form/event')
+        self.assertEqual(['1_arm_1', '3_arm_1'],
+                         [event.findtext('name') for event in events])
+        self.assertEqual(['13', '11'],
+                         [event.findtext("field[name='hemo_lborres']/value")
+                          for event in events])
+        self.assertEqual(['2', '2'],
+                         [event.findtext("field[name='cbc_complete']/value")
+                          for event in events])
+        # the template itself is not changed
+        self.assertEqual(None, template.getroot().find(
+            'form/event/field/value').text)
+
+    def test_sparse_events_are_inserted_in_template_order(self):
+        template = etree.ElementTree(etree.fromstring(
+            '<all_form_events><form><name>cbc</name>%s</form>'
+            '</all_form_events>' % ''.join(
+                '<event><name>%s_arm_1</name></event>' % number
+                for number in range(1, 6))))
+        pfe_tree = etree.ElementTree(etree.fromstring(
+            '<person_form_event><person><study_id>123</study_id>'
+            '<all_form_events><form><name>cbc</name>'
+            '<event><name>unscheduled</name></event>'
+            '<event><name>4_arm_1</name></event>'
+            '</form></all_form_events></person></person_form_event>'))
+
+        index = redi.PersonFormEventIndex(pfe_tree, template)
+        for event_name in ['5_arm_1', '2_arm_1', '1_arm_1', '3_arm_1']:
+            index.event_fields('123', 'cbc', event_name)
+        self.assertEqual(
+            ['unscheduled', '1_arm_1', '2_arm_1', '3_arm_1', '4_arm_1',
+             '5_arm_1'],
+            pfe_tree.getroot().xpath('person/all_form_events/form/event/'
+                                     'name/text()'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -295,6 +295,37 @@ class TestCreateSummaryReport(unittest.TestCase):
 
         self.assertEqual(self.expected_xml, result_string)
 
+    def test_create_summary_report_with_stages(self):
+        self.newpath = proj_root+'config'
+        self.configFolderCreatedNow = False
+        if not os.path.exists(self.newpath):
+            self.configFolderCreatedNow = True
+            os.makedirs(self.newpath)
+
+        self.test_report_data['stages'] = [
+            {'name': 'sort', 'wall_time': 0.5, 'cpu_time': 0.25,
+             'peak_rss_kb': 2048, 'rss_growth_kb': 0, 'rows_in': 10,
+             'rows_out': 10},
+            {'name': 'rules', 'wall_time': 0.1, 'cpu_time': 0.1,
+             'peak_rss_kb': None, 'rss_growth_kb': None, 'rows_in': 4,
+             'rows_out': 4}]
+        result = redi.create_summary_report(self.test_report_params,
+          self.test_report_data,
+          self.test_alert_summary,
+          self.specimen_taken_time_summary)
+
+        stages = result.getroot().findall('stages/stage')
+        self.assertEqual(['sort', 'rules'],
+                         [stage.findtext('name') for stage in stages])
+        self.assertEqual('0.5', stages[0].findtext('wall_time'))
+        self.assertEqual('2048', stages[0].findtext('peak_rss_kb'))
+        self.assertEqual(None, stages[1].find('peak_rss_kb').text)
+
+        transform = etree.XSLT(etree.parse(proj_root + 'bin/utils/report.xsl'))
+        html_str = etree.tostring(transform(result), method='html')
+        self.assertIn('<h3>Stages</h3>', html_str)
+        self.assertIn('<td>rules</td>', html_str)
+
     def tearDown(self):
     	# delete the created xml file
         with open(proj_root + 'config/report.xml'):
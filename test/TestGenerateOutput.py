@@ -14,11 +14,15 @@ __email__       = "asura@ufl.edu"
 __status__      = "Development"
 
 import unittest
+import json
 import logging
 import os
 import tempfile
+import threading
+import time
 from lxml import etree
 from mock import patch
+from redcap import RedcapError
 import redi
 import redi_lib
 from utils.redcapClient import redcapClient
@@ -30,6 +34,20 @@ proj_root = os.path.abspath(goal_dir)+'/'
 
 DEFAULT_DATA_DIRECTORY = os.getcwd()
 
+
+class MockDataRepository(object):
+    """ Counts the stores and keeps the event statuses saved with them """
+    def __init__(self):
+        self.stored = 0
+        self.statuses = []
+
+    def store(self, data):
+        self.stored += 1
+
+    def store_statuses(self, data, statuses):
+        self.statuses.extend(statuses)
+        self.store(data)
+
 class TestGenerateOutput(unittest.TestCase):
     
     def setUp(self):
@@ -189,10 +207,6 @@ class TestGenerateOutput(unittest.TestCase):
             'redcap_support_receiver_email': 'please-do-not-reply@example.com'
         }
 
-        class MockDataRepository(object):
-            def store(self, data):
-                pass
-
         etree_1 = etree.ElementTree(etree.fromstring(string_1_xml))
         result = redi_lib.generate_output(etree_1, redcap_settings, email_settings, MockDataRepository())
         self.assertEqual(report_data['total_subjects'], result['total_subjects'])
@@ -200,6 +214,261 @@ class TestGenerateOutput(unittest.TestCase):
         self.assertEqual(report_data['subject_details'], result['subject_details'])
         self.assertEqual(report_data['errors'], result['errors'])
 
+    def batch_person_tree(self):
+        events = ''
+        for number in range(1, 6):
+            events += """<event><name>%d_arm_1</name><status>unsent</status>
+    <field><name>cbc_lbdtc</name><value>1905-10-0%d</value></field>
+</event>""" % (number, number)
+        return etree.ElementTree(etree.fromstring("""<person_form_event>
+    <person><study_id>100</study_id><all_form_events>
+        <form><name>cbc</name>%s</form>
+    </all_form_events></person>
+    <person><study_id>99</study_id><all_form_events>
+        <form><name>cbc</name>%s</form>
+    </all_form_events></person>
+</person_form_event>""" % (events, events)))
+
+    def test_batched_imports(self):
+        requests = []
+
+        def send_data_to_redcap(client, data, overwrite=False):
+            requests.append(data)
+
+        redcap_settings = {
+            'rate_limiter_value_in_redcap': 60000,
+            'redcap_uri': 'http://fakeURI:fakeport/',
+            'token': 'faketoken',
+            'verify_ssl': False,
+            'redcap_batch_rows': 4,
+            'redcap_batch_bytes': 0
+        }
+        person_tree = self.batch_person_tree()
+        repository = MockDataRepository()
+        with patch.multiple(redcapClient,
+                            __init__=self.dummy_redcapClient_initializer,
+                            project=self.dummyClass(),
+                            send_data_to_redcap=send_data_to_redcap):
+            result = redi_lib.generate_output(
+                person_tree, redcap_settings, {}, repository)
+
+        # the rows of both persons are packed into the same requests
+        self.assertEqual([4, 4, 2], [len(data) for data in requests])
+        self.assertEqual(['100', '100', '100', '100'],
+                         [row['test'] for row in requests[0]])
+        self.assertEqual(['100', '99', '99', '99'],
+                         [row['test'] for row in requests[1]])
+        self.assertEqual(3, repository.stored)
+        self.assertEqual(10, len(repository.statuses))
+        self.assertEqual(10, len(person_tree.xpath("//status[.='sent']")))
+        self.assertEqual({'Total_cbc_Forms': 10}, result['form_details'])
+
+        # the payload cap closes a batch before it is full
+        requests[:] = []
+        event = person_tree.getroot().find(
+            'person/all_form_events/form/event')
+        row = redi_lib.create_import_data_json({'test': '100'}, event)
+        row_size = len(json.dumps(row['json_data']))
+        redcap_settings['redcap_batch_bytes'] = 2 * (row_size + 2)
+        person_tree = self.batch_person_tree()
+        with patch.multiple(redcapClient,
+                            __init__=self.dummy_redcapClient_initializer,
+                            project=self.dummyClass(),
+                            send_data_to_redcap=send_data_to_redcap):
+            redi_lib.generate_output(
+                person_tree, redcap_settings, {}, MockDataRepository())
+        self.assertEqual([2, 2, 2, 2, 2], [len(data) for data in requests])
+
+    def test_failed_batch_stays_unsent(self):
+        def send_data_to_redcap(client, data, overwrite=False):
+            if data[0]['test'] == '99':
+                raise RedcapError("{'error': 'no', 'records': []}")
+
+        redcap_settings = {
+            'rate_limiter_value_in_redcap': 60000,
+            'redcap_uri': 'http://fakeURI:fakeport/',
+            'token': 'faketoken',
+            'verify_ssl': False,
+            'redcap_batch_rows': 5
+        }
+        person_tree = self.batch_person_tree()
+        with patch.multiple(redcapClient,
+                            __init__=self.dummy_redcapClient_initializer,
+                            project=self.dummyClass(),
+                            send_data_to_redcap=send_data_to_redcap):
+            result = redi_lib.generate_output(
+                person_tree, redcap_settings, {}, MockDataRepository())
+
+        statuses = [person.xpath('.//status/text()')
+                    for person in person_tree.getroot()]
+        self.assertEqual([['sent'] * 5, ['unsent'] * 5], statuses)
+        self.assertEqual({'100': {'Total_cbc_Forms': 5},
+                          '99': {'Total_cbc_Forms': 0}},
+                         result['subject_details'])
+
+    def test_concurrent_imports(self):
+        requests = []
+        lock = threading.Lock()
+
+        def send_data_to_redcap(client, data, overwrite=False):
+            time.sleep(0.01)
+            with lock:
+                requests.append(data)
+
+        redcap_settings = {
+            'rate_limiter_value_in_redcap': 600000,
+            'redcap_uri': 'http://fakeURI:fakeport/',
+            'token': 'faketoken',
+            'verify_ssl': False,
+            'redcap_batch_rows': 2,
+            'redcap_upload_workers': 3
+        }
+        person_tree = self.batch_person_tree()
+        with patch.multiple(redcapClient,
+                            __init__=self.dummy_redcapClient_initializer,
+                            project=self.dummyClass(),
+                            send_data_to_redcap=send_data_to_redcap):
+            result = redi_lib.generate_output(
+                person_tree, redcap_settings, {}, MockDataRepository())
+
+        self.assertEqual(10, len(person_tree.xpath("//status[.='sent']")))
+        self.assertEqual({'100': {'Total_cbc_Forms': 5},
+                          '99': {'Total_cbc_Forms': 5}},
+                         result['subject_details'])
+        # a request holds the rows of one record, in the order of the events
+        for study_id in ['100', '99']:
+            rows = [row for data in requests for row in data
+                    if row['test'] == study_id]
+            self.assertEqual(['%d_arm_1' % number for number in range(1, 6)],
+                             [row['redcap_event_name'] for row in rows])
+        self.assertEqual([1], list(set(
+            len(set(row['test'] for row in data)) for data in requests)))
+
+    def test_concurrent_batch_is_sent_when_full(self):
+        started = threading.Event()
+
+        class Client(object):
+            project = self.dummyClass()
+
+            def send_data_to_redcap(self, data, overwrite=False):
+                started.set()
+
+        person_tree = self.batch_person_tree()
+        events = person_tree.xpath("person[study_id='100']//event")
+        subject_details = {'100': {'Total_cbc_Forms': 0}}
+        form_details = {'Total_cbc_Forms': 0}
+        batch = redi_lib.ConcurrentImportBatch(
+            2, Client(), person_tree, MockDataRepository(), {'errors': []},
+            subject_details, form_details, redi_lib.TokenBucket(600000), 2)
+
+        batch.add(events[0], {'test': '100'}, '100', 'Total_cbc_Forms', True)
+        self.assertFalse(started.wait(0.05))
+        # the second row fills the batch, which is sent before flush()
+        batch.add(events[1], {'test': '100'}, '100', 'Total_cbc_Forms', True)
+        self.assertTrue(started.wait(5))
+        batch.add(events[2], {'test': '100'}, '100', 'Total_cbc_Forms', True)
+
+        self.assertTrue(batch.flush())
+        self.assertEqual(2, batch.requests_sent)
+        self.assertEqual(['sent', 'sent', 'sent'],
+                         [event.findtext('status') for event in events[:3]])
+        self.assertEqual(3, subject_details['100']['Total_cbc_Forms'])
+
+    def test_diff_mode(self):
+        exports = []
+        requests = []
+
+        def get_data_from_redcap(client, records_to_fetch=None,
+                                 events_to_fetch=None, fields_to_fetch=None,
+                                 forms_to_fetch=None, return_format='xml'):
+            exports.append((records_to_fetch, events_to_fetch,
+                            fields_to_fetch, return_format))
+            current = []
+            if '100' in records_to_fetch:
+                current = [
+                    {'test': '100', 'redcap_event_name': '1_arm_1',
+                     'cbc_lbdtc': '1905-10-01'},
+                    {'test': '100', 'redcap_event_name': '2_arm_1',
+                     'cbc_lbdtc': '1999-01-01'}]
+            return current
+
+        def send_data_to_redcap(client, data, overwrite=False):
+            requests.extend(data)
+
+        redcap_settings = {
+            'rate_limiter_value_in_redcap': 600000,
+            'redcap_uri': 'http://fakeURI:fakeport/',
+            'token': 'faketoken',
+            'verify_ssl': False,
+            'diff_mode': 'events',
+            'diff_export_records': 1
+        }
+        person_tree = self.batch_person_tree()
+        with patch.multiple(redcapClient,
+                            __init__=self.dummy_redcapClient_initializer,
+                            project=self.dummyClass(),
+                            send_data_to_redcap=send_data_to_redcap,
+                            get_data_from_redcap=get_data_from_redcap):
+            result = redi_lib.generate_output(
+                person_tree, redcap_settings, {}, MockDataRepository())
+
+        # one export per record
+        self.assertEqual([(['100'], ['%d_arm_1' % number
+                                     for number in range(1, 6)],
+                           ['test', 'cbc_lbdtc'], 'json'),
+                          (['99'], ['%d_arm_1' % number
+                                    for number in range(1, 6)],
+                           ['test', 'cbc_lbdtc'], 'json')], exports)
+        self.assertEqual(9, len(requests))
+        self.assertFalse({'test': '100', 'redcap_event_name': '1_arm_1',
+                          'cbc_lbdtc': '1905-10-01'} in requests)
+        self.assertEqual(1, result['unchanged_events'])
+        # the unchanged event is counted like a sent one
+        self.assertEqual({'100': {'Total_cbc_Forms': 5},
+                          '99': {'Total_cbc_Forms': 5}},
+                         result['subject_details'])
+        self.assertEqual({'Total_cbc_Forms': 10}, result['form_details'])
+        self.assertEqual(10, len(person_tree.xpath("//status[.='sent']")))
+
+    def test_diff_fields(self):
+        class MockClient(object):
+            project = self.dummyClass()
+
+            def get_data_from_redcap(self, **kwargs):
+                return [{'test': '1', 'redcap_event_name': '1_arm_1',
+                         'a': 'x', 'b': 'y', 'c': ''}]
+
+        person_tree = etree.ElementTree(etree.fromstring("""
+<person_form_event><person><study_id>1</study_id><all_form_events>
+    <form><name>f</name><event><name>1_arm_1</name>
+        <field><name>a</name><value>x</value></field>
+    </event></form>
+</all_form_events></person></person_form_event>"""))
+        diff = redi_lib.RedcapDiff(MockClient(), person_tree,
+                                   fields_only=True)
+        row = {'test': '1', 'redcap_event_name': '1_arm_1',
+               'a': 'x', 'b': 'z', 'c': ''}
+        self.assertEqual({'test': '1', 'redcap_event_name': '1_arm_1',
+                          'b': 'z'}, diff.changes(row))
+        self.assertEqual(2, diff.unchanged_fields)
+        self.assertEqual(None, diff.changes(
+            {'test': '1', 'redcap_event_name': '1_arm_1', 'a': 'x'}))
+        self.assertEqual(1, diff.unchanged_events)
+        row = {'test': '1', 'redcap_event_name': '2_arm_1', 'a': 'x'}
+        self.assertEqual(row, diff.changes(row))
+
+    def test_token_bucket(self):
+        clock = [1000.0]
+        with patch.object(redi_lib.time, 'time', lambda: clock[0]), \
+                patch.object(redi_lib.time, 'sleep',
+                             lambda seconds: clock.__setitem__(
+                                 0, clock[0] + seconds)):
+            bucket = redi_lib.TokenBucket(120, capacity=2)
+            for _ in range(6):
+                bucket.acquire()
+        # two requests right away, then one every half second
+        self.assertAlmostEqual(1002.0, clock[0])
+
     def tearDown(self):
         return()
 
@@ -1,4 +1,5 @@
 import unittest
+import os
 import shutil
 import tempfile
 import pysftp
@@ -64,3 +65,80 @@ class TestGetEMRData(unittest.TestCase):
 '''
         self.assertEqual(result, expected)
         shutil.rmtree(temp_folder)
+
+    @patch.multiple(pysftp, Connection=_noop)
+    @patch.multiple(GetEmrData, download_file=_noop)
+    def test_get_emr_data_without_xml(self):
+        temp_folder = tempfile.mkdtemp('/')
+        with open(temp_folder+"raw.txt", 'w+') as f:
+            f.write('"NAME","STUDY_ID"\n"RNA","999-0059"')
+
+        props = EmrConnectionDetails('fake.server',
+            'username',
+            'password',
+            'tmp',
+            'output.csv'
+            )
+
+        GetEmrData.get_emr_data(temp_folder, props, write_xml=False)
+
+        self.assertTrue(os.path.exists(temp_folder + 'raw.txt'))
+        self.assertFalse(os.path.exists(temp_folder + 'rawEscaped.txt'))
+        self.assertFalse(os.path.exists(temp_folder + 'raw.xml'))
+        shutil.rmtree(temp_folder)
+
+    @patch.multiple(pysftp, Connection=_noop)
+    def test_get_emr_data_to_named_files(self):
+        temp_folder = tempfile.mkdtemp('/')
+        downloads = []
+
+        def download(source, destination, *args):
+            downloads.append((source, destination))
+            with open(destination, 'w') as f:
+                f.write('"NAME","STUDY_ID"\n"RNA","999-0059"')
+
+        props = EmrConnectionDetails('fake.server',
+            'username',
+            'password',
+            'tmp',
+            'output.csv'
+            )
+
+        with patch.object(GetEmrData, 'download_file', download):
+            GetEmrData.get_emr_data(temp_folder, props, True, 'emr.csv',
+                                    'emr.xml')
+
+        self.assertEqual(['tmp/output.csv'],
+                         [source for source, _ in downloads])
+        self.assertEqual(os.path.join(temp_folder, 'emr.csv'),
+                         os.path.normpath(downloads[0][1]))
+        self.assertFalse(os.path.exists(temp_folder + 'raw.txt'))
+        self.assertFalse(os.path.exists(temp_folder + 'raw.xml'))
+        with open(temp_folder + 'emr.xml') as f:
+            self.assertIn('<STUDY_ID>999-0059</STUDY_ID>', f.read())
+        shutil.rmtree(temp_folder)
+
+    def test_iter_csv_subjects(self):
+        temp_folder = tempfile.mkdtemp('/')
+        input_string = '''"NAME","COMPONENT_ID","RESULT","DATE_TIME_STAMP","STUDY_ID"
+"RNA","1905","<5","1907-05-21 05:50:00","999-0059"
+"HEMATOCRIT","1534436",">27&<30","","999-0059"
+"RBC","1534435","4.2 \xb5L","1903-11-27 15:13:00","999-0059"'''
+        with open(temp_folder + "raw.txt", 'w+') as f:
+            f.write(input_string)
+
+        counts = {}
+        subjects = [[(element.tag, element.text) for element in subject]
+                    for subject in GetEmrData.iter_csv_subjects(
+                        temp_folder + "raw.txt", counts)]
+
+        self.assertEqual(3, counts['subjects'])
+        self.assertEqual([('NAME', 'RNA'),
+                          ('COMPONENT_ID', '1905'),
+                          ('RESULT', '<5'),
+                          ('DATE_TIME_STAMP', '1907-05-21 05:50:00'),
+                          ('STUDY_ID', '999-0059')], subjects[0])
+        self.assertEqual(('RESULT', '>27&<30'), subjects[1][2])
+        self.assertEqual(('DATE_TIME_STAMP', None), subjects[1][3])
+        self.assertEqual(('RESULT', u'4.2 \xb5L'), subjects[2][2])
+        shutil.rmtree(temp_folder)
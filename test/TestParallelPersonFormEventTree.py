@@ -0,0 +1,142 @@
+'''
+This file tests building the person form event tree in a pool of processes
+with the subjects partitioned by STUDY_ID
+
+'''
+import unittest
+import os
+from lxml import etree
+import redi
+
+DEFAULT_DATA_DIRECTORY = os.getcwd()
+
+
+class TestParallelPersonFormEventTree(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(DEFAULT_DATA_DIRECTORY)
+        self.form_events = etree.ElementTree(etree.fromstring("""<redcapProject>
+            <name>Project</name>
+            <form>
+                <name>cbc</name>
+                <formDateField>cbc_lbdtc</formDateField>
+                <formCompletedFieldName>cbc_complete</formCompletedFieldName>
+                <formCompletedFieldValue>2</formCompletedFieldValue>
+                <event><name>1_arm_1</name></event>
+                <event><name>2_arm_1</name></event>
+            </form>
+        </redcapProject>"""))
+        self.all_form_events = etree.ElementTree(etree.fromstring("""<all_form_events>
+            <form>
+                <name>cbc</name>
+                <event>
+                    <name>1_arm_1</name>
+                    <field><name>cbc_lbdtc</name><value/></field>
+                    <field><name>wbc_lborres</name><value/></field>
+                    <field><name>wbc_lborresu</name><value/></field>
+                    <field><name>wbc_lbstat</name><value/></field>
+                    <field><name>cbc_complete</name><value/></field>
+                </event>
+                <event>
+                    <name>2_arm_1</name>
+                    <field><name>cbc_lbdtc</name><value/></field>
+                    <field><name>wbc_lborres</name><value/></field>
+                    <field><name>wbc_lborresu</name><value/></field>
+                    <field><name>wbc_lbstat</name><value/></field>
+                    <field><name>cbc_complete</name><value/></field>
+                </event>
+            </form>
+        </all_form_events>"""))
+        translation_table = etree.ElementTree(etree.fromstring("""<rediFieldMap>
+            <clinicalComponent>
+                <redcapFormName>cbc</redcapFormName>
+                <redcapFieldNameValue>wbc_lborres</redcapFieldNameValue>
+                <redcapFieldNameUnits>wbc_lborresu</redcapFieldNameUnits>
+                <redcapStatusFieldName>wbc_lbstat</redcapStatusFieldName>
+                <redcapStatusFieldValue>NOT_DONE</redcapStatusFieldValue>
+            </clinicalComponent>
+        </rediFieldMap>"""))
+        self.status_field_lookup = redi.build_status_field_lookup(
+            translation_table)
+
+        subject = """<subject><STUDY_ID>{0}</STUDY_ID><RESULT>{1}</RESULT>
+            <REFERENCE_UNIT>K/uL</REFERENCE_UNIT>
+            <timestamp>1906-12-{2}</timestamp>
+            <redcapFormName>cbc</redcapFormName><eventName>{3}</eventName>
+            <formDateField>cbc_lbdtc</formDateField>
+            <formCompletedFieldName>cbc_complete</formCompletedFieldName>
+            <formImportedFieldName/>
+            <redcapFieldNameValue>wbc_lborres</redcapFieldNameValue>
+            <redcapFieldNameUnits>wbc_lborresu</redcapFieldNameUnits>
+            <redcapFieldNameStatus>wbc_lbstat</redcapFieldNameStatus>
+            </subject>"""
+        subjects = [subject.format(study_id, study_id * 2, 10 + event,
+                                   '{0}_arm_1'.format(event))
+                    for study_id in range(1, 9) for event in (1, 2)
+                    if study_id % 3 or event == 1]
+        self.raw_data = "<study>{0}</study>".format(''.join(subjects))
+
+    def build_serial(self, sparse):
+        raw_data = etree.ElementTree(etree.fromstring(self.raw_data))
+        tree = redi.create_empty_event_tree_for_study(
+            raw_data, self.all_form_events, sparse)
+        if sparse:
+            index = redi.PersonFormEventIndex(tree, self.all_form_events)
+        else:
+            index = None
+        tree = redi.copy_data_to_person_form_event_tree(
+            raw_data, tree, self.form_events, index)
+        redi.updateStatusFieldValueInPersonFormEventTree(
+            tree, None, self.status_field_lookup)
+        return etree.tostring(tree.getroot())
+
+    def build_parallel(self, sparse, workers):
+        raw_data = etree.ElementTree(etree.fromstring(self.raw_data))
+        tree = redi.build_person_form_event_tree_in_parallel(
+            raw_data, self.all_form_events, self.form_events,
+            self.status_field_lookup, sparse, workers)
+        return etree.tostring(tree.getroot())
+
+    def test_parallel_tree_matches_serial_tree(self):
+        expected = self.build_serial(False)
+        self.assertIn('<value>16</value>', expected)
+        for workers in (2, 3, 20):
+            self.assertEqual(expected, self.build_parallel(False, workers))
+
+    def test_parallel_sparse_tree_matches_serial_tree(self):
+        self.assertEqual(self.build_serial(True),
+                         self.build_parallel(True, 3))
+
+    def test_tree_built_from_stream_matches_serial_tree(self):
+        for sparse in (False, True):
+            raw_data = etree.fromstring(self.raw_data)
+            tree = redi.build_person_form_event_tree_from_stream(
+                iter(raw_data), self.all_form_events, self.form_events,
+                sparse)
+            redi.updateStatusFieldValueInPersonFormEventTree(
+                tree, None, self.status_field_lookup)
+            # the persons are created in the order of the stream
+            expected = etree.fromstring(self.build_serial(sparse))
+            expected[:] = sorted(expected, key=lambda person: int(
+                person.findtext('study_id')))
+            self.assertEqual(etree.tostring(expected),
+                             etree.tostring(tree.getroot()))
+
+    def test_subject_partition(self):
+        partitions = [redi.subject_partition(str(study_id), 4)
+                      for study_id in range(100)]
+        self.assertTrue(all(0 <= partition < 4 for partition in partitions))
+        self.assertEqual(set(range(4)), set(partitions))
+        self.assertEqual(redi.subject_partition('99', 4),
+                         redi.subject_partition(u'99', 4))
+
+    def test_no_subjects(self):
+        raw_data = etree.ElementTree(etree.fromstring('<study/>'))
+        self.assertRaises(
+            Exception, redi.build_person_form_event_tree_in_parallel,
+            raw_data, self.all_form_events, self.form_events,
+            self.status_field_lookup, False, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+'''
+This file tests the ledger of event payloads accepted by REDCap
+
+'''
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+from mock import patch
+import redi
+import redi_lib
+from utils.redcapClient import redcapClient
+from TestGenerateOutput import MockDataRepository
+
+
+class TestPayloadLedger(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(os.getcwd())
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'redi.db')
+        self.events = dict(
+            ((record, form), etree.fromstring(
+                '<event><name>1_arm_1</name></event>'))
+            for record in ['1', '2'] for form in ['cbc', 'inr'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def row(self, record, form, value):
+        return {'test': record, 'redcap_event_name': '1_arm_1',
+                form + '_lborres': value}
+
+    def send_all(self, ledger, value):
+        checked = []
+        for (record, form), event in sorted(self.events.items()):
+            if not ledger.check(event, record, form,
+                                self.row(record, form, value)):
+                checked.append((record, form))
+        ledger.sent(self.events.values())
+        return checked
+
+    def test_ledger(self):
+        ledger = redi_lib.PayloadLedger(self.db_path)
+        self.assertEqual(4, len(self.send_all(ledger, '1')))
+        ledger.close()
+
+        ledger = redi_lib.PayloadLedger(self.db_path)
+        self.assertEqual([], self.send_all(ledger, '1'))
+        self.assertEqual(4, ledger.unchanged_events)
+        self.assertEqual(4, len(self.send_all(ledger, '2')))
+
+        self.assertEqual(2, ledger.invalidate(records=['1']))
+        self.assertEqual(1, ledger.invalidate(records=['2'], forms=['inr']))
+        ledger.close()
+
+        ledger = redi_lib.PayloadLedger(self.db_path)
+        self.assertEqual([('1', 'cbc'), ('1', 'inr'), ('2', 'inr')],
+                         self.send_all(ledger, '2'))
+        self.assertEqual(4, ledger.invalidate(forms=['cbc', 'inr']))
+        self.assertRaises(Exception, ledger.invalidate)
+        ledger.close()
+
+    def test_events_are_recorded_after_they_are_accepted(self):
+        ledger = redi_lib.PayloadLedger(self.db_path)
+        event = self.events[('1', 'cbc')]
+        self.assertFalse(ledger.check(event, '1', 'cbc',
+                                      self.row('1', 'cbc', '1')))
+        # not accepted by REDCap: checked again on the next run
+        ledger.close()
+        ledger = redi_lib.PayloadLedger(self.db_path)
+        self.assertFalse(ledger.check(event, '1', 'cbc',
+                                      self.row('1', 'cbc', '1')))
+        ledger.close()
+
+    def test_generate_output_with_ledger(self):
+        requests = []
+
+        class MockProject(object):
+            def_field = 'test'
+
+        def send_data_to_redcap(client, data, overwrite=False):
+            requests.extend(data)
+
+        def person_tree():
+            return etree.ElementTree(etree.fromstring("""<person_form_event>
+    <person><study_id>1</study_id><all_form_events>
+        <form><name>cbc</name>
+            <event><name>1_arm_1</name>
+                <field><name>cbc_lborres</name><value>5</value></field>
+            </event>
+            <event><name>2_arm_1</name>
+                <field><name>cbc_lborres</name><value>6</value></field>
+            </event>
+        </form>
+    </all_form_events></person>
+</person_form_event>"""))
+
+        redcap_settings = {'rate_limiter_value_in_redcap': 600000,
+                           'redcap_uri': 'http://fakeURI:fakeport/',
+                           'token': 'faketoken',
+                           'verify_ssl': False}
+        with patch.multiple(redcapClient,
+                            __init__=lambda *args: None,
+                            project=MockProject(),
+                            send_data_to_redcap=send_data_to_redcap):
+            ledger = redi_lib.PayloadLedger(self.db_path)
+            redi_lib.generate_output(person_tree(), redcap_settings, {},
+                                     MockDataRepository(), ledger=ledger)
+            ledger.close()
+            self.assertEqual(2, len(requests))
+
+            tree = person_tree()
+            tree.getroot().find('.//value').text = '7'
+            ledger = redi_lib.PayloadLedger(self.db_path)
+            repository = MockDataRepository()
+            result = redi_lib.generate_output(
+                tree, redcap_settings, {}, repository,
+                ledger=ledger)
+            ledger.close()
+
+        self.assertEqual(['1_arm_1', '2_arm_1', '1_arm_1'],
+                         [row['redcap_event_name'] for row in requests])
+        self.assertEqual(1, result['unchanged_events'])
+        # the event left out is counted like a sent one
+        self.assertEqual({'1': {'Total_cbc_Forms': 2}},
+                         result['subject_details'])
+        self.assertEqual({'Total_cbc_Forms': 2}, result['form_details'])
+        self.assertEqual(['sent', 'sent'], tree.xpath('//status/text()'))
+        # the status of the event left out is saved too
+        self.assertEqual([('1', 'cbc', '1_arm_1', 'sent'),
+                          ('1', 'cbc', '2_arm_1', 'sent')],
+                         repository.statuses)
+
+    def test_generate_output_with_ledger_and_diff(self):
+        requests = []
+
+        class MockProject(object):
+            def_field = 'test'
+
+        def get_data_from_redcap(client, records_to_fetch=None,
+                                 events_to_fetch=None, fields_to_fetch=None,
+                                 forms_to_fetch=None, return_format='xml'):
+            return [{'test': '1', 'redcap_event_name': '1_arm_1',
+                     'cbc_lborres': '5'}]
+
+        def send_data_to_redcap(client, data, overwrite=False):
+            requests.extend(data)
+
+        def person_tree():
+            return etree.ElementTree(etree.fromstring("""<person_form_event>
+    <person><study_id>1</study_id><all_form_events>
+        <form><name>cbc</name>
+            <event><name>1_arm_1</name>
+                <field><name>cbc_lborres</name><value>5</value></field>
+            </event>
+            <event><name>2_arm_1</name>
+                <field><name>cbc_lborres</name><value>6</value></field>
+            </event>
+        </form>
+    </all_form_events></person>
+</person_form_event>"""))
+
+        redcap_settings = {'rate_limiter_value_in_redcap': 600000,
+                           'redcap_uri': 'http://fakeURI:fakeport/',
+                           'token': 'faketoken',
+                           'verify_ssl': False,
+                           'diff_mode': 'events'}
+        with patch.multiple(redcapClient,
+                            __init__=lambda *args: None,
+                            project=MockProject(),
+                            get_data_from_redcap=get_data_from_redcap,
+                            send_data_to_redcap=send_data_to_redcap):
+            ledger = redi_lib.PayloadLedger(self.db_path)
+            result = redi_lib.generate_output(
+                person_tree(), redcap_settings, {}, MockDataRepository(),
+                ledger=ledger)
+            # the event the diff left out is recorded like a sent one
+            self.assertEqual({}, ledger.pending)
+            self.assertEqual(
+                [('1', 'cbc', '1_arm_1'), ('1', 'cbc', '2_arm_1')],
+                sorted(ledger.hashes))
+            ledger.close()
+            self.assertEqual(['2_arm_1'],
+                             [row['redcap_event_name'] for row in requests])
+            self.assertEqual(1, result['unchanged_events'])
+
+            # the next run leaves out both events before the diff
+            ledger = redi_lib.PayloadLedger(self.db_path)
+            result = redi_lib.generate_output(
+                person_tree(), redcap_settings, {}, MockDataRepository(),
+                ledger=ledger)
+            self.assertEqual(2, ledger.unchanged_events)
+            ledger.close()
+
+        self.assertEqual(1, len(requests))
+        self.assertEqual(2, result['unchanged_events'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import unittest
+import os
+import shutil
 import tempfile
 
 from lxml import etree
@@ -35,4 +37,50 @@ class TestPersonFormEventsRepository(unittest.TestCase):
             service.store(xml)
 
             self.assertTrue('<test>42</test>' in open(temp.name).read())
-            self.assertIsNotNone(MockLogger.message)
\ No newline at end of file
+            self.assertIsNotNone(MockLogger.message)
+
+    def test_status_journal(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'pfe.xml')
+        xml = etree.fromstring("""<person_form_event>
+    <person><study_id>1</study_id><all_form_events>
+        <form><name>cbc</name>
+            <event><name>1_arm_1</name><status>unsent</status></event>
+            <event><name>2_arm_1</name></event>
+        </form>
+    </all_form_events></person>
+</person_form_event>""").getroottree()
+        service = PersonFormEventsRepository(filename, journal=True)
+        try:
+            service.store(xml)
+            snapshot = open(filename).read()
+
+            service.store_statuses(xml, [('1', 'cbc', '1_arm_1', 'sent')])
+            service.store_statuses(xml, [('1', 'cbc', '2_arm_1', 'sent'),
+                                         ('2', 'cbc', '1_arm_1', 'sent')])
+            self.assertEqual(snapshot, open(filename).read())
+            with open(filename + '.journal', 'a') as journal:
+                journal.write('["1", "cbc"')
+
+            fetched = service.fetch()
+            self.assertEqual(['sent', 'sent'],
+                             fetched.xpath('//event/status/text()'))
+
+            service.store(fetched)
+            self.assertFalse(os.path.exists(filename + '.journal'))
+            self.assertEqual(['sent', 'sent'],
+                             service.fetch().xpath('//event/status/text()'))
+
+            service.store_statuses(xml, [('1', 'cbc', '1_arm_1', 'sent')])
+            service.delete()
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_store_statuses_without_journal(self):
+        with tempfile.NamedTemporaryFile() as temp:
+            xml = etree.fromstring('<test>42</test>').getroottree()
+            service = PersonFormEventsRepository(temp.name)
+            service.store_statuses(xml, [('1', 'cbc', '1_arm_1', 'sent')])
+            self.assertTrue('<test>42</test>' in open(temp.name).read())
+            self.assertFalse(os.path.exists(temp.name + '.journal'))
@@ -0,0 +1,139 @@
+'''
+This file tests the columnar representation of the raw data and the
+transform stages which work on it
+
+'''
+import unittest
+from lxml import etree
+import utils.raw_data_columns as raw_data_columns
+from utils.raw_data_columns import RawDataColumns, DictionaryColumn, MISSING
+
+
+class TestRawDataColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = raw_data_columns.numpy
+        self.data = etree.fromstring("""<study>
+    <subject>
+        <STUDY_ID>22</STUDY_ID>
+        <COMPONENT_ID>1534436</COMPONENT_ID>
+        <RESULT>0.12</RESULT>
+        <DATE_TIME_STAMP>2013-12-01 00:12:01</DATE_TIME_STAMP>
+        <RESULT_DATE>2013-12-03 00:12:01</RESULT_DATE>
+    </subject>
+    <subject>
+        <STUDY_ID>11</STUDY_ID>
+        <COMPONENT_ID>1534435</COMPONENT_ID>
+        <RESULT/>
+        <DATE_TIME_STAMP/>
+        <RESULT_DATE>2013-12-05 00:12:01</RESULT_DATE>
+    </subject>
+    <subject>
+        <STUDY_ID>11</STUDY_ID>
+        <COMPONENT_ID>999</COMPONENT_ID>
+        <RESULT>4.5</RESULT>
+        <RESULT_DATE>2013-12-07 00:12:01</RESULT_DATE>
+    </subject>
+</study>""")
+        self.components = {
+            '1534435': {'redcapFormName': 'cbc',
+                        'redcapFieldNameValue': 'wbc_lborres'},
+            '1534436': {'redcapFormName': 'chemistry',
+                        'redcapFieldNameValue': 'hgb_lborres',
+                        'redcapFieldNameUnits': 'hgb_lborresu'}}
+        self.forms = {
+            'cbc': {'formDateField': 'cbc_lbdtc',
+                    'formCompletedFieldName': 'cbc_complete'},
+            'chemistry': {'formDateField': 'chem_lbdtc',
+                          'formCompletedFieldName': 'chem_complete',
+                          'formImportedFieldName': 'chem_nximport'}}
+
+    def tearDown(self):
+        raw_data_columns.numpy = self.numpy
+
+    def transform(self):
+        columns = RawDataColumns.from_subjects(self.data)
+        raw_data_columns.replace_fields(columns, [('RESULT', 'ORD_VALUE')])
+        columns, summary = raw_data_columns.verify_and_correct_collection_date(
+            columns, '%Y-%m-%d %H:%M:%S')
+        self.unmapped = {}
+        raw_data_columns.convert_component_id_to_loinc_code(columns, {
+            ('COMPONENT_ID', '1534435'): ('loinc_code', '1534435'),
+            ('COMPONENT_ID', '1534436'): ('loinc_code', '1534436')},
+            self.unmapped)
+        raw_data_columns.update_time_stamp(
+            columns, '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+        raw_data_columns.update_from_lookups(
+            columns, self.components, self.forms, 'undefined')
+        columns.sort(['STUDY_ID', 'redcapFormName', 'timestamp'])
+        return columns.to_element_tree(), summary
+
+    def test_dictionary_column(self):
+        column = DictionaryColumn.encode(['a', 'b', 'a', None])
+        self.assertEqual(['a', 'b', None], column.values)
+        self.assertEqual(['A', 'B', 'A', None], list(column.map(
+            lambda value: value and value.upper())))
+        self.assertEqual(2, column.count(lambda value: value == 'a'))
+        mask = column.mask(lambda value: value == 'a')
+        self.assertEqual(['c', 'b', 'c', None],
+                         list(column.assign(mask, 'c')))
+        self.assertEqual([None, 'b', 'a'], list(column.take([3, 1, 0])))
+
+    def test_missing_and_empty_fields(self):
+        columns = RawDataColumns.from_subjects(self.data)
+        self.assertEqual(3, len(columns))
+        self.assertEqual(['2013-12-01 00:12:01', None, MISSING],
+                         list(columns['DATE_TIME_STAMP']))
+
+        subjects = columns.to_element_tree().getroot()
+        self.assertEqual('', subjects[1].findtext('RESULT'))
+        self.assertEqual(None, subjects[2].find('DATE_TIME_STAMP'))
+        self.assertEqual(['STUDY_ID', 'COMPONENT_ID', 'RESULT',
+                          'DATE_TIME_STAMP', 'RESULT_DATE'] +
+                         raw_data_columns.DERIVED_FIELDS,
+                         [element.tag for element in subjects[0]])
+
+    def test_transform(self):
+        data, summary = self.transform()
+        self.assertEqual({'total': 3, 'blank': 2}, summary)
+        self.assertEqual({('COMPONENT_ID', '999'): 1}, self.unmapped)
+
+        subjects = data.getroot()
+        self.assertEqual(
+            ['STUDY_ID', 'loinc_code', 'ORD_VALUE', 'DATE_TIME_STAMP'] +
+            raw_data_columns.DERIVED_FIELDS,
+            [element.tag for element in subjects[0]])
+        self.assertEqual(['11', '11', '22'],
+                         [subject.findtext('STUDY_ID') for subject in subjects])
+
+        cbc, unmapped, chemistry = subjects
+        self.assertEqual('1534435', cbc.findtext('loinc_code'))
+        self.assertEqual('2013-12-01 00:12:01',
+                         cbc.findtext('DATE_TIME_STAMP'))
+        self.assertEqual('2013-12-01', cbc.findtext('timestamp'))
+        self.assertEqual('cbc_lbdtc', cbc.findtext('formDateField'))
+        self.assertEqual('undefined', cbc.findtext('formImportedFieldName'))
+        self.assertEqual('redcapFieldNameUnitsUndefined',
+                         cbc.findtext('redcapFieldNameUnits'))
+
+        self.assertEqual('999', unmapped.findtext('COMPONENT_ID'))
+        self.assertEqual(None, unmapped.find('loinc_code'))
+        self.assertEqual('undefined', unmapped.findtext('redcapFormName'))
+        self.assertEqual('undefined', unmapped.findtext('formDateField'))
+
+        self.assertEqual('2013-12-01 00:12:01',
+                         chemistry.findtext('DATE_TIME_STAMP'))
+        self.assertEqual('hgb_lborresu',
+                         chemistry.findtext('redcapFieldNameUnits'))
+        self.assertEqual('chem_nximport',
+                         chemistry.findtext('formImportedFieldName'))
+        self.assertEqual('', chemistry.findtext('eventName'))
+
+    def test_transform_without_numpy(self):
+        expected = etree.tostring(self.transform()[0])
+        raw_data_columns.numpy = None
+        self.assertEqual(expected, etree.tostring(self.transform()[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
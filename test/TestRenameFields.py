@@ -0,0 +1,70 @@
+'''
+This file tests the renaming of raw data fields listed in
+replace_fields_in_raw_data.xml
+
+'''
+import unittest
+import os
+import tempfile
+from lxml import etree
+import redi
+
+DEFAULT_DATA_DIRECTORY = os.getcwd()
+
+
+class TestRenameFields(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(DEFAULT_DATA_DIRECTORY)
+        self.raw_xml = """<study>
+    <subject>
+        <ORD_VALUE>1.5</ORD_VALUE>
+        <UNIT>g/dL</UNIT>
+        <STUDY_ID>22</STUDY_ID>
+    </subject>
+    <subject>
+        <ORD_VALUE>4.2</ORD_VALUE>
+        <STUDY_ID>23</STUDY_ID>
+    </subject>
+</study>"""
+
+    def test_compile_field_renames(self):
+        renames = redi.compile_field_renames([
+            ('ORD_VALUE', 'VALUE'),
+            ('VALUE', 'RESULT'),
+            ('UNIT', 'REFERENCE_UNIT'),
+            ('ORD_VALUE', 'OTHER'),
+            ('STUDY_ID', 'STUDY_ID')])
+        self.assertEqual({'ORD_VALUE': 'RESULT',
+                          'VALUE': 'RESULT',
+                          'UNIT': 'REFERENCE_UNIT'}, renames)
+
+    def test_replace_fields_in_raw_xml(self):
+        temp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        temp.write("""<rediFieldMap>
+    <field><source>ORD_VALUE</source><target>RESULT</target></field>
+    <field><source>UNIT</source><target>REFERENCE_UNIT</target></field>
+</rediFieldMap>""")
+        temp.close()
+        data = etree.ElementTree(etree.fromstring(self.raw_xml))
+        try:
+            redi.replace_fields_in_raw_xml(data, temp.name)
+        finally:
+            os.remove(temp.name)
+
+        first, second = data.getroot()
+        self.assertEqual(['RESULT', 'REFERENCE_UNIT', 'STUDY_ID'],
+                         [element.tag for element in first])
+        self.assertEqual('g/dL', first.findtext('REFERENCE_UNIT'))
+        self.assertEqual(['RESULT', 'STUDY_ID'],
+                         [element.tag for element in second])
+        self.assertEqual('4.2', second.findtext('RESULT'))
+
+    def test_replace_fields_without_file(self):
+        data = etree.ElementTree(etree.fromstring(self.raw_xml))
+        self.assertRaises(Exception, redi.replace_fields_in_raw_xml, data,
+                          'no_such_file.xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
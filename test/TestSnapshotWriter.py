@@ -0,0 +1,92 @@
+'''
+This file tests the writer of the intermediate xml files of a run and its
+snapshot policies
+
+'''
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+import redi
+
+
+class TestSnapshotWriter(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(os.getcwd())
+        self.directory = tempfile.mkdtemp()
+        self.tree = etree.ElementTree(etree.fromstring(
+            '<study><subject><STUDY_ID>1</STUDY_ID></subject></study>'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, policy, background=False):
+        writer = redi.SnapshotWriter(self.directory, policy, background)
+        writer.write(self.tree, 'rawData.xml')
+        writer.write(self.tree, 'rawDataWithAllUpdates.xml', final=True)
+        writer.close()
+        return sorted(os.listdir(self.directory))
+
+    def test_policies(self):
+        self.assertEqual([], self.write('none'))
+        self.assertEqual(['rawDataWithAllUpdates.xml'], self.write('final'))
+        self.assertEqual(['rawData.xml', 'rawDataWithAllUpdates.xml'],
+                         self.write('all'))
+
+    def test_invalid_policy(self):
+        self.assertRaises(Exception, redi.SnapshotWriter, self.directory,
+                          'some')
+
+    def test_background_writes_a_copy(self):
+        expected = os.path.join(self.directory, 'expected.xml')
+        redi.write_element_tree_to_file(self.tree, expected)
+
+        writer = redi.SnapshotWriter(self.directory, 'all', background=True)
+        writer.write(self.tree, 'rawData.xml')
+        # the next stage changes the tree while the file is written
+        self.tree.getroot().append(etree.Element('subject'))
+        writer.close()
+
+        with open(expected) as fp:
+            expected_xml = fp.read()
+        with open(os.path.join(self.directory, 'rawData.xml')) as fp:
+            self.assertEqual(expected_xml, fp.read())
+
+    def test_subject_stream(self):
+        writer = redi.SnapshotWriter(self.directory, 'final')
+        with writer.subject_stream('rawData.xml') as write_subject:
+            write_subject(self.tree.getroot()[0])
+        with writer.subject_stream('rawDataWithAllUpdates.xml',
+                                   final=True) as write_subject:
+            for subject in self.tree.getroot():
+                write_subject(subject)
+        writer.close()
+
+        self.assertEqual(['rawDataWithAllUpdates.xml'],
+                         sorted(os.listdir(self.directory)))
+        written = etree.parse(
+            os.path.join(self.directory, 'rawDataWithAllUpdates.xml'),
+            etree.XMLParser(remove_blank_text=True))
+        self.assertEqual(etree.tostring(self.tree), etree.tostring(written))
+
+    def test_background_error_is_raised_by_close(self):
+        writer = redi.SnapshotWriter(
+            os.path.join(self.directory, 'missing'), 'all', background=True)
+        writer.write(self.tree, 'rawData.xml')
+        writer.flush()
+        self.assertRaises(IOError, writer.close)
+
+    def test_close_with_discard(self):
+        writer = redi.SnapshotWriter(
+            os.path.join(self.directory, 'missing'), 'all', background=True)
+        thread = writer._thread
+        writer.write(self.tree, 'rawData.xml')
+        # a failed run stops the writer thread without raising its error
+        writer.close(discard=True)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
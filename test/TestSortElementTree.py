@@ -208,6 +208,27 @@ class TestSortElementTree(unittest.TestCase):
         self.expect = etree.tostring(etree.fromstring(self.sorted))
         self.assertEqual(self.expect, result)
 
+    def test_subject_sorter_spills_runs(self):
+        subjects = [etree.fromstring(
+            '<subject><STUDY_ID>{0}</STUDY_ID><redcapFormName>cbc'
+            '</redcapFormName><timestamp>1906-12-0{1}</timestamp>'
+            '<RESULT>{2}</RESULT></subject>'.format(study_id, day, result))
+            for result, (study_id, day) in enumerate(
+                [(2, 1), (1, 3), (2, 1), (1, 1), (1, 3), (3, 2), (1, 1)])]
+        # subjects with equal keys keep their order
+        expected = [etree.tostring(subject) for subject in
+                    sorted(subjects, key=redi.getkey)]
+        # the setting is read as a string
+        for buffer_rows, runs in (('0', 0), ('3', 2), ('1', 7)):
+            sorter = redi.SubjectSorter(buffer_rows)
+            for subject in subjects:
+                sorter.add(subject)
+            self.assertEqual(runs, len(sorter.runs))
+            result = [etree.tostring(subject)
+                      for subject in sorter.subjects()]
+            self.assertEqual(expected, result)
+            self.assertEqual([], sorter.runs)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,107 @@
+'''
+This file tests the recording of the wall time, CPU time, memory and rows
+of the stages of a run
+
+'''
+import unittest
+import os
+import shutil
+import tempfile
+import redi
+import redi_lib
+
+
+class ProfiledRow(object):
+    pass
+
+
+class TestStageMetrics(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(os.getcwd())
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stage(self):
+        metrics = redi_lib.StageMetrics()
+        with metrics.stage('first', 3) as stage:
+            stage['rows_out'] = 2
+        with metrics.stage('second'):
+            sum(range(1000))
+
+        self.assertEqual(['first', 'second'],
+                         [stage['name'] for stage in metrics.stages])
+        first = metrics.stages[0]
+        self.assertEqual(3, first['rows_in'])
+        self.assertEqual(2, first['rows_out'])
+        self.assertEqual(None, metrics.stages[1]['rows_out'])
+        # a stage without rows_out keeps the rows_out of the stage before
+        self.assertEqual(2, metrics.rows_out)
+        for stage in metrics.stages:
+            self.assertTrue(stage['wall_time'] >= 0)
+            self.assertTrue(stage['cpu_time'] >= 0)
+            if redi_lib.resource is not None:
+                self.assertTrue(stage['peak_rss_kb'] > 0)
+                self.assertTrue(stage['rss_growth_kb'] >= 0)
+
+    def test_failed_stage_is_not_recorded(self):
+        metrics = redi_lib.StageMetrics()
+        try:
+            with metrics.stage('failing'):
+                raise ValueError('stage failed')
+        except ValueError:
+            pass
+        self.assertEqual([], metrics.stages)
+
+    def test_write_and_read(self):
+        metrics = redi_lib.StageMetrics()
+        with metrics.stage('sort', 5) as stage:
+            stage['rows_out'] = 5
+        path = os.path.join(self.directory, 'stage_metrics.json')
+        metrics.write(path)
+
+        read = redi_lib.StageMetrics.read(path)
+        self.assertEqual(metrics.stages, read.stages)
+        with read.stage('rules'):
+            pass
+        self.assertEqual(['sort', 'rules'],
+                         [stage['name'] for stage in read.stages])
+
+    def test_profile(self):
+        profile_dir = os.path.join(self.directory, 'profile')
+        metrics = redi_lib.StageMetrics(profile_dir=profile_dir)
+        held = []
+        with metrics.stage('copy data'):
+            sorted(range(1000), reverse=True)
+            held.extend(ProfiledRow() for _ in range(500))
+        try:
+            with metrics.stage('rules'):
+                raise ValueError('stage failed')
+        except ValueError:
+            pass
+
+        names = os.listdir(profile_dir)
+        for name in ('01-copy_data', '02-rules'):
+            self.assertIn(name + '.pstats', names)
+            self.assertIn(name + '.txt', names)
+            self.assertIn(name + '.allocations.txt', names)
+        with open(os.path.join(profile_dir, '01-copy_data.txt')) as fp:
+            report = fp.read()
+        self.assertIn("Stage 'copy data' sorted by cumulative time", report)
+        self.assertIn('sorted', report)
+        self.assertEqual(['copy data'],
+                         [stage['name'] for stage in metrics.stages])
+        with open(os.path.join(profile_dir,
+                               '01-copy_data.allocations.txt')) as fp:
+            allocations = fp.read()
+        if redi_lib.tracemalloc is None:
+            self.assertIn('TestStageMetrics.ProfiledRow: count=+500',
+                          allocations)
+        else:
+            self.assertIn('TestStageMetrics.py', allocations)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+'''
+This file tests the functions iter_raw_xml and stream_raw_xml
+
+'''
+import unittest
+import os
+import tempfile
+from lxml import etree
+import redi
+
+DEFAULT_DATA_DIRECTORY = os.getcwd()
+
+
+class TestStreamRawXml(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(DEFAULT_DATA_DIRECTORY)
+        self.sampleData = """<study>
+        <!-- comments are dropped -->
+        <subject>
+            <loinc_code>test1</loinc_code>
+            <RESULT>0.12</RESULT>
+            <STUDY_ID>1234-5678</STUDY_ID>
+        </subject>
+        <subject>
+            <loinc_code>test2</loinc_code>
+            <RESULT>8.7</RESULT>
+            <STUDY_ID>987-654</STUDY_ID>
+        </subject>
+    </study>"""
+        temp = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        temp.write(self.sampleData)
+        temp.close()
+        self.file_name = temp.name
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_iter_raw_xml_counts(self):
+        counts = {}
+        results = [subject.findtext('RESULT')
+                   for subject in redi.iter_raw_xml(self.file_name, counts)]
+        self.assertEqual(['0.12', '8.7'], results)
+        self.assertEqual(2, counts['subjects'])
+        self.assertEqual(13, counts['lines'])
+
+    def test_iter_raw_xml_detaches_subjects(self):
+        seen = []
+        for subject in redi.iter_raw_xml(self.file_name):
+            seen.append(subject)
+        for subject in seen:
+            self.assertIsNone(subject.getparent())
+            self.assertEqual(3, len(subject))
+        self.assertEqual(['1234-5678', '987-654'],
+                         [subject.findtext('STUDY_ID') for subject in seen])
+
+    def test_iter_raw_xml_large_file(self):
+        # libxml2 parses the text after a subject in chunks, after the end
+        # event of the subject
+        with open(self.file_name, 'w') as fp:
+            fp.write('<study>\n')
+            for study_id in range(20000):
+                fp.write('<subject><STUDY_ID>{0}</STUDY_ID></subject>\n'
+                         .format(study_id))
+            fp.write('</study>')
+        study_ids = [subject.findtext('STUDY_ID')
+                     for subject in redi.iter_raw_xml(self.file_name)]
+        self.assertEqual([str(study_id) for study_id in range(20000)],
+                         study_ids)
+
+    def test_iter_raw_xml_without_file(self):
+        self.assertRaises(Exception, list, redi.iter_raw_xml(''))
+
+    def test_stream_raw_xml(self):
+        data = redi.stream_raw_xml(self.file_name,
+                                   [redi.add_elements_to_subject])
+        expected = redi.parse_raw_xml(self.file_name)
+        redi.add_elements_to_tree(expected)
+
+        self.assertEqual(2, len(data.getroot()))
+        for streamed, parsed in zip(data.getroot(), expected.getroot()):
+            self.assertEqual([(e.tag, e.text) for e in streamed],
+                             [(e.tag, e.text) for e in parsed])
+
+
+if __name__ == '__main__':
+    unittest.main()
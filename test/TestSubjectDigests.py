@@ -0,0 +1,68 @@
+'''
+This file tests the per-subject digests of the raw data used to process
+only new or changed subjects
+
+'''
+import unittest
+import os
+import shutil
+import tempfile
+from lxml import etree
+import redi
+import redi_lib
+
+
+class TestSubjectDigests(unittest.TestCase):
+
+    def setUp(self):
+        redi.configure_logging(os.getcwd())
+        self.directory = tempfile.mkdtemp()
+        self.raw_xml = """<study>
+    <subject><STUDY_ID>1</STUDY_ID><RESULT>5</RESULT></subject>
+    <subject><STUDY_ID>2</STUDY_ID><RESULT>6</RESULT></subject>
+    <subject><STUDY_ID>1</STUDY_ID><RESULT>7</RESULT></subject>
+</study>"""
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def digests(self, raw_xml, salt=''):
+        return redi.compute_subject_digests(
+            etree.fromstring(raw_xml).findall('subject'), salt)
+
+    def test_compute_subject_digests(self):
+        digests = self.digests(self.raw_xml)
+        self.assertEqual(['1', '2'], sorted(digests))
+        self.assertEqual(digests, self.digests(self.raw_xml))
+
+        # whitespace between the rows does not matter; another value of
+        # subject 1 changes only its digest
+        changed = self.digests(self.raw_xml.replace('\n', '').replace(
+            '<RESULT>7', '<RESULT>8'))
+        self.assertNotEqual(digests['1'], changed['1'])
+        self.assertEqual(digests['2'], changed['2'])
+        self.assertEqual(set(['1']), redi.changed_subjects(changed, digests))
+
+        self.assertEqual(set(['1', '2']), redi.changed_subjects(
+            self.digests(self.raw_xml, 'new configuration'), digests))
+        self.assertEqual(set(['1', '2']), redi.changed_subjects(digests, {}))
+
+    def test_select_subjects(self):
+        subjects = etree.fromstring(self.raw_xml).findall('subject')
+        self.assertEqual(['5', '7'], [
+            subject.findtext('RESULT')
+            for subject in redi.select_subjects(subjects, set(['1']))])
+        self.assertEqual(3, len(list(redi.select_subjects(subjects))))
+
+    def test_store_subject_digests(self):
+        db_path = os.path.join(self.directory, 'redi.db')
+        self.assertEqual({}, redi_lib.get_subject_digests(db_path))
+        self.assertTrue(redi_lib.store_subject_digests(
+            db_path, {'1': 'a', '2': 'b'}, 3))
+        self.assertTrue(redi_lib.store_subject_digests(db_path, {'1': 'c'}, 4))
+        self.assertEqual({'1': 'c', '2': 'b'},
+                         redi_lib.get_subject_digests(db_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
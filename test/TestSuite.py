@@ -46,6 +46,17 @@ from TestResume import TestResume
 from TestPersonFormEventsRepository import TestPersonFormEventsRepository
 from TestVerifyAndCorrectCollectionDate import TestVerifyAndCorrectCollectionDate
 from TestSkipBlanks import TestSkipBlanks
+from TestStreamRawXml import TestStreamRawXml
+from TestConfigLookups import TestConfigLookups
+from TestRawDataColumns import TestRawDataColumns
+from TestAnnotateSubjects import TestAnnotateSubjects
+from TestRenameFields import TestRenameFields
+from TestAsyncRedcapClient import TestAsyncRedcapClient
+from TestPayloadLedger import TestPayloadLedger
+from TestSubjectDigests import TestSubjectDigests
+from TestParallelPersonFormEventTree import TestParallelPersonFormEventTree
+from TestStageMetrics import TestStageMetrics
+from TestSnapshotWriter import TestSnapshotWriter
 
 
 class redi_suite(unittest.TestSuite):
@@ -87,6 +98,17 @@ class redi_suite(unittest.TestSuite):
         redi_test_suite.addTest(TestResume)
         redi_test_suite.addTest(TestPersonFormEventsRepository)
         redi_test_suite.addTest(TestSkipBlanks)
+        redi_test_suite.addTest(TestStreamRawXml)
+        redi_test_suite.addTest(TestConfigLookups)
+        redi_test_suite.addTest(TestRawDataColumns)
+        redi_test_suite.addTest(TestAnnotateSubjects)
+        redi_test_suite.addTest(TestRenameFields)
+        redi_test_suite.addTest(TestAsyncRedcapClient)
+        redi_test_suite.addTest(TestPayloadLedger)
+        redi_test_suite.addTest(TestSubjectDigests)
+        redi_test_suite.addTest(TestParallelPersonFormEventTree)
+        redi_test_suite.addTest(TestStageMetrics)
+        redi_test_suite.addTest(TestSnapshotWriter)
 
         # return the suite
         return unittest.TestSuite([redi_test_suite])
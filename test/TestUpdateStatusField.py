@@ -843,6 +843,36 @@ class TestUpdateStatusField(unittest.TestCase):
     result = etree.tostring(self.source_tree)
     self.assertEqual(self.expect, result)
 
+  def test_event_has_values(self):
+    event = etree.fromstring("""<event><name>1_arm_1</name>
+      <field><name>wbc_lborres</name><value/></field>
+      <field><name>wbc_lborresu</name><value>None</value></field>
+      <field><name>wbc_lbstat</name><value></value></field></event>""")
+    self.assertFalse(redi.event_has_values(event))
+    event.find('field/value').text = '3.0'
+    self.assertTrue(redi.event_has_values(event))
+
+  def test_set_status_fields(self):
+    event = etree.fromstring("""<event><name>1_arm_1</name>
+      <field><name>wbc_lborres</name><value>3.0</value></field>
+      <field><name>hemo_lborres</name><value/></field>
+      <field><name>hemo_lborresu</name><value/></field>
+      <field><name>wbc_lbstat</name><value/></field>
+      <field><name>hemo_lbstat</name><value/></field>
+      <field><name>cbc_lbdtc</name><value/></field></event>""")
+    translation_table_dict = {
+      'wbc_lborres': ['wbc_lbstat', 'NOT_DONE'],
+      'hemo_lborres': ['hemo_lbstat', 'NOT_DONE'],
+      'hemo_lborresu': ['hemo_lbstat', 'NOT_DONE'],
+      'cbc_lbdtc': ['', '']}
+    redi.set_status_fields(event, translation_table_dict,
+                           set(['wbc_lbstat', 'hemo_lbstat']))
+    values = dict((field.findtext('name'), field.findtext('value'))
+                  for field in event.iter('field'))
+    self.assertEqual('', values['wbc_lbstat'])
+    self.assertEqual('NOT_DONE', values['hemo_lbstat'])
+    self.assertEqual('', values['cbc_lbdtc'])
+
   def tearDown(self):
     return()
 